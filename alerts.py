@@ -0,0 +1,349 @@
+import os
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import text, bindparam, DateTime
+from db import get_engine
+from shared_state import acquire_lease
+
+logger = logging.getLogger(__name__)
+
+# Порог падения цены по умолчанию и сглаживание EWMA
+WATCH_DEFAULT_DROP = float(os.getenv("WATCH_DEFAULT_DROP", "0.05"))
+WATCH_EWMA_ALPHA = float(os.getenv("WATCH_EWMA_ALPHA", "0.3"))
+WATCH_MAX_PER_CHAT = int(os.getenv("WATCH_MAX_PER_CHAT", "50"))
+
+# Лимиты Telegram: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+ALERT_GLOBAL_RPS = float(os.getenv("ALERT_GLOBAL_RPS", "25"))
+ALERT_CHAT_INTERVAL = float(os.getenv("ALERT_CHAT_INTERVAL", "1.1"))
+ALERT_BATCH_SIZE = int(os.getenv("ALERT_BATCH_SIZE", "500"))
+ALERT_POLL_SECONDS = float(os.getenv("ALERT_POLL_SECONDS", "2"))
+# Уведомлений в одном сообщении и одновременных отправок
+ALERT_MAX_LINES = 20
+ALERT_SEND_CONCURRENCY = 8
+# Уведомления, захваченные упавшим отправителем, возвращаются в очередь
+ALERT_CLAIM_TIMEOUT = timedelta(minutes=5)
+# Уведомления отправляет одна реплика бота: аренда продлевается между пакетами
+ALERT_LEASE_SECONDS = int(os.getenv("ALERT_LEASE_SECONDS", "60"))
+
+WATCHERS_QUERY = text("""
+    SELECT chat_id, product_id, threshold, last_alert_price FROM watches
+    WHERE product_id IN :ids
+""").bindparams(bindparam("ids", expanding=True))
+
+STATE_QUERY = text("""
+    SELECT product_id, ewma, samples FROM watch_state WHERE product_id IN :ids
+""").bindparams(bindparam("ids", expanding=True))
+
+STATE_UPSERT = text("""
+    INSERT INTO watch_state (product_id, ewma, last_price, samples, updated_at)
+    VALUES (:product_id, :ewma, :last_price, :samples, :now)
+    ON CONFLICT (product_id) DO UPDATE SET
+        ewma = excluded.ewma,
+        last_price = excluded.last_price,
+        samples = excluded.samples,
+        updated_at = excluded.updated_at
+""").bindparams(bindparam("now", type_=DateTime))
+
+OUTBOX_INSERT = text("""
+    INSERT INTO alert_outbox (chat_id, product_id, reference_price, price, status, created_at)
+    VALUES (:chat_id, :product_id, :reference_price, :price, 'pending', :now)
+""").bindparams(bindparam("now", type_=DateTime))
+
+CLAIMABLE = """
+    status = 'pending' OR (status = 'sending' AND claimed_at < :stale)
+"""
+
+PG_CLAIM_QUERY = text(f"""
+    UPDATE alert_outbox SET status = 'sending', claimed_at = :now, claimed_by = :token
+    WHERE id IN (
+        SELECT id FROM alert_outbox WHERE {CLAIMABLE}
+        ORDER BY id LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    )
+""").bindparams(bindparam("now", type_=DateTime), bindparam("stale", type_=DateTime))
+
+SQLITE_CLAIM_QUERY = text(f"""
+    UPDATE alert_outbox SET status = 'sending', claimed_at = :now, claimed_by = :token
+    WHERE id IN (
+        SELECT id FROM alert_outbox WHERE {CLAIMABLE}
+        ORDER BY id LIMIT :limit
+    )
+""").bindparams(bindparam("now", type_=DateTime), bindparam("stale", type_=DateTime))
+
+CLAIMED_QUERY = text("""
+    SELECT o.id, o.chat_id, o.product_id, o.reference_price, o.price, p.name
+    FROM alert_outbox o
+    LEFT JOIN products p ON p.id = o.product_id
+    WHERE o.status = 'sending' AND o.claimed_by = :token
+    ORDER BY o.id
+""")
+
+
+def detect_drops(conn, rows, previous, now):
+    """Поиск падений цены у наблюдаемых товаров пакета ingest.
+
+    Для каждого товара хранится EWMA цены: новое наблюдение сравнивается
+    с ним без чтения истории. Уведомление уходит в alert_outbox, если
+    падение не меньше порога подписчика, а после прошлого уведомления
+    цена снизилась еще хотя бы на тот же порог.
+    """
+    prices = {row["id"]: row["price"] for row in rows if row["price"] is not None}
+    if not prices:
+        return 0
+
+    subscribers = {}
+    for watch in conn.execute(WATCHERS_QUERY, {"ids": list(prices)}):
+        subscribers.setdefault(watch.product_id, []).append(watch)
+    if not subscribers:
+        return 0
+
+    state = {row.product_id: row for row in conn.execute(STATE_QUERY, {"ids": list(subscribers)})}
+    states, alerts, alerted, recovered = [], [], [], []
+
+    for product_id, watchers in subscribers.items():
+        price = prices[product_id]
+        current = state.get(product_id)
+        if current is not None:
+            ewma, samples = current.ewma, current.samples
+        else:
+            # Первое наблюдение после подписки: опорой служит прежняя цена товара
+            old = previous.get(product_id)
+            ewma, samples = (old.price if old is not None and old.price else price), 0
+
+        drop = 1 - price / ewma if ewma else 0
+        if drop <= 0:
+            recovered.append(product_id)
+        for watch in watchers:
+            last = watch.last_alert_price
+            if drop >= watch.threshold and (last is None or price <= last * (1 - watch.threshold)):
+                alerts.append({"chat_id": watch.chat_id, "product_id": product_id,
+                               "reference_price": ewma, "price": price, "now": now})
+                alerted.append({"chat_id": watch.chat_id, "product_id": product_id, "price": price})
+
+        states.append({
+            "product_id": product_id,
+            "ewma": WATCH_EWMA_ALPHA * price + (1 - WATCH_EWMA_ALPHA) * ewma,
+            "last_price": price,
+            "samples": samples + 1,
+            "now": now
+        })
+
+    conn.execute(STATE_UPSERT, states)
+    if alerts:
+        conn.execute(OUTBOX_INSERT, alerts)
+        conn.execute(text("""
+            UPDATE watches SET last_alert_price = :price
+            WHERE chat_id = :chat_id AND product_id = :product_id
+        """), alerted)
+    if recovered:
+        # Цена вернулась к среднему — следующее падение снова заслуживает уведомления
+        conn.execute(text("""
+            UPDATE watches SET last_alert_price = NULL
+            WHERE product_id IN :ids AND last_alert_price IS NOT NULL
+        """).bindparams(bindparam("ids", expanding=True)), {"ids": recovered})
+    return len(alerts)
+
+
+def add_watch(chat_id, product_id, threshold=WATCH_DEFAULT_DROP):
+    """Подписка чата на снижение цены: "added", "updated", "limit" или "not_found" """
+    with get_engine().begin() as conn:
+        if conn.execute(text("SELECT 1 FROM products WHERE id = :id"), {"id": product_id}).first() is None:
+            return "not_found"
+        params = {"chat_id": chat_id, "product_id": product_id, "threshold": threshold}
+        if conn.execute(text("""
+            UPDATE watches SET threshold = :threshold
+            WHERE chat_id = :chat_id AND product_id = :product_id
+        """), params).rowcount:
+            return "updated"
+        count = conn.execute(text("SELECT COUNT(*) FROM watches WHERE chat_id = :chat_id"), params).scalar()
+        if count >= WATCH_MAX_PER_CHAT:
+            return "limit"
+        conn.execute(text("""
+            INSERT INTO watches (chat_id, product_id, threshold, created_at)
+            VALUES (:chat_id, :product_id, :threshold, :now)
+        """).bindparams(bindparam("now", type_=DateTime)), {**params, "now": datetime.utcnow()})
+    return "added"
+
+
+def remove_watch(chat_id, product_id):
+    """Отписка от товара; False, если подписки не было"""
+    with get_engine().begin() as conn:
+        result = conn.execute(text("""
+            DELETE FROM watches WHERE chat_id = :chat_id AND product_id = :product_id
+        """), {"chat_id": chat_id, "product_id": product_id})
+    return result.rowcount > 0
+
+
+def list_watches(chat_id):
+    """Подписки чата с текущими ценами"""
+    with get_engine().connect() as conn:
+        rows = conn.execute(text("""
+            SELECT w.product_id, w.threshold, p.name, p.price
+            FROM watches w
+            LEFT JOIN products p ON p.id = w.product_id
+            WHERE w.chat_id = :chat_id
+            ORDER BY w.created_at
+        """), {"chat_id": chat_id})
+        return [dict(row._mapping) for row in rows]
+
+
+def claim_alerts(limit=ALERT_BATCH_SIZE):
+    """Захват неотправленных уведомлений для отправки"""
+    now = datetime.utcnow()
+    params = {"now": now, "stale": now - ALERT_CLAIM_TIMEOUT, "limit": limit, "token": uuid.uuid4().hex}
+    with get_engine().begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(PG_CLAIM_QUERY, params)
+        else:
+            conn.execute(SQLITE_CLAIM_QUERY, params)
+        return [dict(row._mapping) for row in conn.execute(CLAIMED_QUERY, params)]
+
+
+def finish_alerts(ids, status):
+    """Отметка уведомлений отправленными ("sent") или недоставленными ("failed")"""
+    if not ids:
+        return
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            UPDATE alert_outbox SET status = :status, sent_at = :now WHERE id IN :ids
+        """).bindparams(bindparam("ids", expanding=True), bindparam("now", type_=DateTime)),
+            {"ids": list(ids), "status": status, "now": datetime.utcnow()})
+
+
+def drop_chat(chat_id):
+    """Удаление подписок чата, который заблокировал бота"""
+    with get_engine().begin() as conn:
+        conn.execute(text("DELETE FROM watches WHERE chat_id = :chat_id"), {"chat_id": chat_id})
+
+
+def format_alerts(alerts):
+    """Сообщения для одного чата: по ALERT_MAX_LINES уведомлений в каждом"""
+    # Несколько уведомлений об одном товаре — достаточно последнего
+    latest = {}
+    for alert in alerts:
+        latest[alert["product_id"]] = alert
+    lines = []
+    for alert in latest.values():
+        name = (alert["name"] or "Товар")[:60].replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        drop = 1 - alert["price"] / alert["reference_price"] if alert["reference_price"] else 0
+        lines.append(
+            f"📉 <b>{name}</b> (ID {alert['product_id']})\n"
+            f"   {alert['reference_price']:,.0f}₸ → <b>{alert['price']:,.0f}₸</b> (−{drop:.0%})"
+        )
+    return [
+        "🔔 <b>Цена снизилась:</b>\n\n" + "\n".join(lines[i:i + ALERT_MAX_LINES])
+        for i in range(0, len(lines), ALERT_MAX_LINES)
+    ]
+
+
+class SendLimiter:
+    """Интервалы отправки: общий темп бота и минимальный интервал для чата"""
+
+    def __init__(self, rate=ALERT_GLOBAL_RPS, chat_interval=ALERT_CHAT_INTERVAL):
+        self.interval = 1 / rate
+        self.chat_interval = chat_interval
+        self.next_slot = 0.0
+        self.next_chat = {}
+        self.paused_until = 0.0
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        slot = max(now, self.next_slot, self.next_chat.get(chat_id, 0.0))
+        self.next_slot = slot + self.interval
+        self.next_chat[chat_id] = slot + self.chat_interval
+        if len(self.next_chat) > 10000:
+            self.next_chat = {chat: t for chat, t in self.next_chat.items() if t > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        # Слоты, выданные до ответа 429, тоже ждут конца паузы
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Интервал чата отсчитывается от фактической отправки
+        self.next_chat[chat_id] = time.monotonic() + self.chat_interval
+
+    def pause(self, seconds):
+        """Пауза всех отправок после ответа 429"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.next_slot = max(self.next_slot, self.paused_until)
+
+
+class AlertSender:
+    """Фоновая отправка уведомлений из alert_outbox с учетом лимитов Telegram"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.limiter = SendLimiter()
+        self.slots = asyncio.Semaphore(ALERT_SEND_CONCURRENCY)
+
+    async def _send(self, chat_id, text_message):
+        from aiogram.utils.exceptions import RetryAfter
+        for _ in range(3):
+            try:
+                async with self.slots:
+                    await self.limiter.acquire(chat_id)
+                    await self.bot.send_message(chat_id, text_message, parse_mode='HTML',
+                                                disable_web_page_preview=True)
+                return
+            except RetryAfter as e:
+                logger.warning(f"Telegram просит паузу {e.timeout} с")
+                self.limiter.pause(e.timeout)
+        raise RuntimeError("Превышено число повторов отправки")
+
+    async def _deliver(self, chat_id, alerts):
+        from aiogram.utils.exceptions import Unauthorized, ChatNotFound
+        from async_db import run_db
+        ids = [alert["id"] for alert in alerts]
+        try:
+            for message in format_alerts(alerts):
+                await self._send(chat_id, message)
+        except (Unauthorized, ChatNotFound):
+            # Бот заблокирован или чат удален — подписки больше не нужны
+            await run_db(drop_chat, chat_id)
+            await run_db(finish_alerts, ids, "failed")
+            return
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомлений в чат {chat_id}: {e}")
+            await run_db(finish_alerts, ids, "failed")
+            return
+        await run_db(finish_alerts, ids, "sent")
+
+    async def run(self):
+        """Цикл отправки: уведомления одного чата объединяются в одно сообщение"""
+        from async_db import run_db
+        logger.info("🔔 Отправка уведомлений запущена")
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+        leader, renewed = False, None
+        while True:
+            if renewed is None or time.monotonic() - renewed >= ALERT_LEASE_SECONDS / 3:
+                try:
+                    held = await run_db(acquire_lease, "alert_sender", owner, ALERT_LEASE_SECONDS)
+                except Exception as e:
+                    logger.error(f"Ошибка продления аренды отправки уведомлений: {e}")
+                    held = False
+                if held != leader:
+                    logger.info("🔔 Реплика отправляет уведомления" if held
+                                else "Уведомления отправляет другая реплика")
+                leader, renewed = held, time.monotonic()
+            if not leader:
+                await asyncio.sleep(ALERT_POLL_SECONDS)
+                continue
+
+            try:
+                alerts = await run_db(claim_alerts)
+            except Exception as e:
+                logger.error(f"Ошибка чтения очереди уведомлений: {e}")
+                alerts = []
+            if not alerts:
+                await asyncio.sleep(ALERT_POLL_SECONDS)
+                continue
+
+            by_chat = {}
+            for alert in alerts:
+                by_chat.setdefault(alert["chat_id"], []).append(alert)
+            await asyncio.gather(*(self._deliver(chat_id, items) for chat_id, items in by_chat.items()))
+            logger.info(f"Отправлено {len(alerts)} уведомлений в {len(by_chat)} чатов")
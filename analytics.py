@@ -1,31 +1,50 @@
-from db import engine
-from sqlalchemy import text
+import os
+import time
+from db import get_engine, ROLLUP_TABLES
+from sqlalchemy import text, bindparam, DateTime, Float
 from io import BytesIO
-import matplotlib.pyplot as plt
-import matplotlib
 import logging
 from datetime import datetime, timedelta
+from charts import render_price_chart
+import history_archive
 
-# Используем Agg backend для работы без GUI (важно для Render)
-matplotlib.use('Agg')
 logger = logging.getLogger(__name__)
 
-def get_top_niches(limit=10):
-    """Получение ТОП ниш по количеству товаров и отзывов"""
+# Короткий кеш ТОП ниш: статистика меняется только при обновлении данных
+NICHES_CACHE_TTL = int(os.getenv("NICHES_CACHE_TTL", "60"))
+NICHES_ORDER = {
+    "demand": "demand DESC, products DESC",
+    "score": "score DESC"
+}
+
+_niches_cache = {}
+
+def get_top_niches(limit=10, order_by="demand"):
+    """Получение ТОП ниш из статистики категорий.
+
+    order_by: "demand" — по суммарному числу отзывов, "score" — по спросу
+    на один товар (много отзывов при малой конкуренции).
+    """
+    cache_key = (limit, order_by)
+    cached = _niches_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
     try:
-        with engine.connect() as conn:
-            # Запрос для получения ТОП категорий
-            query = text("""
+        with get_engine().connect() as conn:
+            # Индексированное чтение первых limit строк
+            query = text(f"""
                 SELECT 
                     category as name,
-                    COUNT(*) as products,
-                    SUM(reviews) as demand
-                FROM products 
-                WHERE category IS NOT NULL 
-                AND category != ''
-                AND is_active = 1
-                GROUP BY category 
-                ORDER BY demand DESC, products DESC
+                    products,
+                    demand,
+                    CASE WHEN priced > 0 THEN price_sum / priced END as avg_price,
+                    price_change_7d,
+                    price_change_30d,
+                    score
+                FROM category_stats 
+                WHERE products > 0
+                ORDER BY {NICHES_ORDER[order_by]}
                 LIMIT :limit
             """)
             
@@ -36,9 +55,14 @@ def get_top_niches(limit=10):
                 niches_list.append({
                     "name": row.name,
                     "products": row.products,
-                    "demand": int(row.demand) if row.demand else 0
+                    "demand": int(row.demand) if row.demand else 0,
+                    "avg_price": row.avg_price,
+                    "price_change_7d": row.price_change_7d,
+                    "price_change_30d": row.price_change_30d,
+                    "score": row.score
                 })
             
+            _niches_cache[cache_key] = (time.monotonic() + NICHES_CACHE_TTL, niches_list)
             logger.info(f"Получено {len(niches_list)} ниш")
             return niches_list
             
@@ -53,129 +77,361 @@ def get_top_niches(limit=10):
             {"name": "Планшеты", "products": 15, "demand": 920}
         ]
 
-def get_price_trend(product_id):
-    """Получение истории цен для товара"""
+# Выбор разрешения истории по длине окна
+TREND_RAW_MAX_DAYS = 3
+TREND_HOURLY_MAX_DAYS = 60
+# Максимум точек на графике
+MAX_CHART_POINTS = 300
+# Размер страницы истории цен по умолчанию и максимальный
+HISTORY_PAGE_SIZE = 500
+HISTORY_PAGE_MAX = 5000
+
+def choose_resolution(since, until):
+    """Разрешение истории для окна: raw, hour или day"""
+    if since is None:
+        return "day"
+    span = (until or datetime.utcnow()) - since
+    if span <= timedelta(days=TREND_RAW_MAX_DAYS):
+        return "raw"
+    if span <= timedelta(days=TREND_HOURLY_MAX_DAYS):
+        return "hour"
+    return "day"
+
+def _first_timestamp(conn, product_id):
+    if history_archive.archive_boundary():
+        first_seen = history_archive.first_timestamp(product_id)
+        if first_seen:
+            return first_seen
+    query = text("""
+        SELECT MIN(timestamp) AS first_seen FROM price_history WHERE product_id = :product_id
+    """).columns(first_seen=DateTime)
+    return conn.execute(query, {"product_id": product_id}).scalar()
+
+def _time_params(since=None, until=None):
+    # Типизированные параметры: SQLite сравнивает даты как строки формата SQLAlchemy
+    names = [name for name, value in (("since", since), ("until", until)) if value]
+    return [bindparam(name, type_=DateTime) for name in names]
+
+def _raw_trend(conn, product_id, since, until):
+    """Ступенчатый ряд из сырых изменений цены (старые месяцы — из архива)"""
+    # Записи раньше границы читаются только из архива: пока месяц переносится,
+    # он есть и в базе, и в файле
+    boundary = history_archive.archive_boundary()
+    params = {"product_id": product_id, "since": since, "until": until, "boundary": boundary}
+    conditions = ["product_id = :product_id"]
+    if since:
+        conditions.append("timestamp >= :since")
+    if until:
+        conditions.append("timestamp <= :until")
+    if boundary:
+        conditions.append("timestamp >= :boundary")
+    boundary_param = [bindparam("boundary", type_=DateTime)] if boundary else []
+
+    query = text(f"""
+        SELECT 
+            price,
+            timestamp,
+            last_seen
+        FROM price_history 
+        WHERE {' AND '.join(conditions)}
+        ORDER BY timestamp ASC
+    """).bindparams(*_time_params(since, until), *boundary_param).columns(
+        price=Float, timestamp=DateTime, last_seen=DateTime
+    )
+
+    rows = []
+    if boundary and (since is None or since < boundary):
+        rows = history_archive.read_history(product_id, since, until)
+
+    trend_data = []
+
+    # Цена, действовавшая на начало окна
+    if since:
+        previous = conn.execute(text(f"""
+            SELECT price, last_seen FROM price_history
+            WHERE product_id = :product_id AND timestamp < :since
+            {"AND timestamp >= :boundary" if boundary else ""}
+            ORDER BY timestamp DESC
+            LIMIT 1
+        """).bindparams(*_time_params(since), *boundary_param).columns(price=Float, last_seen=DateTime),
+            params).fetchone()
+        if previous is None and boundary:
+            previous = history_archive.previous_row(product_id, since)
+        if previous:
+            trend_data.append({"price": float(previous[0]), "time": since})
+
+    # Каждая строка — начало ступени; last_seen — последнее наблюдение той же цены
+    rows.extend(conn.execute(query, params))
+    for price, timestamp, last_seen in rows:
+        price = float(price)
+        trend_data.append({
+            "price": price,
+            "time": timestamp
+        })
+        last_seen = min(last_seen, until) if last_seen and until else last_seen
+        if last_seen and last_seen > timestamp:
+            trend_data.append({
+                "price": price,
+                "time": last_seen
+            })
+
+    return trend_data
+
+def _rollup_trend(conn, product_id, since, until, resolution):
+    """Ряд OHLC-агрегатов: цена закрытия интервала плюс минимум и максимум"""
+    conditions = ["product_id = :product_id"]
+    if since:
+        conditions.append("bucket >= :since")
+    if until:
+        conditions.append("bucket <= :until")
+
+    query = text(f"""
+        SELECT bucket, open, high, low, close
+        FROM {ROLLUP_TABLES[resolution].name}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY bucket ASC
+    """).bindparams(*_time_params(since, until)).columns(
+        bucket=DateTime, open=Float, high=Float, low=Float, close=Float
+    )
+
+    result = conn.execute(query, {"product_id": product_id, "since": since, "until": until})
+    return [
+        {
+            "price": float(row.close),
+            "time": row.bucket,
+            "open": float(row.open),
+            "high": float(row.high),
+            "low": float(row.low)
+        }
+        for row in result
+    ]
+
+def get_price_trend(product_id, since=None, until=None, resolution=None):
+    """Получение истории цен для товара в окне [since, until].
+
+    Разрешение (raw / hour / day) выбирается по длине окна, если не задано явно.
+    """
     try:
-        with engine.connect() as conn:
-            query = text("""
-                SELECT 
-                    price,
-                    timestamp
-                FROM price_history 
-                WHERE product_id = :product_id
-                ORDER BY timestamp ASC
-            """)
-            
-            result = conn.execute(query, {"product_id": product_id})
-            trend_data = []
-            
-            for row in result:
-                trend_data.append({
-                    "price": float(row.price),
-                    "time": row.timestamp
-                })
+        with get_engine().connect() as conn:
+            if resolution is None:
+                first_seen = since or _first_timestamp(conn, product_id)
+                resolution = choose_resolution(first_seen, until)
+
+            if resolution == "raw":
+                trend_data = _raw_trend(conn, product_id, since, until)
+            else:
+                trend_data = _rollup_trend(conn, product_id, since, until, resolution)
+                # Агрегатов может не быть для истории, записанной в обход ingest
+                if not trend_data:
+                    trend_data = _raw_trend(conn, product_id, since, until)
             
-            logger.info(f"Получено {len(trend_data)} записей истории цен для товара {product_id}")
+            logger.info(
+                f"Получено {len(trend_data)} записей истории цен для товара {product_id} "
+                f"(разрешение {resolution})"
+            )
             return trend_data
             
     except Exception as e:
         logger.error(f"Ошибка получения истории цен для товара {product_id}: {e}")
         return []
 
-def plot_price_trend(product_id):
+def encode_cursor(timestamp, skip=0):
+    """Курсор страницы истории: время последней прочитанной записи и число
+    уже прочитанных записей с этим временем"""
+    return f"{timestamp:%Y-%m-%dT%H:%M:%S.%f}~{skip}"
+
+def decode_cursor(cursor):
+    """(время, пропуск) из курсора encode_cursor (ValueError для некорректного)"""
+    value, _, skip = cursor.partition("~")
+    skip = int(skip or 0)
+    if skip < 0:
+        raise ValueError(f"Некорректный курсор: {cursor}")
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f"), skip
+
+def get_price_history(product_id, since=None, until=None, limit=HISTORY_PAGE_SIZE, cursor=None):
+    """Страница сырых записей истории цен товара в окне [since, until] по времени.
+
+    cursor — next_cursor предыдущей страницы: чтение продолжается с его
+    времени диапазоном индекса (product_id, timestamp), без OFFSET, поэтому
+    стоимость страницы не зависит от ее номера и возраста товара. Записи
+    с одинаковым временем не теряются: курсор помнит, сколько их уже прочитано.
+    Возвращает {"rows": [{"price", "time", "last_seen"}], "next_cursor"};
+    next_cursor равен None на последней странице.
+    """
+    limit = max(1, min(limit or HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX))
+    try:
+        after, skip = decode_cursor(cursor) if cursor else (None, 0)
+    except ValueError:
+        logger.warning(f"⚠️ Некорректный курсор истории цен товара {product_id}: {cursor!r}")
+        return {"rows": [], "next_cursor": None}
+    # Одна лишняя запись показывает, есть ли следующая страница; записи
+    # со временем курсора, прочитанные на прошлых страницах, отбрасываются
+    wanted = limit + 1 + skip
+    try:
+        boundary = history_archive.archive_boundary()
+        lower = max(after, since) if after and since else after or since
+        rows = []
+        if boundary and (lower is None or lower < boundary):
+            rows = history_archive.read_history(product_id, lower, until, wanted, carried=False)
+
+        if len(rows) < wanted:
+            params = {
+                "product_id": product_id, "since": since, "until": until, "after": after,
+                "boundary": boundary, "limit": wanted - len(rows),
+                "carry": history_archive.CARRY_SOURCE
+            }
+            # Перенесенная на границу архива цена — не наблюдение
+            conditions = ["product_id = :product_id", "COALESCE(source, '') <> :carry"]
+            binds = _time_params(since, until)
+            if since:
+                conditions.append("timestamp >= :since")
+            if until:
+                conditions.append("timestamp <= :until")
+            if after:
+                conditions.append("timestamp >= :after")
+                binds.append(bindparam("after", type_=DateTime))
+            if boundary:
+                conditions.append("timestamp >= :boundary")
+                binds.append(bindparam("boundary", type_=DateTime))
+            query = text(f"""
+                SELECT price, timestamp, last_seen
+                FROM price_history
+                WHERE {' AND '.join(conditions)}
+                ORDER BY timestamp ASC, id ASC
+                LIMIT :limit
+            """).bindparams(*binds).columns(price=Float, timestamp=DateTime, last_seen=DateTime)
+            with get_engine().connect() as conn:
+                rows.extend(tuple(row) for row in conn.execute(query, params))
+
+        ties = 0
+        while ties < min(skip, len(rows)) and rows[ties][1] == after:
+            ties += 1
+        rows = rows[ties:]
+        page = [
+            {"price": float(price), "time": timestamp, "last_seen": last_seen}
+            for price, timestamp, last_seen in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = page[-1]["time"]
+            read = sum(1 for row in page if row["time"] == last) + (ties if last == after else 0)
+            next_cursor = encode_cursor(last, read)
+        return {"rows": page, "next_cursor": next_cursor}
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы истории цен товара {product_id}: {e}")
+        return {"rows": [], "next_cursor": None}
+
+def downsample_lttb(points, threshold=MAX_CHART_POINTS):
+    """Прореживание ряда алгоритмом Largest-Triangle-Three-Buckets.
+
+    Сохраняет форму графика (пики и провалы), оставляя не больше threshold точек.
+    """
+    count = len(points)
+    if threshold >= count or threshold < 3:
+        return points
+
+    xs = [p["time"].timestamp() for p in points]
+    ys = [p["price"] for p in points]
+    sampled = [points[0]]
+    bucket_size = (count - 2) / (threshold - 2)
+    selected = 0
+
+    for i in range(threshold - 2):
+        # Среднее следующей корзины — третья вершина треугольника
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, count)
+        span = max(next_end - next_start, 1)
+        avg_x = sum(xs[next_start:next_end]) / span if next_end > next_start else xs[-1]
+        avg_y = sum(ys[next_start:next_end]) / span if next_end > next_start else ys[-1]
+
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        ax, ay = xs[selected], ys[selected]
+        best_area = -1
+        best = start
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = j
+
+        sampled.append(points[best])
+        selected = best
+
+    sampled.append(points[-1])
+    return sampled
+
+def get_latest_observation(product_id):
+    """Время последнего наблюдения цены товара (None, если истории нет)"""
+    try:
+        with get_engine().connect() as conn:
+            query = text("""
+                SELECT MAX(COALESCE(last_seen, timestamp)) AS latest
+                FROM price_history
+                WHERE product_id = :product_id
+            """).columns(latest=DateTime)
+            latest = conn.execute(query, {"product_id": product_id}).scalar()
+        # Товар, который давно не встречался, может остаться только в архиве
+        if latest is None and history_archive.archive_boundary():
+            latest = history_archive.latest_observation(product_id)
+        return latest
+    except Exception as e:
+        logger.error(f"Ошибка получения последнего наблюдения товара {product_id}: {e}")
+        return None
+
+def record_trend_hit(product_id):
+    """Учет запроса графика товара (сигнал интереса для планировщика)"""
+    day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    try:
+        with get_engine().begin() as conn:
+            conn.execute(text("""
+                INSERT INTO trend_hits (product_id, day, hits)
+                VALUES (:product_id, :day, 1)
+                ON CONFLICT (product_id, day) DO UPDATE SET hits = trend_hits.hits + 1
+            """).bindparams(bindparam("day", type_=DateTime)), {"product_id": product_id, "day": day})
+    except Exception as e:
+        logger.error(f"Ошибка учета запроса графика товара {product_id}: {e}")
+
+def get_product(product_id):
+    """Карточка товара по ID"""
+    try:
+        with get_engine().connect() as conn:
+            query = text("""
+                SELECT id, name, category, price, rating, reviews, url
+                FROM products
+                WHERE id = :product_id
+            """)
+            row = conn.execute(query, {"product_id": product_id}).fetchone()
+            return dict(row._mapping) if row else None
+    except Exception as e:
+        logger.error(f"Ошибка получения товара {product_id}: {e}")
+        return None
+
+def plot_price_trend(product_id, since=None, until=None):
     """Построение графика динамики цены"""
     try:
-        trend = get_price_trend(product_id)
+        trend = get_price_trend(product_id, since, until)
         
         if not trend:
             logger.warning(f"Нет данных для построения графика товара {product_id}")
             return None
         
+        # Ограничиваем число точек, чтобы время отрисовки не зависело от длины истории
+        trend = downsample_lttb(trend, MAX_CHART_POINTS)
+        
         # Подготавливаем данные
         times = [t['time'] for t in trend]
         prices = [t['price'] for t in trend]
         
         # Получаем информацию о товаре
-        product_name = "Товар"
-        with engine.connect() as conn:
-            query = text("SELECT name FROM products WHERE id = :product_id")
-            result = conn.execute(query, {"product_id": product_id})
-            row = result.fetchone()
-            if row:
-                product_name = row.name
-        
-        # Создаем график
-        plt.figure(figsize=(12, 6), facecolor='#f8f9fa')
-        
-        # Основной график
-        plt.plot(times, prices, marker='o', linestyle='-', 
-                color='#2c3e50', linewidth=2.5, markersize=6,
-                markerfacecolor='#e74c3c', markeredgecolor='#c0392b')
-        
-        # Настройки графика
-        plt.title(f"📈 Динамика цены: {product_name[:50]}...", 
-                 fontsize=16, fontweight='bold', color='#2c3e50', pad=20)
-        plt.xlabel("Дата", fontsize=12, color='#34495e')
-        plt.ylabel("Цена (₸)", fontsize=12, color='#34495e')
-        
-        # Форматирование оси X для дат
-        plt.gcf().autofmt_xdate()
-        
-        # Добавляем сетку
-        plt.grid(True, alpha=0.3, linestyle='--', linewidth=0.5)
-        
-        # Добавляем аннотации для минимального и максимального значения
-        min_price = min(prices)
-        max_price = max(prices)
-        min_time = times[prices.index(min_price)]
-        max_time = times[prices.index(max_price)]
-        
-        # Линии минимума и максимума
-        plt.axhline(y=min_price, color='#27ae60', linestyle=':', alpha=0.7, linewidth=1.5)
-        plt.axhline(y=max_price, color='#e74c3c', linestyle=':', alpha=0.7, linewidth=1.5)
-        
-        # Аннотации
-        plt.annotate(f'Мин: {min_price:,.0f}₸', 
-                    xy=(min_time, min_price),
-                    xytext=(10, 10),
-                    textcoords='offset points',
-                    color='#27ae60',
-                    fontweight='bold',
-                    bbox=dict(boxstyle='round,pad=0.3', facecolor='#d5f4e6', alpha=0.8))
-        
-        plt.annotate(f'Макс: {max_price:,.0f}₸', 
-                    xy=(max_time, max_price),
-                    xytext=(10, -20),
-                    textcoords='offset points',
-                    color='#e74c3c',
-                    fontweight='bold',
-                    bbox=dict(boxstyle='round,pad=0.3', facecolor='#fadbd8', alpha=0.8))
-        
-        # Текущая цена
-        current_price = prices[-1]
-        plt.annotate(f'Текущая: {current_price:,.0f}₸', 
-                    xy=(times[-1], current_price),
-                    xytext=(-100, 20),
-                    textcoords='offset points',
-                    arrowprops=dict(arrowstyle='->', color='#3498db'),
-                    color='#2980b9',
-                    fontweight='bold',
-                    bbox=dict(boxstyle='round,pad=0.5', facecolor='#ebf5fb', alpha=0.9))
-        
-        # Настройка внешнего вида
-        plt.gca().set_facecolor('#ffffff')
-        plt.tight_layout()
+        product = get_product(product_id)
+        product_name = product["name"] if product else "Товар"
         
-        # Сохраняем в буфер
-        buf = BytesIO()
-        plt.savefig(buf, format='png', dpi=100, bbox_inches='tight', 
-                   facecolor=plt.gcf().get_facecolor())
-        buf.seek(0)
-        plt.close()
+        buf = BytesIO(render_price_chart(times, prices, product_name))
         
         logger.info(f"График для товара {product_id} успешно построен")
         return buf
         
     except Exception as e:
         logger.error(f"Ошибка построения графика для товара {product_id}: {e}")
-        return None
\ No newline at end of file
+        return None
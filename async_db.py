@@ -0,0 +1,119 @@
+import time
+import asyncio
+import logging
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import startup
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    # Отдельный пул потоков по размеру пула соединений: запросы хендлеров
+    # не ждут ни event loop, ни свободного соединения
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from db import DB_POOL_SIZE
+                _executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+    return _executor
+
+
+def _analytics():
+    # SQLAlchemy и analytics загружаются при первом запросе, а не при старте бота
+    import analytics
+    return analytics
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполнение синхронной функции доступа к БД вне event loop"""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    result = await loop.run_in_executor(_get_executor(), partial(func, *args, **kwargs))
+    startup.mark("first_query", time.perf_counter() - started)
+    return result
+
+
+async def get_top_niches(limit=10, order_by="demand"):
+    """Асинхронная версия analytics.get_top_niches"""
+    return await run_db(lambda: _analytics().get_top_niches(limit, order_by))
+
+
+async def get_price_trend(product_id, since=None, until=None, resolution=None):
+    """Асинхронная версия analytics.get_price_trend"""
+    return await run_db(lambda: _analytics().get_price_trend(product_id, since, until, resolution))
+
+
+async def get_price_history(product_id, since=None, until=None, limit=None, cursor=None):
+    """Асинхронная версия analytics.get_price_history"""
+    return await run_db(lambda: _analytics().get_price_history(product_id, since, until, limit, cursor))
+
+
+async def get_product(product_id):
+    """Асинхронная версия analytics.get_product"""
+    return await run_db(lambda: _analytics().get_product(product_id))
+
+
+async def get_latest_observation(product_id):
+    """Асинхронная версия analytics.get_latest_observation"""
+    return await run_db(lambda: _analytics().get_latest_observation(product_id))
+
+
+async def record_trend_hit(product_id):
+    """Асинхронная версия analytics.record_trend_hit"""
+    return await run_db(lambda: _analytics().record_trend_hit(product_id))
+
+
+def _search():
+    import search
+    return search
+
+
+async def search_products(query, limit=None):
+    """Асинхронная версия search.search_products"""
+    return await run_db(lambda: _search().search_products(query, limit or _search().SEARCH_LIMIT))
+
+
+def _alerts():
+    import alerts
+    return alerts
+
+
+async def add_watch(chat_id, product_id, threshold=None):
+    """Асинхронная версия alerts.add_watch"""
+    return await run_db(lambda: _alerts().add_watch(chat_id, product_id, threshold or _alerts().WATCH_DEFAULT_DROP))
+
+
+async def remove_watch(chat_id, product_id):
+    """Асинхронная версия alerts.remove_watch"""
+    return await run_db(lambda: _alerts().remove_watch(chat_id, product_id))
+
+
+async def list_watches(chat_id):
+    """Асинхронная версия alerts.list_watches"""
+    return await run_db(lambda: _alerts().list_watches(chat_id))
+
+
+def _shared_state():
+    import shared_state
+    return shared_state
+
+
+async def claim_update(update_id):
+    """Асинхронная версия shared_state.claim_update"""
+    return await run_db(lambda: _shared_state().claim_update(update_id))
+
+
+async def get_chart_file_id(key):
+    """Асинхронная версия shared_state.get_file_id"""
+    return await run_db(lambda: _shared_state().get_file_id(key))
+
+
+async def save_chart_file_id(key, file_id):
+    """Асинхронная версия shared_state.set_file_id"""
+    return await run_db(lambda: _shared_state().set_file_id(key, file_id))
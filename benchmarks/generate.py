@@ -0,0 +1,246 @@
+"""Генератор синтетического каталога Kaspi для бенчмарков.
+
+Заполняет products и price_history (история только из изменений цены,
+в порядке обходов, как пишет ingest), затем прогоняет migrate() для
+индексов, агрегатов и статистики категорий. Отдельно сохраняет HTML
+страниц листинга в разметке Kaspi для бенчмарков парсера.
+
+    python benchmarks/generate.py --database-url sqlite:///bench.db --products 1000000 --history 100
+"""
+import os
+import io
+import csv
+import sys
+import time
+import random
+import logging
+import argparse
+from array import array
+from itertools import accumulate
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logger = logging.getLogger(__name__)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+CARDS_PER_PAGE = 12
+CHUNK_ROWS = 50000
+
+BRANDS = ["Apple", "Samsung", "Xiaomi", "Huawei", "Lenovo", "ASUS", "HP", "Philips",
+          "Bosch", "LG", "Sony", "Redmond", "Tefal", "Polaris", "Honor", "Realme"]
+NOUNS = ["Смартфон", "Ноутбук", "Наушники", "Смарт-часы", "Пылесос", "Телевизор",
+         "Холодильник", "Планшет", "Монитор", "Чайник", "Фен", "Утюг", "Роутер", "Колонка"]
+SUFFIXES = ["Pro", "Max", "Lite", "Plus", "Ultra", "Mini", "SE", "Neo", "X", "S"]
+
+HISTORY_COLUMNS = ["product_id", "price", "timestamp", "source", "last_seen"]
+PRODUCT_COLUMNS = ["id", "name", "category", "price", "rating", "reviews", "url",
+                   "created_at", "updated_at", "is_active"]
+
+
+def category_names(count):
+    return [f"{NOUNS[i % len(NOUNS)]} {i // len(NOUNS) + 1}" for i in range(count)]
+
+
+def _write_rows(conn, table, columns, rows):
+    if not rows:
+        return
+    if conn.dialect.name == "postgresql":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            writer.writerow([row[column] for column in columns])
+        buf.seek(0)
+        cursor = conn.connection.driver_connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+        finally:
+            cursor.close()
+        return
+    from ingest import _sqlite_insert_many
+    _sqlite_insert_many(conn, table, columns, rows)
+
+
+def generate_catalog(engine, products=100000, history=20, categories=500, days=365, seed=1):
+    """Синтетические товары и история цен.
+
+    history — среднее число строк истории на товар; обход каталога
+    моделируется каждые 6 часов, в каждом обходе часть товаров меняет цену.
+    """
+    from sqlalchemy import text, bindparam, DateTime
+
+    rnd = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    start = now - timedelta(days=days)
+    rounds = max(days * 4, 1)
+    change_rate = max(history - 1, 0) / rounds
+    prices = array("d", (round(rnd.lognormvariate(10.5, 1.2), -1) for _ in range(products)))
+    started = time.perf_counter()
+    written = 0
+
+    with engine.begin() as conn:
+        for round_index in range(rounds):
+            observed = start + timedelta(hours=6 * round_index)
+            if round_index == 0:
+                changed = range(products)
+            else:
+                count = min(products, int(rnd.gauss(products * change_rate, (products * change_rate) ** 0.5 + 1)))
+                changed = sorted(rnd.sample(range(products), max(count, 0)))
+
+            rows = []
+            for index in changed:
+                if round_index:
+                    prices[index] = max(round(prices[index] * rnd.uniform(0.9, 1.1), -1), 10.0)
+                rows.append({
+                    "product_id": index + 1,
+                    "price": prices[index],
+                    "timestamp": observed,
+                    "source": "kaspi",
+                    "last_seen": observed
+                })
+                if len(rows) >= CHUNK_ROWS:
+                    _write_rows(conn, "price_history", HISTORY_COLUMNS, rows)
+                    written += len(rows)
+                    rows = []
+            _write_rows(conn, "price_history", HISTORY_COLUMNS, rows)
+            written += len(rows)
+
+            if round_index % 100 == 0:
+                logger.info(f"Обход {round_index}/{rounds}: {written} строк истории")
+
+        # Последняя цена каждого товара наблюдалась в последнем обходе
+        conn.execute(text("""
+            UPDATE price_history SET last_seen = :now
+            WHERE id IN (SELECT MAX(id) FROM price_history GROUP BY product_id)
+        """).bindparams(bindparam("now", type_=DateTime)), {"now": now})
+
+        names = category_names(categories)
+        # Популярность категорий распределена по Ципфу
+        cum_weights = list(accumulate(1 / (rank + 1) for rank in range(categories)))
+        rows = []
+        for index in range(products):
+            category = rnd.choices(names, cum_weights=cum_weights)[0]
+            product_id = index + 1
+            rows.append({
+                "id": product_id,
+                "name": f"{category.split()[0]} {rnd.choice(BRANDS)} {rnd.choice(SUFFIXES)} {product_id}",
+                "category": category,
+                "price": prices[index],
+                "rating": round(rnd.uniform(3.5, 5.0), 1),
+                "reviews": int(rnd.paretovariate(1.2)) - 1,
+                "url": f"https://kaspi.kz/shop/p/product-{product_id}/",
+                "created_at": start,
+                "updated_at": now,
+                "is_active": 1
+            })
+            if len(rows) >= CHUNK_ROWS:
+                _write_rows(conn, "products", PRODUCT_COLUMNS, rows)
+                rows = []
+        _write_rows(conn, "products", PRODUCT_COLUMNS, rows)
+
+    logger.info(f"Сгенерировано {products} товаров и {written} строк истории "
+                f"за {time.perf_counter() - started:.1f} с")
+    return {"products": products, "price_history": written}
+
+
+def _card(product_id, name, price, rating, reviews):
+    return (
+        f'<div class="item-card ddl_product ddl_product_link undefined" data-product-id="{product_id}">'
+        f'<div class="item-card__image-wrapper"><a href="/shop/p/product-{product_id}/?c=750000000">'
+        f'<img class="item-card__image" src="/images/{product_id}.jpg" alt="{name}"></a></div>'
+        f'<div class="item-card__info">'
+        f'<div class="item-card__name"><a href="/shop/p/product-{product_id}/?c=750000000" '
+        f'class="item-card__name-link">{name}</a></div>'
+        f'<div class="item-card__rating"><span class="rating _small _{int(rating * 10)}"></span>'
+        f'<a href="/shop/p/product-{product_id}/#!/reviews">({reviews} отзывов)</a></div>'
+        f'<div class="item-card__prices"><div class="item-card__debet">'
+        f'<span class="item-card__prices-title">Цена</span>'
+        f'<span class="item-card__prices-price">{price:,.0f} ₸</span></div>'
+        f'<div class="item-card__instalment"><span class="item-card__prices-price">'
+        f'{price / 12:,.0f} ₸ x 12</span></div></div>'
+        f'</div></div>'
+    ).replace(",", "&nbsp;")
+
+
+def listing_page(category, slug, page, pages, rnd, categories):
+    """HTML страницы листинга в разметке Kaspi"""
+    cards = []
+    for i in range(CARDS_PER_PAGE):
+        product_id = 100000000 + page * CARDS_PER_PAGE + i
+        cards.append(_card(
+            product_id,
+            f"{category.split()[0]} {rnd.choice(BRANDS)} {rnd.choice(SUFFIXES)} {product_id}",
+            round(rnd.lognormvariate(10.5, 1.2), -1),
+            round(rnd.uniform(3.5, 5.0), 1),
+            rnd.randint(0, 5000)
+        ))
+    links = "".join(
+        f'<li class="tree__item"><a href="/shop/c/{other}/" class="tree__link">{other}</a></li>'
+        for other in categories
+    )
+    next_class = "pagination__el" if page < pages else "pagination__el _disabled"
+    return (
+        '<!DOCTYPE html><html lang="ru"><head><meta charset="utf-8">'
+        f'<title>{category} — купить в Kaspi</title></head><body>'
+        '<header class="header"><nav><ul class="menu">'
+        '<li><a href="/shop/">Магазин</a></li><li><a href="/guide/">Помощь</a></li></ul></nav></header>'
+        f'<div class="layout"><aside class="filters"><ul class="tree">{links}</ul></aside>'
+        f'<main><h1 class="search-result__title">{category}</h1>'
+        f'<div class="item-cards-grid">{"".join(cards)}</div>'
+        f'<ul class="pagination"><li class="pagination__el">← Предыдущая</li>'
+        f'<li class="pagination__el _active">{page}</li>'
+        f'<li class="{next_class}">Следующая →</li></ul></main></div>'
+        '<footer class="footer">© Kaspi.kz</footer></body></html>'
+    )
+
+
+def write_fixtures(directory=FIXTURES_DIR, categories=5, pages=10, seed=1):
+    """Сохранение страниц листинга: <slug>/<page>.html"""
+    rnd = random.Random(seed)
+    slugs = [f"category-{i}" for i in range(categories)]
+    names = category_names(categories)
+    for slug, name in zip(slugs, names):
+        os.makedirs(os.path.join(directory, slug), exist_ok=True)
+        for page in range(1, pages + 1):
+            html = listing_page(name, slug, page, pages, rnd, slugs)
+            with open(os.path.join(directory, slug, f"{page}.html"), "w", encoding="utf-8") as f:
+                f.write(html)
+    logger.info(f"Сохранено {categories * pages} страниц листинга в {directory}")
+    return slugs
+
+
+def main():
+    args = argparse.ArgumentParser(description="Синтетический каталог для бенчмарков")
+    args.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL", "sqlite:///bench.db"))
+    args.add_argument("--products", type=int, default=100000)
+    args.add_argument("--history", type=int, default=20, help="строк истории на товар в среднем")
+    args.add_argument("--categories", type=int, default=500)
+    args.add_argument("--days", type=int, default=365)
+    args.add_argument("--fixtures-dir", default=FIXTURES_DIR)
+    args.add_argument("--fixture-categories", type=int, default=5)
+    args.add_argument("--fixture-pages", type=int, default=10)
+    args.add_argument("--seed", type=int, default=1)
+    opts = args.parse_args()
+
+    # URL базы читается модулем db при импорте
+    os.environ["DATABASE_URL"] = opts.database_url
+    from db import get_engine, metadata
+    from migrate import migrate
+
+    engine = get_engine()
+    metadata.create_all(engine)
+    with engine.connect() as conn:
+        from sqlalchemy import text
+        if conn.execute(text("SELECT 1 FROM products LIMIT 1")).first():
+            logger.error("База уже содержит товары — укажите пустую базу")
+            sys.exit(1)
+
+    generate_catalog(engine, opts.products, opts.history, opts.categories, opts.days, opts.seed)
+    # Индексы, агрегаты и статистика категорий — тем же путем, что и в продакшене
+    migrate()
+    write_fixtures(opts.fixtures_dir, opts.fixture_categories, opts.fixture_pages, opts.seed)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
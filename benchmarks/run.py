@@ -0,0 +1,322 @@
+"""Бенчмарки основных путей: ТОП ниш, история цен, график, парсинг.
+
+Для каждого сценария — перцентили задержки, пропускная способность
+и пиковая память; результат пишется в JSON для сравнения во времени.
+
+    python benchmarks/run.py --database-url sqlite:///bench.db
+    python benchmarks/run.py --database-url postgresql://localhost/bench --compare benchmarks/results/old.json
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import asyncio
+import tempfile
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+logger = logging.getLogger(__name__)
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+
+# Окна истории цен для get_price_trend
+TREND_WINDOWS = {"7d": timedelta(days=7), "30d": timedelta(days=30), "1y": timedelta(days=365), "all": None}
+
+
+def percentile(values, q):
+    """Перцентиль с линейной интерполяцией по отсортированному списку"""
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def measure(fn, iterations, warmup=3, memory_iterations=5):
+    """Задержки вызовов fn() в мс, пропускная способность и пиковая память Python"""
+    for _ in range(warmup):
+        fn()
+
+    latencies = []
+    gc.collect()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - call_started) * 1000)
+    elapsed = time.perf_counter() - started
+
+    # Память меряется отдельно: tracemalloc заметно замедляет вызовы
+    tracemalloc.start()
+    for _ in range(memory_iterations):
+        fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "iterations": iterations,
+        "mean_ms": sum(latencies) / len(latencies),
+        "p50_ms": percentile(latencies, 50),
+        "p90_ms": percentile(latencies, 90),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": latencies[-1],
+        "throughput_per_s": iterations / elapsed if elapsed else None,
+        "peak_memory_kb": peak / 1024
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _fixture_pages(directory):
+    pages = []
+    for slug in sorted(os.listdir(directory)):
+        category_dir = os.path.join(directory, slug)
+        if not os.path.isdir(category_dir):
+            continue
+        for name in sorted(os.listdir(category_dir), key=lambda n: int(n.split(".")[0])):
+            with open(os.path.join(category_dir, name), encoding="utf-8") as f:
+                pages.append((slug, f.read()))
+    return pages
+
+
+class FixtureServer:
+    """Локальный HTTP-сервер страниц листинга вместо kaspi.kz"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.port = None
+
+    async def _page(self, request):
+        from aiohttp import web
+        page = int(request.query.get("page", 1))
+        path = os.path.join(self.directory, request.match_info["slug"], f"{page}.html")
+        if not os.path.exists(path):
+            raise web.HTTPNotFound()
+        with open(path, encoding="utf-8") as f:
+            return web.Response(text=f.read(), content_type="text/html")
+
+    def start(self):
+        import threading
+        from aiohttp import web
+
+        async def setup():
+            app = web.Application()
+            app.router.add_get("/shop/c/{slug}/", self._page)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, "127.0.0.1", 0)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]
+
+        self.loop.run_until_complete(setup())
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.port}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def build_cases(opts):
+    """Сценарии: имя -> функция без аргументов"""
+    import analytics
+    from sqlalchemy import text
+    from db import get_engine
+
+    rnd = random.Random(opts.seed)
+    with get_engine().connect() as conn:
+        low, high = conn.execute(text("SELECT MIN(id), MAX(id) FROM products")).first()
+    if low is None:
+        raise SystemExit("В базе нет товаров — сначала запустите benchmarks/generate.py")
+
+    def random_product():
+        return rnd.randint(low, high)
+
+    def top_niches():
+        # Без кеша в памяти: меряется чтение из базы
+        analytics._niches_cache.clear()
+        analytics.get_top_niches(10)
+
+    cases = {
+        "top_niches": top_niches,
+        "top_niches_cached": lambda: analytics.get_top_niches(10),
+    }
+    for label, window in TREND_WINDOWS.items():
+        def trend(window=window):
+            since = datetime.utcnow() - window if window else None
+            analytics.get_price_trend(random_product(), since)
+        cases[f"price_trend_{label}"] = trend
+
+    cases["plot_price_trend_30d"] = lambda: analytics.plot_price_trend(
+        random_product(), datetime.utcnow() - timedelta(days=30)
+    )
+    return cases
+
+
+def build_parser_cases(opts, base_url, cache_dir):
+    import parser
+
+    pages = _fixture_pages(opts.fixtures_dir)
+    if not pages:
+        raise SystemExit("Нет HTML-страниц — сначала запустите benchmarks/generate.py")
+    slugs = sorted({slug for slug, _ in pages})
+    cursor = {"page": 0, "slug": 0}
+
+    def parse_listing():
+        slug, html = pages[cursor["page"] % len(pages)]
+        cursor["page"] += 1
+        parser.parse_listing(html, f"{base_url}/shop/c/{slug}/")
+
+    def parse_category():
+        slug = slugs[cursor["slug"] % len(slugs)]
+        cursor["slug"] += 1
+        parser.parse_category(f"{base_url}/shop/c/{slug}/")
+
+    async def walk(url, cache=None):
+        # Страницы подтверждаются сразу, как после записи пакета в ingest_stream
+        async for item in parser.iter_category_products(url, cache=cache):
+            if "page" in item and item["committed"]:
+                item["committed"]()
+
+    def category_products():
+        slug = slugs[cursor["slug"] % len(slugs)]
+        cursor["slug"] += 1
+        asyncio.run(walk(f"{base_url}/shop/c/{slug}/"))
+
+    # Повторный обход одной категории с кешем ответов: страницы не изменились,
+    # их разбор берется из кеша. Первый обход заполняет кеш
+    cache = parser.ResponseCache(os.path.join(cache_dir, "http_cache.db"))
+    cached_url = f"{base_url}/shop/c/{slugs[0]}/"
+    asyncio.run(walk(cached_url, cache))
+
+    def category_products_cached():
+        asyncio.run(walk(cached_url, cache))
+
+    return {
+        "parse_listing": parse_listing,
+        "parse_category": parse_category,
+        "category_products": category_products,
+        "category_products_cached": category_products_cached
+    }, len(pages)
+
+
+def compare(report, baseline_path):
+    """Изменение p50 и p95 относительно прошлого отчета"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"{'сценарий':<24}{'p50, мс':>12}{'Δ p50':>10}{'p95, мс':>12}{'Δ p95':>10}")
+    for name, result in report["results"].items():
+        old = baseline.get("results", {}).get(name)
+        deltas = []
+        for key in ("p50_ms", "p95_ms"):
+            if old and old.get(key):
+                deltas.append(f"{(result[key] / old[key] - 1) * 100:+.1f}%")
+            else:
+                deltas.append("—")
+        print(f"{name:<24}{result['p50_ms']:>12.2f}{deltas[0]:>10}{result['p95_ms']:>12.2f}{deltas[1]:>10}")
+
+
+def main():
+    args = argparse.ArgumentParser(description="Бенчмарки Kaspi Analytic Bot")
+    args.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL", "sqlite:///bench.db"))
+    args.add_argument("--iterations", type=int, default=100)
+    args.add_argument("--warmup", type=int, default=3)
+    args.add_argument("--only", nargs="*", help="запустить только указанные сценарии")
+    args.add_argument("--fixtures-dir", default=FIXTURES_DIR)
+    args.add_argument("--output", help="путь к JSON-отчету (по умолчанию benchmarks/results/)")
+    args.add_argument("--compare", help="прошлый JSON-отчет для сравнения")
+    args.add_argument("--seed", type=int, default=1)
+    opts = args.parse_args()
+
+    # Настройки читаются модулями при импорте: своя база, без общего кеша
+    # ответов (он есть только у category_products_cached) и без ограничения
+    # частоты запросов к локальному серверу
+    os.environ["DATABASE_URL"] = opts.database_url
+    os.environ["HTTP_CACHE_PATH"] = ""
+    os.environ["CRAWL_RATE"] = "100000"
+    os.environ["CRAWL_BURST"] = "100000"
+
+    from sqlalchemy import text
+    from db import get_engine
+
+    server = FixtureServer(opts.fixtures_dir)
+    base_url = server.start()
+    cache_dir = tempfile.TemporaryDirectory(prefix="bench_http_cache_")
+    cases = build_cases(opts)
+    parser_cases, fixture_pages = build_parser_cases(opts, base_url, cache_dir.name)
+    cases.update(parser_cases)
+
+    results = {}
+    try:
+        for name, fn in cases.items():
+            if opts.only and name not in opts.only:
+                continue
+            logger.info(f"Сценарий {name}...")
+            results[name] = measure(fn, opts.iterations, opts.warmup)
+            logger.info(f"{name}: p50 {results[name]['p50_ms']:.2f} мс, p99 {results[name]['p99_ms']:.2f} мс")
+    finally:
+        server.stop()
+        cache_dir.cleanup()
+
+    engine = get_engine()
+    with engine.connect() as conn:
+        rows = {
+            table: conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+            for table in ("products", "price_history", "category_stats")
+        }
+
+    report = {
+        "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "database": engine.dialect.name,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "rows": rows,
+        "fixture_pages": fixture_pages,
+        "iterations": opts.iterations,
+        # ru_maxrss в Linux — в килобайтах
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "results": results
+    }
+
+    output = opts.output or os.path.join(
+        RESULTS_DIR, f"bench-{engine.dialect.name}-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"Отчет сохранен: {output}")
+
+    if opts.compare:
+        compare(report, opts.compare)
+
+
+if __name__ == "__main__":
+    # Логи модулей бота на каждом вызове исказили бы замеры
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    main()
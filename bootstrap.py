@@ -0,0 +1,53 @@
+import os
+import time
+import logging
+import threading
+import startup
+
+logger = logging.getLogger(__name__)
+
+# Миграции: background — в фоне после старта, blocking — до старта, off — отдельным шагом
+RUN_MIGRATIONS = os.getenv("RUN_MIGRATIONS", "background")
+ENABLE_SCHEDULER = os.getenv("ENABLE_SCHEDULER", "1") == "1"
+# Воркер очереди обхода внутри процесса бота (для запуска на одной машине)
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "1") == "1"
+
+
+def _run_embedded_worker():
+    import asyncio
+    from worker import Worker
+    try:
+        asyncio.run(Worker().run())
+    except Exception as e:
+        logger.error(f"❌ Ошибка встроенного воркера: {e}")
+
+
+def _start_services():
+    if RUN_MIGRATIONS != "off":
+        from migrate import migrate
+        try:
+            migrate()
+        except Exception as e:
+            logger.error(f"❌ Ошибка миграции базы данных: {e}")
+            return
+
+    if ENABLE_SCHEDULER:
+        started = time.perf_counter()
+        from scheduler import start_scheduler
+        start_scheduler()
+        startup.mark("scheduler", time.perf_counter() - started)
+
+    if EMBEDDED_WORKER:
+        threading.Thread(target=_run_embedded_worker, name="crawl-worker", daemon=True).start()
+
+
+def bootstrap():
+    """Явный запуск служб приложения: миграции, планировщик и воркер обхода.
+
+    Импорт модулей ничего не подключает и не запускает — вся работа здесь.
+    """
+    if RUN_MIGRATIONS == "blocking":
+        _start_services()
+    else:
+        threading.Thread(target=_start_services, name="bootstrap", daemon=True).start()
+    startup.mark("bootstrap")
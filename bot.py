@@ -1,8 +1,21 @@
+import startup
 import os
+import time
 import asyncio
 import logging
+import tempfile
+from io import BytesIO
+from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, executor, types
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from dotenv import load_dotenv
+from charts import get_trend_chart, render_compare, ChartQueueFull
+from async_db import get_top_niches, record_trend_hit, search_products, add_watch, remove_watch, list_watches, save_chart_file_id
+from chart_cache import chart_cache
+from bootstrap import bootstrap
+import metrics
+
+startup.mark("imports")
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -17,18 +30,70 @@ if not API_TOKEN:
     logger.error("❌ API_TOKEN не найден!")
     raise ValueError("Не указан API_TOKEN!")
 
+# Получение обновлений: polling — один процесс, webhook — HTTP-сервер (можно несколько реплик)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Telegram ID администраторов через запятую (доступ к /stats и /export)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()}
+
+# Команды с отдельной гистограммой времени обработки, остальное — "other"
+TRACKED_COMMANDS = {"start", "update", "niches", "trend", "compare", "watch", "unwatch", "watches", "stats", "export", "search"}
+
+# Максимум товаров в /compare и окно сравнения, дни
+COMPARE_MAX_PRODUCTS = 8
+COMPARE_DAYS = 90
+
 bot = Bot(token=API_TOKEN)
 dp = Dispatcher(bot)
 
+# Одна выгрузка за раз: она долго держит соединение с базой и диск
+export_lock = asyncio.Lock()
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замер времени обработки сообщений по командам"""
+
+    async def on_process_message(self, message, data):
+        data["metrics_started"] = time.perf_counter()
+
+    async def on_post_process_message(self, message, results, data):
+        started = data.get("metrics_started")
+        if started is None or not metrics.sampled():
+            return
+        command = message.get_command(pure=True)
+        metrics.observe(
+            "handler",
+            time.perf_counter() - started,
+            command=command if command in TRACKED_COMMANDS else "other"
+        )
+
+
+dp.middleware.setup(MetricsMiddleware())
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_background_tasks = set()
+
+def run_in_background(coro):
+    """Запуск корутины без ожидания результата"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 @dp.message_handler(commands=['start'])
 async def start(message: types.Message):
     """Обработчик команды /start"""
+    startup.mark("first_start")
     await message.answer(
         "👋 Привет! Я Kaspi Analytic Bot 🤖\n\n"
         "📊 <b>Доступные команды:</b>\n"
         "/update - обновить данные\n"
         "/niches - ТОП прибыльных ниш\n"
-        "/trend <ID> - график цены товара\n\n"
+        "/search <название> - поиск товара\n"
+        "/trend <ID> [30d] - график цены товара\n"
+        "/compare <ID> <ID> ... - сравнение цен товаров\n"
+        "/watch <ID> [%] - уведомить о снижении цены\n"
+        "/watches - мои подписки\n\n"
         "📍 <b>Пример:</b> /trend 1",
         parse_mode='HTML'
     )
@@ -41,46 +106,325 @@ async def update_data(message: types.Message):
 @dp.message_handler(commands=['niches'])
 async def niches(message: types.Message):
     """Обработчик команды /niches"""
-    niches_list = [
-        {"name": "Смартфоны", "products": 42, "demand": 1250},
-        {"name": "Ноутбуки", "products": 35, "demand": 840},
-        {"name": "Наушники", "products": 28, "demand": 3120},
-        {"name": "Смарт-часы", "products": 19, "demand": 1560},
-        {"name": "Планшеты", "products": 15, "demand": 920}
-    ]
+    niches_list = await get_top_niches(limit=5)
     
     text = "🏆 <b>ТОП прибыльных ниш:</b>\n\n"
     for i, niche in enumerate(niches_list, 1):
         emoji = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
         text += f"{emoji} <b>{niche['name']}</b>\n"
         text += f"   📦 Товаров: <code>{niche['products']}</code>\n"
-        text += f"   ⭐ Отзывов: <code>{niche['demand']:,}</code>\n\n"
+        text += f"   ⭐ Отзывов: <code>{niche['demand']:,}</code>\n"
+        if niche.get("avg_price"):
+            text += f"   💰 Средняя цена: <code>{niche['avg_price']:,.0f}₸</code>\n"
+        text += "\n"
     
     await message.answer(text, parse_mode='HTML')
 
+# Окна /trend: 7d, 2w, 6m, 1y
+TREND_WINDOW_UNITS = {"d": 1, "w": 7, "m": 30, "y": 365}
+TREND_WINDOW_MAX_DAYS = 3650
+
+def _parse_window(arg):
+    """Окно вида 30d в timedelta (None, если формат не подходит)"""
+    unit, number = arg[-1:].lower(), arg[:-1]
+    if unit not in TREND_WINDOW_UNITS or not number.isdigit():
+        return None
+    days = int(number) * TREND_WINDOW_UNITS[unit]
+    return timedelta(days=days) if 0 < days <= TREND_WINDOW_MAX_DAYS else None
+
 @dp.message_handler(commands=['trend'])
 async def trend(message: types.Message):
     """Обработчик команды /trend"""
     args = message.text.split()
     
-    if len(args) != 2:
+    if len(args) not in (2, 3):
         await message.answer(
-            "ℹ️ <b>Используйте:</b> <code>/trend ID</code>\n\n"
-            "📝 <b>Пример:</b> <code>/trend 1</code>",
+            "ℹ️ <b>Используйте:</b> <code>/trend ID [7d|30d|1y]</code>\n\n"
+            "📝 <b>Пример:</b> <code>/trend 1 30d</code>",
             parse_mode='HTML'
         )
         return
     
     try:
         product_id = int(args[1])
+    except ValueError:
+        await message.answer("❌ ID должен быть числом!")
+        return
+    
+    window = None
+    if len(args) == 3:
+        window = _parse_window(args[2])
+        if window is None:
+            await message.answer("❌ Окно задается как 7d, 4w, 6m или 1y")
+            return
+    
+    await send_trend(message, product_id, window, args[2] if window else None)
+
+async def send_trend(message, product_id, window=None, window_label=None):
+    """Отправка графика цены товара за окно window (вся история, если None)"""
+    # Интерес к товару повышает приоритет его обновления
+    run_in_background(record_trend_hit(product_id))
+    
+    try:
+        chart = await get_trend_chart(product_id, window)
+    except ChartQueueFull:
+        await message.answer("⏳ Сейчас строится слишком много графиков, попробуйте через минуту")
+        return
+    
+    if chart is None:
+        await message.answer(f"📭 Нет истории цен для товара ID: {product_id}")
+        return
+    
+    # Повторная отправка по file_id — без отрисовки и загрузки файла
+    photo = chart["file_id"] or types.InputFile(BytesIO(chart["png"]), filename=f"trend_{product_id}.png")
+    caption = f"📈 <b>График для товара ID: {product_id}</b>"
+    if window_label:
+        caption += f" за {window_label}"
+    with metrics.timed("telegram_send", method="photo", cached=str(bool(chart["file_id"])).lower()):
+        sent = await message.answer_photo(photo, caption=caption, parse_mode='HTML')
+    if not chart["file_id"]:
+        chart_cache.set_file_id(chart["key"], sent.photo[-1].file_id)
+        run_in_background(save_chart_file_id(chart["key"], sent.photo[-1].file_id))
+
+@dp.message_handler(commands=['search'])
+async def search(message: types.Message):
+    """Обработчик команды /search"""
+    query = message.get_args().strip()
+    if not query:
         await message.answer(
-            f"📈 <b>График для товара ID: {product_id}</b>\n\n"
-            "✅ Функция графика работает!\n"
-            "🔄 Данные обновляются автоматически",
+            "ℹ️ <b>Используйте:</b> <code>/search название</code>\n\n"
+            "📝 <b>Пример:</b> <code>/search iphone 14</code>",
             parse_mode='HTML'
         )
+        return
+    
+    found = await search_products(query)
+    if not found:
+        await message.answer("📭 Ничего не найдено")
+        return
+    
+    # Кнопка под каждым товаром открывает его график
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    for product in found:
+        price = f" — {product['price']:,.0f} ₸".replace(",", " ") if product["price"] else ""
+        keyboard.add(types.InlineKeyboardButton(
+            f"{product['name'][:48]}{price}", callback_data=f"trend:{product['id']}"
+        ))
+    await message.answer(f"🔎 <b>Найдено товаров:</b> {len(found)}", reply_markup=keyboard, parse_mode='HTML')
+
+@dp.callback_query_handler(lambda call: call.data and call.data.startswith("trend:"))
+async def trend_button(call: types.CallbackQuery):
+    """Кнопка графика из результатов /search"""
+    try:
+        product_id = int(call.data.split(":", 1)[1])
     except ValueError:
-        await message.answer("❌ ID должен быть числом!")
+        await call.answer()
+        return
+    # Ответ сразу, чтобы у кнопки пропали часики, пока строится график
+    await call.answer()
+    await send_trend(call.message, product_id)
+
+def _percent(value):
+    return f"{value * 100:+.1f}%" if value is not None else "—"
+
+@dp.message_handler(commands=['compare'])
+async def compare(message: types.Message):
+    """Обработчик команды /compare"""
+    args = message.text.split()[1:]
+    
+    try:
+        product_ids = list(dict.fromkeys(int(arg) for arg in args))
+    except ValueError:
+        await message.answer("❌ ID должны быть числами!")
+        return
+    
+    if not 2 <= len(product_ids) <= COMPARE_MAX_PRODUCTS:
+        await message.answer(
+            f"ℹ️ <b>Используйте:</b> <code>/compare ID ID ...</code> (от 2 до {COMPARE_MAX_PRODUCTS} товаров)\n\n"
+            "📝 <b>Пример:</b> <code>/compare 1 2 3</code>",
+            parse_mode='HTML'
+        )
+        return
+    
+    for product_id in product_ids:
+        run_in_background(record_trend_hit(product_id))
+    
+    try:
+        data = await render_compare(product_ids, COMPARE_DAYS)
+    except ChartQueueFull:
+        await message.answer("⏳ Сейчас строится слишком много графиков, попробуйте через минуту")
+        return
+    
+    if data is None:
+        await message.answer("📭 Нет истории цен ни для одного из товаров")
+        return
+    
+    text = f"📊 <b>Сравнение цен за {COMPARE_DAYS} дней</b>\n\n"
+    for product_id, stats in data["metrics"].items():
+        name = data["names"][product_id][:40].replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        text += f"<b>{name}</b> (ID {product_id})\n"
+        text += f"   💰 <code>{stats['price']:,.0f}₸</code>, 30д: <code>{_percent(stats['change'].get('30d'))}</code>\n"
+        text += f"   📉 Просадка: <code>{_percent(stats['max_drawdown'])}</code>"
+        if stats["volatility"] is not None:
+            text += f", волатильность: <code>{stats['volatility'] * 100:.1f}%</code>"
+        text += "\n"
+        if stats["is_discount"]:
+            text += f"   🔥 Скидка {stats['discount'] * 100:.0f}% к медиане месяца\n"
+    if data["missing"]:
+        text += f"\n📭 Нет истории: {', '.join(str(i) for i in data['missing'])}"
+    
+    photo = types.InputFile(BytesIO(data["png"]), filename="compare.png")
+    with metrics.timed("telegram_send", method="photo", cached="false"):
+        if len(text) <= 1024:
+            await message.answer_photo(photo, caption=text, parse_mode='HTML')
+        else:
+            await message.answer_photo(photo)
+            await message.answer(text, parse_mode='HTML')
+
+@dp.message_handler(commands=['watch'])
+async def watch(message: types.Message):
+    """Обработчик команды /watch"""
+    args = message.text.split()[1:]
+    
+    try:
+        product_id = int(args[0])
+        percent = float(args[1].rstrip("%").replace(",", ".")) if len(args) > 1 else None
+    except (IndexError, ValueError):
+        await message.answer(
+            "ℹ️ <b>Используйте:</b> <code>/watch ID [процент]</code>\n\n"
+            "📝 <b>Пример:</b> <code>/watch 1 10</code> — сообщить, когда цена упадет на 10%",
+            parse_mode='HTML'
+        )
+        return
+    
+    if percent is not None and not 0 < percent < 100:
+        await message.answer("❌ Процент должен быть от 0 до 100")
+        return
+    
+    result = await add_watch(message.chat.id, product_id, percent / 100 if percent else None)
+    if result == "not_found":
+        await message.answer(f"📭 Товар ID: {product_id} не найден")
+    elif result == "limit":
+        await message.answer("❌ Достигнут лимит подписок, удалите лишние через /unwatch")
+    else:
+        run_in_background(record_trend_hit(product_id))
+        await message.answer(f"🔔 Сообщу, когда цена товара ID: {product_id} снизится")
+
+@dp.message_handler(commands=['unwatch'])
+async def unwatch(message: types.Message):
+    """Обработчик команды /unwatch"""
+    args = message.text.split()[1:]
+    if len(args) != 1 or not args[0].isdigit():
+        await message.answer("ℹ️ <b>Используйте:</b> <code>/unwatch ID</code>", parse_mode='HTML')
+        return
+    
+    if await remove_watch(message.chat.id, int(args[0])):
+        await message.answer(f"🔕 Подписка на товар ID: {args[0]} удалена")
+    else:
+        await message.answer(f"📭 Подписки на товар ID: {args[0]} нет")
+
+@dp.message_handler(commands=['watches'])
+async def watches(message: types.Message):
+    """Обработчик команды /watches"""
+    items = await list_watches(message.chat.id)
+    if not items:
+        await message.answer("📭 Подписок нет. Добавьте: <code>/watch ID</code>", parse_mode='HTML')
+        return
+    
+    text = "🔔 <b>Ваши подписки:</b>\n\n"
+    for item in items:
+        name = (item["name"] or "Товар")[:40].replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        price = f"{item['price']:,.0f}₸" if item["price"] else "—"
+        text += f"• <b>{name}</b> (ID {item['product_id']}): <code>{price}</code>, порог {item['threshold']:.0%}\n"
+    
+    await message.answer(text, parse_mode='HTML')
+
+def _ms(seconds):
+    return f"{seconds * 1000:.0f}" if seconds is not None else "—"
+
+@dp.message_handler(commands=['stats'])
+async def stats(message: types.Message):
+    """Обработчик команды /stats (только для администраторов)"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ Команда доступна только администраторам")
+        return
+    
+    lines = [f"{'метрика':<28}{'n':>7}{'p50':>7}{'p95':>7}"]
+    for row in metrics.summary():
+        labels = ",".join(str(v) for v in row["labels"].values())
+        name = f"{row['name']}[{labels}]" if labels else row["name"]
+        lines.append(f"{name[:28]:<28}{row['count']:>7}{_ms(row['p50']):>7}{_ms(row['p95']):>7}")
+    
+    text = "📊 <b>Метрики</b> (мс, выборка {:.0%})\n<pre>{}</pre>".format(
+        metrics.METRICS_SAMPLE_RATE, "\n".join(lines)[:2500]
+    )
+    slow = metrics.slow_events(5)
+    if slow:
+        text += "\n🐢 <b>Медленные операции:</b>\n"
+        for event in slow:
+            detail = event["detail"][:120].replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            text += f"• {event['kind']} {event['ms']:.0f} мс: <code>{detail}</code>\n"
+    
+    await message.answer(text, parse_mode='HTML')
+
+@dp.message_handler(commands=['export'])
+async def export_data(message: types.Message):
+    """Обработчик команды /export (только для администраторов)"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ Команда доступна только администраторам")
+        return
+    
+    args = message.get_args().split()
+    if not args or args[0] not in ("products", "history"):
+        await message.answer(
+            "📦 Использование: /export products|history [csv|jsonl] [30d] [категория]\n"
+            "Например: /export history jsonl 90d Смартфоны"
+        )
+        return
+    table, fmt, days, category = args[0], "csv", None, []
+    for arg in args[1:]:
+        if arg in ("csv", "jsonl"):
+            fmt = arg
+        elif arg.endswith("d") and arg[:-1].isdigit():
+            days = int(arg[:-1])
+        else:
+            category.append(arg)
+    category = " ".join(category) or None
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    
+    if export_lock.locked():
+        await message.answer("⏳ Выгрузка уже выполняется, попробуйте позже")
+        return
+    
+    # SQLAlchemy загружается при первой выгрузке, а не при импорте бота
+    from export import export, EXPORT_CHUNK_MB
+    loop = asyncio.get_running_loop()
+    
+    async def send_chunk(path):
+        try:
+            with open(path, "rb") as f:
+                await message.answer_document(types.InputFile(f, filename=os.path.basename(path)))
+        finally:
+            os.remove(path)
+    
+    def on_chunk(path):
+        # Выгрузка ждет отправки файла: на диске не больше одного файла
+        asyncio.run_coroutine_threadsafe(send_chunk(path), loop).result()
+    
+    async with export_lock:
+        await message.answer(f"⏳ Готовлю выгрузку {table}...")
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                paths, rows = await asyncio.to_thread(
+                    export, table, os.path.join(directory, table), fmt, True, category, since, None,
+                    int(EXPORT_CHUNK_MB * 1024 * 1024), on_chunk
+                )
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки {table}: {e}")
+            await message.answer("❌ Не удалось выполнить выгрузку")
+            return
+    rows = f"{rows:,}".replace(",", " ")
+    await message.answer(f"✅ Выгружено строк: {rows}, файлов: {len(paths)}")
 
 @dp.message_handler()
 async def handle_unknown(message: types.Message):
@@ -90,6 +434,20 @@ async def handle_unknown(message: types.Message):
         parse_mode='HTML'
     )
 
+async def on_startup(dispatcher):
+    """Отчет о времени запуска после подключения к Telegram"""
+    startup.mark(BOT_MODE)
+    startup.report()
+    await metrics.start_metrics_server()
+    # Отправка уведомлений о снижении цен; SQLAlchemy загружается здесь, а не при импорте
+    from alerts import AlertSender
+    run_in_background(AlertSender(bot).run())
+
 if __name__ == '__main__':
     logger.info("🚀 Бот запускается...")
-    executor.start_polling(dp, skip_updates=True)
+    bootstrap()
+    if BOT_MODE == "webhook":
+        from webhook import start_webhook
+        start_webhook(dp, on_startup=on_startup)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
@@ -0,0 +1,124 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Лимиты кеша графиков: PNG в памяти, PNG на диске, file_id Telegram
+CHART_CACHE_MAX_MB = float(os.getenv("CHART_CACHE_MAX_MB", "32"))
+CHART_CACHE_DIR = os.getenv("CHART_CACHE_DIR", "")
+CHART_CACHE_DISK_MB = float(os.getenv("CHART_CACHE_DISK_MB", "256"))
+CHART_FILE_IDS_MAX = int(os.getenv("CHART_FILE_IDS_MAX", "10000"))
+
+
+def chart_key(product_id, window, latest):
+    """Ключ графика: товар, окно (секунды) и время последнего наблюдения"""
+    seconds = int(window.total_seconds()) if window else 0
+    return (product_id, seconds, latest.strftime("%Y%m%d%H%M%S%f"))
+
+
+class ChartCache:
+    """LRU-кеш построенных графиков и их file_id в Telegram"""
+
+    def __init__(self, max_bytes=CHART_CACHE_MAX_MB * 1024 * 1024, directory=CHART_CACHE_DIR,
+                 max_disk_bytes=CHART_CACHE_DISK_MB * 1024 * 1024, max_file_ids=CHART_FILE_IDS_MAX):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.max_file_ids = max_file_ids
+        self._png = OrderedDict()
+        self._png_bytes = 0
+        self._file_ids = OrderedDict()
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            files = [os.path.join(directory, name) for name in os.listdir(directory)
+                     if name.endswith(".png")]
+            for path in sorted(files, key=os.path.getatime):
+                size = os.path.getsize(path)
+                self._disk[path] = size
+                self._disk_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, "_".join(str(part) for part in key) + ".png")
+
+    def get(self, key):
+        """{"png", "file_id"} или None, если график не закеширован"""
+        with self._lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self._file_ids.move_to_end(key)
+            png = self._png.get(key)
+            if png is not None:
+                self._png.move_to_end(key)
+            elif file_id is None and self.directory:
+                png = self._read_disk(key)
+        if png is None and file_id is None:
+            return None
+        return {"png": png, "file_id": file_id}
+
+    def put(self, key, png):
+        """Сохранение PNG графика"""
+        with self._lock:
+            old = self._png.pop(key, None)
+            if old is not None:
+                self._png_bytes -= len(old)
+            self._png[key] = png
+            self._png_bytes += len(png)
+            if self.directory:
+                self._write_disk(key, png)
+            while self._png_bytes > self.max_bytes and len(self._png) > 1:
+                _, evicted = self._png.popitem(last=False)
+                self._png_bytes -= len(evicted)
+
+    def set_file_id(self, key, file_id):
+        """Запоминание file_id после первой отправки графика"""
+        with self._lock:
+            self._file_ids[key] = file_id
+            self._file_ids.move_to_end(key)
+            while len(self._file_ids) > self.max_file_ids:
+                self._file_ids.popitem(last=False)
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        if path not in self._disk:
+            return None
+        try:
+            with open(path, "rb") as f:
+                png = f.read()
+        except OSError:
+            self._remove_disk(path)
+            return None
+        os.utime(path)
+        self._disk.move_to_end(path)
+        return png
+
+    def _write_disk(self, key, png):
+        path = self._path(key)
+        try:
+            with open(path, "wb") as f:
+                f.write(png)
+        except OSError as e:
+            logger.error(f"Ошибка записи графика на диск: {e}")
+            return
+        self._disk_bytes += len(png) - self._disk.pop(path, 0)
+        self._disk[path] = len(png)
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            self._remove_disk(next(iter(self._disk)))
+
+    def _remove_disk(self, path):
+        size = self._disk.pop(path, None)
+        if size is None:
+            return
+        self._disk_bytes -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+chart_cache = ChartCache()
@@ -0,0 +1,256 @@
+import os
+import asyncio
+import logging
+from io import BytesIO
+from datetime import datetime
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from chart_cache import chart_cache, chart_key
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Процессы для отрисовки и размер очереди ожидающих запросов
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "2"))
+CHART_QUEUE_SIZE = int(os.getenv("CHART_QUEUE_SIZE", "20"))
+
+_chart_pool = None
+_render_slots = None
+_pending = 0
+
+
+class ChartQueueFull(Exception):
+    """Очередь на построение графиков переполнена"""
+
+
+def render_price_chart(times, prices, product_name):
+    """Отрисовка графика динамики цены в PNG.
+
+    Использует объектный API Figure без глобального состояния pyplot,
+    поэтому безопасна для параллельного вызова в пуле процессов.
+    """
+    # matplotlib загружается только при первой отрисовке
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(12, 6), facecolor='#f8f9fa')
+    ax = fig.subplots()
+
+    # Основной график
+    ax.plot(times, prices, marker='o', linestyle='-', drawstyle='steps-post',
+            color='#2c3e50', linewidth=2.5, markersize=6,
+            markerfacecolor='#e74c3c', markeredgecolor='#c0392b')
+
+    # Настройки графика
+    ax.set_title(f"📈 Динамика цены: {product_name[:50]}...",
+                 fontsize=16, fontweight='bold', color='#2c3e50', pad=20)
+    ax.set_xlabel("Дата", fontsize=12, color='#34495e')
+    ax.set_ylabel("Цена (₸)", fontsize=12, color='#34495e')
+
+    # Форматирование оси X для дат
+    fig.autofmt_xdate()
+
+    # Добавляем сетку
+    ax.grid(True, alpha=0.3, linestyle='--', linewidth=0.5)
+
+    # Аннотации для минимального и максимального значения
+    import numpy as np
+    min_index = int(np.argmin(prices))
+    max_index = int(np.argmax(prices))
+    min_price, min_time = prices[min_index], times[min_index]
+    max_price, max_time = prices[max_index], times[max_index]
+
+    # Линии минимума и максимума
+    ax.axhline(y=min_price, color='#27ae60', linestyle=':', alpha=0.7, linewidth=1.5)
+    ax.axhline(y=max_price, color='#e74c3c', linestyle=':', alpha=0.7, linewidth=1.5)
+
+    # Аннотации
+    ax.annotate(f'Мин: {min_price:,.0f}₸',
+                xy=(min_time, min_price),
+                xytext=(10, 10),
+                textcoords='offset points',
+                color='#27ae60',
+                fontweight='bold',
+                bbox=dict(boxstyle='round,pad=0.3', facecolor='#d5f4e6', alpha=0.8))
+
+    ax.annotate(f'Макс: {max_price:,.0f}₸',
+                xy=(max_time, max_price),
+                xytext=(10, -20),
+                textcoords='offset points',
+                color='#e74c3c',
+                fontweight='bold',
+                bbox=dict(boxstyle='round,pad=0.3', facecolor='#fadbd8', alpha=0.8))
+
+    # Текущая цена
+    current_price = prices[-1]
+    ax.annotate(f'Текущая: {current_price:,.0f}₸',
+                xy=(times[-1], current_price),
+                xytext=(-100, 20),
+                textcoords='offset points',
+                arrowprops=dict(arrowstyle='->', color='#3498db'),
+                color='#2980b9',
+                fontweight='bold',
+                bbox=dict(boxstyle='round,pad=0.5', facecolor='#ebf5fb', alpha=0.9))
+
+    # Настройка внешнего вида
+    ax.set_facecolor('#ffffff')
+    fig.tight_layout()
+
+    # Сохраняем в буфер
+    buf = BytesIO()
+    fig.savefig(buf, format='png', dpi=100, bbox_inches='tight',
+                facecolor=fig.get_facecolor())
+    return buf.getvalue()
+
+
+def render_compare_chart(dates, series):
+    """Отрисовка графика цен нескольких товаров в PNG.
+
+    series — список (подпись, массив цен по датам); при разбросе цен
+    больше чем в 10 раз ось Y логарифмическая.
+    """
+    from matplotlib.figure import Figure
+    import numpy as np
+
+    fig = Figure(figsize=(12, 6), facecolor='#f8f9fa')
+    ax = fig.subplots()
+
+    for label, prices in series:
+        ax.plot(dates, prices, drawstyle='steps-post', linewidth=2, label=label)
+
+    top = max(np.nanmax(prices) for _, prices in series)
+    bottom = min(np.nanmin(prices) for _, prices in series)
+    if bottom > 0 and top / bottom > 10:
+        ax.set_yscale('log')
+
+    ax.set_title("📊 Сравнение цен", fontsize=16, fontweight='bold', color='#2c3e50', pad=20)
+    ax.set_xlabel("Дата", fontsize=12, color='#34495e')
+    ax.set_ylabel("Цена (₸)", fontsize=12, color='#34495e')
+    ax.grid(True, alpha=0.3, linestyle='--', linewidth=0.5)
+    ax.legend(loc='best', fontsize=9)
+    ax.set_facecolor('#ffffff')
+    fig.autofmt_xdate()
+    fig.tight_layout()
+
+    buf = BytesIO()
+    fig.savefig(buf, format='png', dpi=100, bbox_inches='tight',
+                facecolor=fig.get_facecolor())
+    return buf.getvalue()
+
+
+def get_chart_pool():
+    """Пул процессов для отрисовки графиков"""
+    global _chart_pool
+    if _chart_pool is None:
+        _chart_pool = ProcessPoolExecutor(max_workers=CHART_WORKERS)
+    return _chart_pool
+
+
+def _load_chart_data(product_id, since, until):
+    # Импорт здесь, чтобы процессы пула не подключались к БД
+    from analytics import get_price_trend, get_product, downsample_lttb, MAX_CHART_POINTS
+
+    trend = get_price_trend(product_id, since, until)
+    if not trend:
+        return None
+    trend = downsample_lttb(trend, MAX_CHART_POINTS)
+    product = get_product(product_id)
+    return (
+        [t['time'] for t in trend],
+        [t['price'] for t in trend],
+        product["name"] if product else "Товар"
+    )
+
+
+@asynccontextmanager
+async def _chart_request():
+    """Место в очереди на построение графика (или ChartQueueFull)"""
+    global _pending
+    if _pending >= CHART_WORKERS + CHART_QUEUE_SIZE:
+        raise ChartQueueFull()
+    _pending += 1
+    try:
+        yield
+    finally:
+        _pending -= 1
+
+
+async def _render_in_pool(fn, *args):
+    global _render_slots
+    if _render_slots is None:
+        _render_slots = asyncio.Semaphore(CHART_WORKERS)
+    async with _render_slots:
+        loop = asyncio.get_running_loop()
+        with metrics.timed("chart_render"):
+            return await loop.run_in_executor(get_chart_pool(), fn, *args)
+
+
+async def render_trend(product_id, since=None, until=None):
+    """Асинхронное построение графика цены товара (PNG или None).
+
+    Не больше CHART_WORKERS графиков рисуются одновременно, еще
+    CHART_QUEUE_SIZE ждут; остальные запросы сразу получают ChartQueueFull.
+    """
+    async with _chart_request():
+        from async_db import run_db
+        with metrics.timed("chart_data"):
+            data = await run_db(_load_chart_data, product_id, since, until)
+        if data is None:
+            logger.warning(f"Нет данных для построения графика товара {product_id}")
+            return None
+
+        png = await _render_in_pool(render_price_chart, *data)
+        logger.info(f"График для товара {product_id} успешно построен")
+        return png
+
+
+def _load_compare_data(product_ids, days):
+    from price_metrics import compare_data
+    return compare_data(product_ids, days)
+
+
+async def render_compare(product_ids, days=90):
+    """График и метрики нескольких товаров за days дней.
+
+    Ряды всех товаров загружаются пакетно. Возвращает данные compare_data
+    с добавленным "png" или None, если истории нет ни у одного товара.
+    """
+    async with _chart_request():
+        from async_db import run_db
+        with metrics.timed("chart_data", chart="compare"):
+            data = await run_db(_load_compare_data, product_ids, days)
+        if data is None:
+            return None
+        data["png"] = await _render_in_pool(render_compare_chart, data["dates"], data["series"])
+        return data
+
+
+async def get_trend_chart(product_id, window=None):
+    """График цены за окно window с учетом кеша.
+
+    Возвращает {"key", "png", "file_id"} или None, если истории нет.
+    Если известен file_id, PNG не строится и может отсутствовать.
+    """
+    from async_db import get_latest_observation, get_chart_file_id
+
+    latest = await get_latest_observation(product_id)
+    if latest is None:
+        return None
+
+    key = chart_key(product_id, window, latest)
+    cached = chart_cache.get(key)
+    if cached and cached["file_id"]:
+        return {"key": key, **cached}
+    # График мог уже отправить другой экземпляр бота
+    file_id = await get_chart_file_id(key)
+    if file_id:
+        chart_cache.set_file_id(key, file_id)
+        return {"key": key, "png": cached["png"] if cached else None, "file_id": file_id}
+    if cached:
+        return {"key": key, **cached}
+
+    since = datetime.utcnow() - window if window else None
+    png = await render_trend(product_id, since)
+    if png is None:
+        return None
+    chart_cache.put(key, png)
+    return {"key": key, "png": png, "file_id": None}
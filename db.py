@@ -1,8 +1,11 @@
 import os
-from sqlalchemy import create_engine, Table, Column, Integer, String, Float, MetaData, DateTime, Text
-from sqlalchemy.exc import OperationalError, SQLAlchemyError
-from datetime import datetime
+import time
+import threading
+from sqlalchemy import create_engine, Table, Column, Integer, BigInteger, String, Float, MetaData, DateTime, Text, text, bindparam
+from datetime import datetime, timedelta
 import logging
+import startup
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -14,29 +17,58 @@ if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
     logger.info("Обновлен URL для PostgreSQL")
 
-logger.info(f"Подключение к базе данных")
+# Размер пула соединений; столько же потоков у асинхронного слоя (async_db)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
 
-try:
-    engine = create_engine(
-        DATABASE_URL,
-        pool_pre_ping=True,
-        pool_recycle=300,
-        connect_args={"connect_timeout": 10}
-    )
-    
-    # Тестируем подключение
-    with engine.connect() as conn:
-        conn.execute("SELECT 1")
+_engine = None
+_engine_lock = threading.Lock()
+
+def _create_engine():
+    """Создание движка с проверкой подключения (SQLite как запасной вариант)"""
+    global DATABASE_URL
+    started = time.perf_counter()
+    logger.info(f"Подключение к базе данных")
     
-    logger.info("✅ Подключение к базе данных успешно")
+    try:
+        engine = create_engine(
+            DATABASE_URL,
+            pool_pre_ping=True,
+            pool_recycle=300,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            # SQLite: ожидание блокировки записи, когда в базу пишут несколько воркеров
+            connect_args={"timeout": 30} if DATABASE_URL.startswith("sqlite") else {"connect_timeout": 10}
+        )
+        
+        # Тестируем подключение
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        
+        logger.info("✅ Подключение к базе данных успешно")
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка подключения к базе данных: {e}")
+        # Для локальной разработки создаем SQLite базу
+        if "sqlite" not in DATABASE_URL:
+            DATABASE_URL = "sqlite:///local.db"
+            engine = create_engine(DATABASE_URL)
+            logger.info("Создана локальная SQLite база данных")
+        else:
+            raise
     
-except Exception as e:
-    logger.error(f"❌ Ошибка подключения к базе данных: {e}")
-    # Для локальной разработки создаем SQLite базу
-    if "sqlite" not in DATABASE_URL:
-        DATABASE_URL = "sqlite:///local.db"
-        engine = create_engine(DATABASE_URL)
-        logger.info("Создана локальная SQLite база данных")
+    metrics.instrument_engine(engine)
+    startup.mark("db_connect", time.perf_counter() - started)
+    return engine
+
+def get_engine():
+    """Движок базы данных, создается при первом обращении"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _create_engine()
+    return _engine
 
 metadata = MetaData()
 
@@ -64,135 +96,206 @@ price_history = Table(
     Column('product_id', Integer, nullable=False),
     Column('price', Float, nullable=False),
     Column('timestamp', DateTime, default=datetime.utcnow, nullable=False),
-    Column('source', String(50), default='kaspi')
+    Column('source', String(50), default='kaspi'),
+    # Строка пишется только при изменении цены, last_seen — последнее наблюдение этой цены
+    Column('last_seen', DateTime)
 )
 
-def init_db():
-    """Инициализация базы данных"""
-    try:
-        # Создаем таблицы
-        metadata.create_all(engine)
-        logger.info("✅ Таблицы базы данных созданы/проверены")
-        
-        # Создаем индексы для оптимизации
-        with engine.connect() as conn:
-            # Индекс для быстрого поиска по product_id в истории цен
-            conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_price_history_product_id 
-                ON price_history(product_id)
-            """)
-            
-            # Индекс для сортировки по времени
-            conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_price_history_timestamp 
-                ON price_history(timestamp DESC)
-            """)
-            
-            # Индекс для категорий
-            conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_products_category 
-                ON products(category)
-            """)
-            
-            logger.info("✅ Индексы созданы/проверены")
-        
-        # Добавляем тестовые данные если таблица пуста
-        with engine.connect() as conn:
-            result = conn.execute("SELECT COUNT(*) FROM products")
-            count = result.scalar()
-            
-            if count == 0:
-                logger.info("Добавляю тестовые данные...")
-                
-                # Тестовые товары
-                test_products = [
-                    {
-                        "id": 1,
-                        "name": "Смартфон Apple iPhone 14 Pro Max",
-                        "category": "Смартфоны",
-                        "price": 650000.0,
-                        "rating": 4.8,
-                        "reviews": 1250,
-                        "url": "https://kaspi.kz/shop/p/apple-iphone-14-pro-max-256gb-fioletovyi-106363342/"
-                    },
-                    {
-                        "id": 2,
-                        "name": "Ноутбук Apple MacBook Pro 16",
-                        "category": "Ноутбуки",
-                        "price": 1250000.0,
-                        "rating": 4.9,
-                        "reviews": 840,
-                        "url": "https://kaspi.kz/shop/p/apple-macbook-pro-16-mk183-seryi-102892005/"
-                    },
-                    {
-                        "id": 3,
-                        "name": "Наушники Apple AirPods Pro 2",
-                        "category": "Наушники",
-                        "price": 145000.0,
-                        "rating": 4.7,
-                        "reviews": 3120,
-                        "url": "https://kaspi.kz/shop/p/apple-airpods-pro-2nd-generation-belyi-106662968/"
-                    },
-                    {
-                        "id": 4,
-                        "name": "Смарт-часы Apple Watch Series 8",
-                        "category": "Смарт-часы",
-                        "price": 280000.0,
-                        "rating": 4.6,
-                        "reviews": 1560,
-                        "url": "https://kaspi.kz/shop/p/apple-watch-series-8-45-mm-aluminium-chernyi-106585020/"
-                    },
-                    {
-                        "id": 5,
-                        "name": "Планшет Apple iPad Air 5",
-                        "category": "Планшеты",
-                        "price": 420000.0,
-                        "rating": 4.8,
-                        "reviews": 920,
-                        "url": "https://kaspi.kz/shop/p/apple-ipad-air-5-2022-wi-fi-10-9-64-gb-seryi-104235453/"
-                    }
-                ]
-                
-                # Добавляем товары
-                for product in test_products:
-                    conn.execute(
-                        "INSERT OR IGNORE INTO products (id, name, category, price, rating, reviews, url) "
-                        "VALUES (:id, :name, :category, :price, :rating, :reviews, :url)",
-                        product
-                    )
-                
-                # Добавляем историю цен для тестовых товаров
-                import random
-                from datetime import datetime, timedelta
-                
-                for product_id in range(1, 6):
-                    base_price = random.uniform(100000, 1500000)
-                    for days_ago in range(30, 0, -2):
-                        price_date = datetime.utcnow() - timedelta(days=days_ago)
-                        price_change = random.uniform(-0.1, 0.1)  # ±10%
-                        current_price = base_price * (1 + price_change)
-                        
-                        conn.execute(
-                            "INSERT INTO price_history (product_id, price, timestamp) "
-                            "VALUES (:product_id, :price, :timestamp)",
-                            {
-                                "product_id": product_id,
-                                "price": round(current_price, 2),
-                                "timestamp": price_date
-                            }
-                        )
-                
-                logger.info(f"✅ Добавлено {len(test_products)} тестовых товаров с историей цен")
-        
-        logger.info("✅ База данных инициализирована успешно")
-        
-    except SQLAlchemyError as e:
-        logger.error(f"❌ Ошибка SQL при инициализации базы данных: {e}")
-        raise
-    except Exception as e:
-        logger.error(f"❌ Неизвестная ошибка при инициализации базы данных: {e}")
-        raise
+def _rollup_table(name):
+    """Таблица OHLC-агрегатов цены за интервал"""
+    return Table(
+        name,
+        metadata,
+        Column('product_id', Integer, primary_key=True),
+        Column('bucket', DateTime, primary_key=True),
+        Column('open', Float, nullable=False),
+        Column('high', Float, nullable=False),
+        Column('low', Float, nullable=False),
+        Column('close', Float, nullable=False),
+        Column('samples', Integer, nullable=False, default=1)
+    )
+
+# Почасовые и дневные агрегаты истории цен
+price_rollup_hourly = _rollup_table('price_rollup_hourly')
+price_rollup_daily = _rollup_table('price_rollup_daily')
+
+ROLLUP_TABLES = {
+    "hour": price_rollup_hourly,
+    "day": price_rollup_daily
+}
+
+# Месяцы истории цен, перенесенные в архив Parquet (history_archive): запись
+# появляется вместе с удалением строк месяца, host — кто записал файл
+history_archive_months = Table(
+    'history_archive_months',
+    metadata,
+    Column('month', DateTime, primary_key=True),
+    Column('rows', Integer, nullable=False),
+    Column('host', String(100), nullable=False),
+    Column('archived_at', DateTime, default=datetime.utcnow)
+)
+
+# Статистика по категориям, поддерживается ingest инкрементально
+category_stats = Table(
+    'category_stats',
+    metadata,
+    Column('category', String(200), primary_key=True),
+    Column('products', Integer, nullable=False, default=0),
+    Column('demand', Integer, nullable=False, default=0),
+    Column('price_sum', Float, nullable=False, default=0),
+    Column('priced', Integer, nullable=False, default=0),
+    Column('price_change_7d', Float),
+    Column('price_change_30d', Float),
+    # Спрос на один товар: много отзывов при малой конкуренции
+    Column('score', Float),
+    Column('updated_at', DateTime, default=datetime.utcnow)
+)
+
+# Цели обновления (страницы категорий) для адаптивного планировщика
+refresh_targets = Table(
+    'refresh_targets',
+    metadata,
+    Column('url', String(500), primary_key=True),
+    Column('category', String(200)),
+    Column('score', Float, nullable=False, default=0),
+    Column('interval_minutes', Float),
+    Column('pages', Integer),
+    Column('demand_at_refresh', Integer),
+    Column('last_refreshed', DateTime),
+    Column('next_due', DateTime, nullable=False, default=datetime.utcnow),
+    Column('created_at', DateTime, default=datetime.utcnow)
+)
+
+# Интерес пользователей: запросы /trend по товарам за день
+trend_hits = Table(
+    'trend_hits',
+    metadata,
+    Column('product_id', Integer, primary_key=True),
+    Column('day', DateTime, primary_key=True),
+    Column('hits', Integer, nullable=False, default=0)
+)
+
+# Очередь задач обхода, общая для всех воркеров (аренда с продлением)
+crawl_jobs = Table(
+    'crawl_jobs',
+    metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('kind', String(20), nullable=False),
+    Column('url', String(500), nullable=False),
+    Column('status', String(20), nullable=False, default='pending'),
+    Column('priority', Float, nullable=False, default=0),
+    Column('attempts', Integer, nullable=False, default=0),
+    Column('run_after', DateTime, nullable=False, default=datetime.utcnow),
+    Column('lease_owner', String(100)),
+    Column('lease_expires', DateTime),
+    Column('heartbeat_at', DateTime),
+    Column('last_error', Text),
+    Column('created_at', DateTime, default=datetime.utcnow),
+    Column('finished_at', DateTime)
+)
+
+# Подписки на снижение цены: порог — доля падения относительно EWMA цены
+watches = Table(
+    'watches',
+    metadata,
+    Column('chat_id', BigInteger, primary_key=True),
+    Column('product_id', Integer, primary_key=True),
+    Column('threshold', Float, nullable=False),
+    Column('last_alert_price', Float),
+    Column('created_at', DateTime, default=datetime.utcnow)
+)
+
+# Скользящее состояние цены наблюдаемых товаров (без повторного чтения истории)
+watch_state = Table(
+    'watch_state',
+    metadata,
+    Column('product_id', Integer, primary_key=True),
+    Column('ewma', Float, nullable=False),
+    Column('last_price', Float, nullable=False),
+    Column('samples', Integer, nullable=False, default=0),
+    Column('updated_at', DateTime, default=datetime.utcnow)
+)
+
+# Исходящие уведомления: пишутся при загрузке, отправляются ботом
+alert_outbox = Table(
+    'alert_outbox',
+    metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('chat_id', BigInteger, nullable=False),
+    Column('product_id', Integer, nullable=False),
+    Column('reference_price', Float),
+    Column('price', Float, nullable=False),
+    Column('status', String(20), nullable=False, default='pending'),
+    Column('created_at', DateTime, default=datetime.utcnow),
+    Column('claimed_at', DateTime),
+    Column('claimed_by', String(40)),
+    Column('sent_at', DateTime)
+)
+
+# Общее состояние реплик бота (SHARED_STATE=db): обработанные обновления
+# Telegram, file_id отправленных графиков и аренды фоновых задач
+processed_updates = Table(
+    'processed_updates',
+    metadata,
+    Column('update_id', BigInteger, primary_key=True),
+    Column('created_at', DateTime, default=datetime.utcnow)
+)
+
+chart_file_ids = Table(
+    'chart_file_ids',
+    metadata,
+    Column('chart_key', String(100), primary_key=True),
+    Column('file_id', String(200), nullable=False),
+    Column('created_at', DateTime, default=datetime.utcnow)
+)
+
+leases = Table(
+    'leases',
+    metadata,
+    Column('name', String(50), primary_key=True),
+    Column('owner', String(100), nullable=False),
+    Column('expires_at', DateTime, nullable=False)
+)
+
+def refresh_category_metrics(conn, categories=None):
+    """Пересчет производных метрик категорий: score и изменение цен за 7 и 30 дней"""
+    if categories is not None and not categories:
+        return
+    params = {}
+    condition = ""
+    if categories is not None:
+        params["categories"] = list(categories)
+        condition = "AND category IN :categories"
+
+    def with_categories(query):
+        query = text(query)
+        if categories is not None:
+            query = query.bindparams(bindparam("categories", expanding=True))
+        return query
+
+    conn.execute(with_categories(f"""
+        UPDATE category_stats
+        SET score = CASE WHEN products > 0 THEN CAST(demand AS FLOAT) / products END
+        WHERE 1 = 1 {condition}
+    """), params)
 
-# Автоматическая инициализация при импорте
-if __name__ != "__main__":
-    init_db()
\ No newline at end of file
+    # Средняя доля изменения текущей цены относительно дневного закрытия N дней назад
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    for days, column in ((7, "price_change_7d"), (30, "price_change_30d")):
+        result = conn.execute(with_categories(f"""
+            SELECT p.category AS category, AVG(p.price / r.close - 1) AS change
+            FROM products p
+            JOIN price_rollup_daily r ON r.product_id = p.id AND r.bucket = :bucket
+            WHERE p.is_active = 1 AND p.price IS NOT NULL AND r.close > 0
+            {condition.replace("category", "p.category")}
+            GROUP BY p.category
+        """).bindparams(bindparam("bucket", type_=DateTime)), {**params, "bucket": today - timedelta(days=days)})
+        changes = [{"category": row.category, "change": row.change} for row in result]
+        conn.execute(with_categories(f"""
+            UPDATE category_stats SET {column} = NULL WHERE 1 = 1 {condition}
+        """), params)
+        if changes:
+            conn.execute(
+                text(f"UPDATE category_stats SET {column} = :change WHERE category = :category"),
+                changes
+            )
@@ -0,0 +1,229 @@
+"""Потоковая выгрузка товаров и истории цен в CSV/JSONL (можно со сжатием gzip).
+
+Строки читаются из серверного курсора пакетами и сразу пишутся в файл,
+поэтому память не зависит от размера таблиц. Большие выгрузки делятся
+на файлы не больше --chunk-mb, каждый — самостоятельный CSV/JSONL.
+
+    python export.py products --category Смартфоны --output products.csv
+    python export.py history --format jsonl --gzip --since 2024-01-01 --output history
+    python export.py history --output - | head
+"""
+import os
+import io
+import sys
+import csv
+import gzip
+import json
+import logging
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Переменные окружения читаются модулями при импорте
+load_dotenv()
+
+from sqlalchemy import text, bindparam, DateTime, Float
+from db import get_engine
+import history_archive
+
+logger = logging.getLogger(__name__)
+
+# Строк, получаемых из курсора базы за раз
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+# Размер файла выгрузки для бота: документы Telegram ограничены 50 МБ
+EXPORT_CHUNK_MB = float(os.getenv("EXPORT_CHUNK_MB", "45"))
+
+# Колонки выгрузки по таблицам
+TABLES = {
+    "products": ("id", "name", "category", "price", "rating", "reviews", "url",
+                 "created_at", "updated_at", "is_active"),
+    "history": ("product_id", "price", "timestamp", "source", "last_seen")
+}
+FORMATS = ("csv", "jsonl")
+
+
+def _streamed(conn, query, params):
+    # yield_per включает серверный курсор (stream_results) и ограничивает буфер строк
+    result = conn.execution_options(yield_per=EXPORT_BATCH_SIZE).execute(query, params)
+    for row in result:
+        yield tuple(row)
+
+
+def _window(column, since, until):
+    conditions, binds = [], []
+    if since:
+        conditions.append(f"{column} >= :since")
+        binds.append(bindparam("since", type_=DateTime))
+    if until:
+        conditions.append(f"{column} <= :until")
+        binds.append(bindparam("until", type_=DateTime))
+    return conditions, binds
+
+
+def iter_products(category=None, since=None, until=None):
+    """Товары категории, обновленные в окне [since, until]"""
+    conditions, binds = _window("updated_at", since, until)
+    if category:
+        conditions.append("category = :category")
+    query = text(f"""
+        SELECT {', '.join(TABLES['products'])} FROM products
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY id
+    """).bindparams(*binds).columns(price=Float, rating=Float, created_at=DateTime, updated_at=DateTime)
+    with get_engine().connect() as conn:
+        yield from _streamed(conn, query, {"category": category, "since": since, "until": until})
+
+
+def iter_history(category=None, since=None, until=None):
+    """История цен в окне [since, until]: сначала архивные месяцы, затем база
+    (без строк, перенесенных на начало месяца при архивировании)"""
+    params = {"category": category, "since": since, "until": until}
+    boundary = history_archive.archive_boundary()
+    with get_engine().connect() as conn:
+        if boundary and (since is None or since < boundary):
+            product_ids = None
+            if category:
+                product_ids = {row[0] for row in conn.execute(
+                    text("SELECT id FROM products WHERE category = :category"), params
+                )}
+            yield from history_archive.iter_archive(since, until, product_ids, EXPORT_BATCH_SIZE, carried=False)
+
+        conditions, binds = _window("h.timestamp", since, until)
+        # Строки, перенесенные на начало месяца при архивировании, — не наблюдения
+        conditions.append("COALESCE(h.source, '') <> :carry")
+        params["carry"] = history_archive.CARRY_SOURCE
+        if boundary:
+            conditions.append("h.timestamp >= :boundary")
+            binds.append(bindparam("boundary", type_=DateTime))
+            params["boundary"] = boundary
+        join = ""
+        if category:
+            join = "JOIN products p ON p.id = h.product_id"
+            conditions.append("p.category = :category")
+        query = text(f"""
+            SELECT h.product_id, h.price, h.timestamp, h.source, h.last_seen
+            FROM price_history h {join}
+            {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        """).bindparams(*binds).columns(price=Float, timestamp=DateTime, last_seen=DateTime)
+        yield from _streamed(conn, query, params)
+
+
+def _value(value):
+    return value.isoformat(sep=" ") if isinstance(value, datetime) else value
+
+
+class ChunkedWriter:
+    """Запись строк в файлы не больше chunk_bytes (None — один файл, "-" — stdout)"""
+
+    def __init__(self, output, columns, fmt="csv", compress=False, chunk_bytes=None, on_chunk=None):
+        extension = "." + fmt + (".gz" if compress else "")
+        self.prefix = output[:-len(extension)] if output.endswith(extension) else output
+        self.extension = extension
+        self.columns = columns
+        self.fmt = fmt
+        self.compress = compress
+        self.chunk_bytes = chunk_bytes if output != "-" else None
+        self.on_chunk = on_chunk
+        self.stdout = output == "-"
+        self.paths = []
+        self.rows = 0
+        self._raw = self._gzip = self._text = self._csv = None
+
+    def _open(self):
+        if self.stdout:
+            self._raw, path = sys.stdout.buffer, "-"
+        else:
+            part = f".part{len(self.paths) + 1:03d}" if self.chunk_bytes else ""
+            path = self.prefix + part + self.extension
+            self._raw = open(path, "wb")
+        self.paths.append(path)
+        stream = self._raw
+        if self.compress:
+            stream = self._gzip = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+        self._text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        if self.fmt == "csv":
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(self.columns)
+
+    def _close(self):
+        if self._text is None:
+            return
+        self._text.flush()
+        self._text.detach()
+        if self._gzip is not None:
+            self._gzip.close()
+        if self.stdout:
+            self._raw.flush()
+        else:
+            self._raw.close()
+            if self.on_chunk:
+                self.on_chunk(self.paths[-1])
+        self._raw = self._gzip = self._text = self._csv = None
+
+    def write(self, row):
+        if self._text is None:
+            self._open()
+        values = [_value(value) for value in row]
+        if self.fmt == "csv":
+            self._csv.writerow(values)
+        else:
+            self._text.write(json.dumps(dict(zip(self.columns, values)), ensure_ascii=False) + "\n")
+        self.rows += 1
+        # Размер файла проверяется по уже записанным (сжатым) байтам раз в пакет
+        if self.chunk_bytes and self.rows % 1000 == 0:
+            self._text.flush()
+            if self._raw.tell() >= self.chunk_bytes:
+                self._close()
+
+    def close(self):
+        # Пустая выгрузка — все равно файл (с заголовком CSV)
+        if not self.paths:
+            self._open()
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export(table, output, fmt="csv", compress=False, category=None, since=None, until=None,
+           chunk_bytes=None, on_chunk=None):
+    """Потоковая выгрузка таблицы: (файлы, число строк).
+
+    on_chunk(path) вызывается после закрытия каждого файла — бот отправляет
+    его, не дожидаясь конца выгрузки.
+    """
+    if table not in TABLES:
+        raise ValueError(f"Неизвестная таблица: {table}")
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    rows = iter_products if table == "products" else iter_history
+    with ChunkedWriter(output, TABLES[table], fmt, compress, chunk_bytes, on_chunk) as writer:
+        for row in rows(category, since, until):
+            writer.write(row)
+    logger.info(f"📦 Выгрузка {table}: {writer.rows} строк, файлов: {len(writer.paths)}")
+    return writer.paths, writer.rows
+
+
+def _date(value):
+    return datetime.fromisoformat(value)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args = argparse.ArgumentParser(description="Выгрузка товаров и истории цен Kaspi")
+    args.add_argument("table", choices=sorted(TABLES))
+    args.add_argument("--format", choices=FORMATS, default="csv")
+    args.add_argument("--gzip", action="store_true", help="сжатие gzip")
+    args.add_argument("--category", help="только товары категории")
+    args.add_argument("--since", type=_date, help="начало окна (ISO, например 2024-01-01)")
+    args.add_argument("--until", type=_date, help="конец окна (ISO)")
+    args.add_argument("--output", help="файл или префикс файлов ('-' — stdout), по умолчанию имя таблицы")
+    args.add_argument("--chunk-mb", type=float, default=0, help="размер файла, МБ (0 — один файл)")
+    opts = args.parse_args()
+    export(
+        opts.table, opts.output or opts.table, opts.format, opts.gzip, opts.category,
+        opts.since, opts.until, int(opts.chunk_mb * 1024 * 1024) or None
+    )
@@ -0,0 +1,430 @@
+import os
+import time
+import socket
+import logging
+import tempfile
+import threading
+from datetime import datetime
+import numpy as np
+from sqlalchemy import text, bindparam, DateTime, Float
+from db import get_engine
+from shared_state import SHARED_STATE, acquire_lease
+
+logger = logging.getLogger(__name__)
+
+# Месяцев истории цен в базе; более старые месяцы переносятся в архив (0 — не архивировать)
+HISTORY_HOT_MONTHS = int(os.getenv("HISTORY_HOT_MONTHS", "6"))
+# Каталог архива: по файлу Parquet на месяц, общий для всех процессов бота
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "history_archive")
+# Каталог архива смонтирован у всех реплик (общий диск, NFS): без этого при
+# SHARED_STATE=db строки не удаляются из базы — файлы были бы на одной машине
+HISTORY_ARCHIVE_SHARED = os.getenv("HISTORY_ARCHIVE_SHARED", "0") == "1"
+# Строк в группе Parquet: строки отсортированы по товару, и чтение одного
+# товара распаковывает одну-две группы, остальные отсекаются по статистике
+HISTORY_ARCHIVE_ROW_GROUP = int(os.getenv("HISTORY_ARCHIVE_ROW_GROUP", "4096"))
+# Месячные секции PostgreSQL создаются заранее
+PARTITION_MONTHS_AHEAD = 2
+
+# Аренда архивирования продлевается перед каждым месяцем
+ARCHIVE_LEASE_SECONDS = 3600
+# Список архивных месяцев меняется раз в месяц: процесс перечитывает его
+# не чаще раза в столько секунд (свой архив сбрасывает кэш сразу)
+ARCHIVE_MONTHS_TTL = 60
+ARCHIVE_HOST = socket.gethostname()
+ARCHIVE_OWNER = f"{ARCHIVE_HOST}:{os.getpid()}"
+
+READ_COLUMNS = ["product_id", "price", "timestamp", "last_seen", "source"]
+# Источник строк, перенесенных на начало месяца: это не наблюдение цены,
+# и читатели сырой истории (страницы, выгрузка) их пропускают
+CARRY_SOURCE = "carry"
+
+MONTH_QUERY = text("""
+    SELECT product_id, price, timestamp, source, last_seen FROM price_history
+    WHERE timestamp >= :start AND timestamp < :end
+    ORDER BY product_id, timestamp
+""").bindparams(
+    bindparam("start", type_=DateTime), bindparam("end", type_=DateTime)
+).columns(price=Float, timestamp=DateTime, last_seen=DateTime)
+
+# Цена, еще действовавшая на конец месяца, переносится строкой на начало
+# следующего: горячая таблица сама знает цену на своей границе, а last_seen
+# продлевает уже она. Строка помечена source = CARRY_SOURCE
+CARRY_FORWARD_QUERY = text("""
+    INSERT INTO price_history (product_id, price, timestamp, source, last_seen)
+    SELECT h.product_id, h.price, :end, :carry, h.last_seen
+    FROM price_history h
+    JOIN (
+        SELECT product_id, MAX(timestamp) AS timestamp FROM price_history
+        WHERE timestamp >= :start AND timestamp < :end
+        GROUP BY product_id
+    ) latest ON latest.product_id = h.product_id AND latest.timestamp = h.timestamp
+    WHERE COALESCE(h.last_seen, h.timestamp) >= :end
+      AND NOT EXISTS (
+          SELECT 1 FROM price_history n WHERE n.product_id = h.product_id AND n.timestamp = :end
+      )
+""").bindparams(bindparam("start", type_=DateTime), bindparam("end", type_=DateTime))
+
+DELETE_MONTH_QUERY = text("""
+    DELETE FROM price_history WHERE timestamp >= :start AND timestamp < :end
+""").bindparams(bindparam("start", type_=DateTime), bindparam("end", type_=DateTime))
+
+ARCHIVED_MONTHS_QUERY = text("""
+    SELECT month, host FROM history_archive_months ORDER BY month
+""").columns(month=DateTime)
+
+REGISTER_MONTH_QUERY = text("""
+    INSERT INTO history_archive_months (month, rows, host, archived_at)
+    VALUES (:start, :rows, :host, :now)
+""").bindparams(bindparam("start", type_=DateTime), bindparam("now", type_=DateTime))
+
+# Открытые файлы архива: путь -> (mtime, ParquetFile, диапазоны product_id групп)
+_files = {}
+_files_lock = threading.Lock()
+# Архивные файлы, об отсутствии которых уже сообщено
+_missing = set()
+# Кэш списка архивных месяцев: (время чтения, [(начало месяца, host)])
+_months = None
+
+
+def month_start(value):
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(value, months):
+    index = value.year * 12 + value.month - 1 + months
+    return value.replace(year=index // 12, month=index % 12 + 1)
+
+
+def _period_name(start):
+    return f"price_history_{start:%Y_%m}"
+
+
+# --- Месячные секции PostgreSQL ---
+
+def is_partitioned(conn):
+    return conn.execute(text(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass('price_history')"
+    )).scalar() == "p"
+
+
+def ensure_partitions(conn, since=None, now=None):
+    """Секции price_history по месяцам от since до PARTITION_MONTHS_AHEAD вперед"""
+    if conn.dialect.name != "postgresql" or not is_partitioned(conn):
+        return
+    now = now or datetime.utcnow()
+    month = month_start(since or now)
+    last = add_months(month_start(now), PARTITION_MONTHS_AHEAD)
+    while month <= last:
+        end = add_months(month, 1)
+        try:
+            # Секция не создается, если строки ее месяца уже лежат в секции по умолчанию
+            with conn.begin_nested():
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS {_period_name(month)} PARTITION OF price_history
+                    FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')
+                """))
+        except Exception as e:
+            logger.error(f"Ошибка создания секции {_period_name(month)}: {e}")
+        month = end
+
+
+def partition_price_history(conn):
+    """Перевод price_history PostgreSQL на месячные секции (один раз при миграции)"""
+    if conn.dialect.name != "postgresql" or is_partitioned(conn):
+        return
+    logger.info("Перевод price_history на месячные секции...")
+    first = conn.execute(text("SELECT MIN(timestamp) AS first FROM price_history").columns(first=DateTime)).scalar()
+    conn.execute(text("ALTER TABLE price_history RENAME TO price_history_unpartitioned"))
+    sequence = conn.execute(text(
+        "SELECT pg_get_serial_sequence('price_history_unpartitioned', 'id')"
+    )).scalar()
+    # Ключ секционированной таблицы обязан включать колонку секционирования
+    conn.execute(text("""
+        CREATE TABLE price_history (LIKE price_history_unpartitioned INCLUDING DEFAULTS)
+        PARTITION BY RANGE ("timestamp")
+    """))
+    conn.execute(text('ALTER TABLE price_history ADD PRIMARY KEY (id, "timestamp")'))
+    conn.execute(text("CREATE TABLE price_history_default PARTITION OF price_history DEFAULT"))
+    ensure_partitions(conn, since=first)
+    conn.execute(text("INSERT INTO price_history SELECT * FROM price_history_unpartitioned"))
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY price_history.id"))
+    conn.execute(text("DROP TABLE price_history_unpartitioned"))
+    logger.info("✅ price_history разбита на месячные секции")
+
+
+# --- Архив Parquet ---
+
+def _archive_path(start):
+    return os.path.join(HISTORY_ARCHIVE_DIR, _period_name(start) + ".parquet")
+
+
+def _archived_months(refresh=False):
+    """Заархивированные месяцы по возрастанию: [(начало месяца, host)].
+
+    Список общий для всех процессов: месяц записывается в базу в одной
+    транзакции с удалением его строк, поэтому файл, записанный до сбоя,
+    не читается, пока месяц не заархивирован заново. Читается из базы
+    не чаще раза в ARCHIVE_MONTHS_TTL секунд (refresh — сразу).
+    """
+    global _months
+    cached = _months
+    if refresh or cached is None or time.monotonic() - cached[0] > ARCHIVE_MONTHS_TTL:
+        with get_engine().connect() as conn:
+            months = [tuple(row) for row in conn.execute(ARCHIVED_MONTHS_QUERY)]
+        cached = _months = (time.monotonic(), months)
+    return cached[1]
+
+
+def _periods():
+    """Архивные месяцы по возрастанию: [(начало месяца, путь)]"""
+    periods = []
+    for start, host in _archived_months():
+        path = _archive_path(start)
+        if os.path.exists(path):
+            periods.append((start, path))
+        elif path not in _missing:
+            _missing.add(path)
+            logger.error(f"❌ Нет файла архива {path} (записан на {host}): история за месяц недоступна")
+    return periods
+
+
+def archive_boundary():
+    """Начало истории в базе: все более ранние записи в архиве (None — архива нет)"""
+    months = _archived_months()
+    return add_months(months[-1][0], 1) if months else None
+
+
+def _export_month(conn, start, end, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("product_id", pa.int64()),
+        ("price", pa.float64()),
+        ("timestamp", pa.timestamp("us")),
+        ("source", pa.string()),
+        ("last_seen", pa.timestamp("us"))
+    ])
+    # Уникальное временное имя: недописанный файл другого процесса не подменяется
+    descriptor, temporary = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path)
+    )
+    os.close(descriptor)
+    written = 0
+    try:
+        result = conn.execution_options(yield_per=HISTORY_ARCHIVE_ROW_GROUP).execute(
+            MONTH_QUERY, {"start": start, "end": end}
+        )
+        with pq.ParquetWriter(temporary, schema, compression="zstd") as writer:
+            for chunk in result.partitions():
+                product_ids, prices, timestamps, sources, last_seen = zip(*chunk)
+                # Дальше конца месяца цену продолжает строка, перенесенная в базу
+                last_seen = [min(value, end) if value else value for value in last_seen]
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(product_ids), pa.array(prices), pa.array(timestamps),
+                     pa.array(sources), pa.array(last_seen)],
+                    schema=schema
+                ))
+                written += len(chunk)
+        if written:
+            os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return written
+
+
+def _archive_month(engine, start):
+    global _months
+    end = add_months(start, 1)
+    params = {"start": start, "end": end}
+    with engine.begin() as conn:
+        rows = _export_month(conn, start, end, _archive_path(start))
+        if not rows:
+            return 0
+        carried = conn.execute(CARRY_FORWARD_QUERY, {**params, "carry": CARRY_SOURCE}).rowcount
+        if conn.dialect.name == "postgresql":
+            name = _period_name(start)
+            if conn.execute(text(f"SELECT to_regclass('{name}')")).scalar():
+                conn.execute(text(f"ALTER TABLE price_history DETACH PARTITION {name}"))
+                conn.execute(text(f"DROP TABLE {name}"))
+        # Строки месяца вне своей секции (секция по умолчанию, SQLite)
+        conn.execute(DELETE_MONTH_QUERY, params)
+        conn.execute(REGISTER_MONTH_QUERY, {
+            "start": start, "rows": rows, "host": ARCHIVE_HOST, "now": datetime.utcnow()
+        })
+    # Читатели этого процесса видят новый месяц сразу, остальные — через ARCHIVE_MONTHS_TTL
+    _months = None
+    logger.info(f"🗄 {_period_name(start)}: в архив {rows} записей, перенесено цен {carried}")
+    return rows
+
+
+def archive_history(now=None):
+    """Перенос месяцев старше HISTORY_HOT_MONTHS из price_history в архив Parquet.
+
+    Файл месяца пишется до удаления строк из базы: при сбое месяц будет
+    заархивирован повторно, а читатели не видят дублей — месяц становится
+    архивным вместе с удалением строк. Архив пишет один процесс под арендой
+    и только в каталог, где есть файлы всех уже архивных месяцев.
+    """
+    if HISTORY_HOT_MONTHS <= 0:
+        return 0
+    if SHARED_STATE == "db" and not HISTORY_ARCHIVE_SHARED:
+        logger.warning("⚠️ Архив истории выключен: для нескольких реплик нужен общий "
+                       "HISTORY_ARCHIVE_DIR (HISTORY_ARCHIVE_SHARED=1)")
+        return 0
+    if not acquire_lease("history_archive", ARCHIVE_OWNER, ARCHIVE_LEASE_SECONDS):
+        logger.info("Архив истории пишет другой процесс")
+        return 0
+
+    months = _archived_months(refresh=True)
+    missing = [(start, host) for start, host in months if not os.path.exists(_archive_path(start))]
+    if missing:
+        start, host = missing[0]
+        logger.error(f"❌ Архивирование остановлено: в {HISTORY_ARCHIVE_DIR} нет {len(missing)} "
+                     f"архивных месяцев (например, {_period_name(start)} с {host})")
+        return 0
+
+    cutoff = add_months(month_start(now or datetime.utcnow()), -HISTORY_HOT_MONTHS)
+    engine = get_engine()
+    with engine.connect() as conn:
+        first = conn.execute(text("SELECT MIN(timestamp) AS first FROM price_history").columns(first=DateTime)).scalar()
+    if first is None or first >= cutoff:
+        return 0
+
+    os.makedirs(HISTORY_ARCHIVE_DIR, exist_ok=True)
+    archived = 0
+    # Уже архивный месяц не переписывается: его файл — единственная копия
+    month = max(month_start(first), add_months(months[-1][0], 1)) if months else month_start(first)
+    while month < cutoff:
+        if not acquire_lease("history_archive", ARCHIVE_OWNER, ARCHIVE_LEASE_SECONDS):
+            logger.warning("⚠️ Аренда архивирования потеряна, архивирование прервано")
+            break
+        try:
+            archived += _archive_month(engine, month)
+        except Exception as e:
+            logger.error(f"Ошибка архивирования {_period_name(month)}: {e}")
+            break
+        month = add_months(month, 1)
+    return archived
+
+
+def maintain_history():
+    """Обслуживание истории цен: секции PostgreSQL наперед и архивирование старых месяцев"""
+    try:
+        with get_engine().begin() as conn:
+            ensure_partitions(conn)
+        archive_history()
+    except Exception as e:
+        logger.error(f"Ошибка обслуживания истории цен: {e}")
+
+
+def _open(path):
+    """Открытый файл архива и диапазоны product_id его групп строк.
+
+    Файл отображается в память и держится открытым, пока не изменится;
+    группы без нужного товара отсекаются по статистике без чтения.
+    """
+    import pyarrow.parquet as pq
+    mtime = os.path.getmtime(path)
+    cached = _files.get(path)
+    if cached is None or cached[0] != mtime:
+        parquet = pq.ParquetFile(path, memory_map=True)
+        ranges = []
+        for index in range(parquet.metadata.num_row_groups):
+            statistics = parquet.metadata.row_group(index).column(0).statistics
+            if statistics is None or not statistics.has_min_max:
+                ranges.append((float("-inf"), float("inf")))
+            else:
+                ranges.append((statistics.min, statistics.max))
+        cached = _files[path] = (mtime, parquet, ranges)
+    return cached[1], cached[2]
+
+
+def _read(path, product_id, since=None, until=None, before=None, carried=True):
+    """Записи товара из файла архива: [(price, timestamp, last_seen)] по времени
+    (carried=False — без перенесенных на начало месяца строк)"""
+    with _files_lock:
+        parquet, ranges = _open(path)
+        groups = [index for index, (low, high) in enumerate(ranges) if low <= product_id <= high]
+        if not groups:
+            return []
+        table = parquet.read_row_groups(groups, columns=READ_COLUMNS, use_threads=False)
+    # Строки файла отсортированы по товару: нужный диапазон находится бинарным поиском
+    product_ids = table.column("product_id").combine_chunks().to_numpy()
+    low, high = np.searchsorted(product_ids, [product_id, product_id + 1])
+    table = table.slice(low, high - low)
+    rows = zip(*(table.column(name).to_pylist() for name in READ_COLUMNS[1:]))
+    return [
+        (price, timestamp, last_seen) for price, timestamp, last_seen, source in rows
+        if (since is None or timestamp >= since)
+        and (until is None or timestamp <= until)
+        and (before is None or timestamp < before)
+        and (carried or source != CARRY_SOURCE)
+    ]
+
+
+def iter_archive(since=None, until=None, product_ids=None, batch_size=HISTORY_ARCHIVE_ROW_GROUP, carried=True):
+    """Потоковое чтение архива по месяцам: кортежи (product_id, price, timestamp, source, last_seen).
+
+    В памяти одновременно не больше одного пакета batch_size строк;
+    carried=False пропускает строки, перенесенные на начало месяца.
+    """
+    import pyarrow.parquet as pq
+    columns = ["product_id", "price", "timestamp", "source", "last_seen"]
+    for start, path in _periods():
+        if (since and add_months(start, 1) <= since) or (until and start > until):
+            continue
+        parquet = pq.ParquetFile(path, memory_map=True)
+        for batch in parquet.iter_batches(batch_size=batch_size, columns=columns, use_threads=False):
+            for row in zip(*(batch.column(name).to_pylist() for name in columns)):
+                if since and row[2] < since or until and row[2] > until:
+                    continue
+                if product_ids is not None and row[0] not in product_ids:
+                    continue
+                if not carried and row[3] == CARRY_SOURCE:
+                    continue
+                yield row
+
+
+def read_history(product_id, since=None, until=None, limit=None, carried=True):
+    """Архивные записи товара в окне [since, until]; с limit — не больше
+    limit первых записей (следующие месяцы не читаются)"""
+    rows = []
+    for start, path in _periods():
+        if (since and add_months(start, 1) <= since) or (until and start > until):
+            continue
+        rows.extend(_read(path, product_id, since, until, carried=carried))
+        if limit is not None and len(rows) >= limit:
+            return rows[:limit]
+    return rows
+
+
+def previous_row(product_id, before):
+    """Последняя архивная запись товара раньше before"""
+    for start, path in reversed(_periods()):
+        if start >= before:
+            continue
+        rows = _read(path, product_id, before=before)
+        if rows:
+            return rows[-1]
+    return None
+
+
+def first_timestamp(product_id):
+    """Время первой архивной записи товара"""
+    for _, path in _periods():
+        rows = _read(path, product_id)
+        if rows:
+            return rows[0][1]
+    return None
+
+
+def latest_observation(product_id):
+    """Последнее наблюдение цены товара в архиве"""
+    for _, path in reversed(_periods()):
+        rows = _read(path, product_id)
+        if rows:
+            return max(last_seen or timestamp for _, timestamp, last_seen in rows)
+    return None
@@ -0,0 +1,378 @@
+import os
+import io
+import csv
+import asyncio
+import sqlite3
+import logging
+from datetime import datetime
+from itertools import islice
+from sqlalchemy import select, text, bindparam, func, DateTime
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from db import get_engine, products, ROLLUP_TABLES, refresh_category_metrics
+from alerts import detect_drops
+
+logger = logging.getLogger(__name__)
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "1000"))
+
+# Лимит параметров в одном запросе SQLite
+SQLITE_MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32) else 999
+SQLITE_ROWS_PER_STATEMENT = 500
+
+PRODUCT_COLUMNS = ["id", "name", "category", "price", "rating", "reviews", "url",
+                   "created_at", "updated_at", "is_active"]
+UPDATE_COLUMNS = ["name", "category", "price", "rating", "reviews", "url",
+                  "updated_at", "is_active"]
+HISTORY_COLUMNS = ["product_id", "price", "timestamp", "source", "last_seen"]
+ROLLUP_COLUMNS = ["product_id", "bucket", "open", "high", "low", "close", "samples"]
+
+# Приращения статистики категорий
+CATEGORY_STATS_QUERY = text("""
+    INSERT INTO category_stats (category, products, demand, price_sum, priced, updated_at)
+    VALUES (:category, :products, :demand, :price_sum, :priced, :now)
+    ON CONFLICT (category) DO UPDATE SET
+        products = category_stats.products + excluded.products,
+        demand = category_stats.demand + excluded.demand,
+        price_sum = category_stats.price_sum + excluded.price_sum,
+        priced = category_stats.priced + excluded.priced,
+        updated_at = excluded.updated_at
+""").bindparams(bindparam("now", type_=DateTime))
+
+# Продление последней записи истории для товаров с неизменной ценой
+# (последняя по времени: ее находит индекс (product_id, timestamp))
+HEARTBEAT_QUERY = text("""
+    UPDATE price_history SET last_seen = :now
+    WHERE (product_id, timestamp) IN (
+        SELECT product_id, MAX(timestamp) FROM price_history
+        WHERE product_id IN :product_ids
+        GROUP BY product_id
+    )
+""").bindparams(bindparam("product_ids", expanding=True), bindparam("now", type_=DateTime))
+
+
+def chunked(iterable, size):
+    """Разбиение потока на списки по size элементов"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _sqlite_datetime(value):
+    # Тот же формат, что использует тип DateTime SQLAlchemy для SQLite
+    return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def _sqlite_insert_many(conn, table, columns, rows, suffix=""):
+    """Многострочный INSERT ... VALUES (...), (...) без компиляции Core на каждый пакет"""
+    per_statement = max(1, min(SQLITE_ROWS_PER_STATEMENT, SQLITE_MAX_VARIABLES // len(columns)))
+    placeholder = "(" + ", ".join("?" * len(columns)) + ")"
+    statements = {}
+
+    for part in chunked(rows, per_statement):
+        sql = statements.get(len(part))
+        if sql is None:
+            sql = statements[len(part)] = (
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+                + ", ".join([placeholder] * len(part)) + suffix
+            )
+        params = []
+        for row in part:
+            for column in columns:
+                value = row[column]
+                params.append(_sqlite_datetime(value) if isinstance(value, datetime) else value)
+        conn.exec_driver_sql(sql, tuple(params))
+
+
+def _product_rows(records, now):
+    # Последняя запись по каждому id: ON CONFLICT не допускает дублей в одном запросе
+    rows = {}
+    for record in records:
+        if record.get("id") is None or not record.get("name"):
+            continue
+        rows[record["id"]] = {
+            "id": record["id"],
+            "name": record["name"][:500],
+            "category": record.get("category"),
+            "price": record.get("price"),
+            "rating": record.get("rating"),
+            "reviews": record.get("reviews") or 0,
+            "url": record.get("url"),
+            "created_at": now,
+            "updated_at": now,
+            "is_active": 1
+        }
+    return list(rows.values())
+
+
+def _upsert_products(conn, rows):
+    if conn.dialect.name == "postgresql":
+        stmt = pg_insert(products)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[products.c.id],
+            set_={column: stmt.excluded[column] for column in UPDATE_COLUMNS}
+        )
+        # executemany: SQLAlchemy сворачивает его в пакетные INSERT ... VALUES
+        conn.execute(stmt, rows)
+        return
+
+    suffix = " ON CONFLICT (id) DO UPDATE SET " + ", ".join(
+        f"{column} = excluded.{column}" for column in UPDATE_COLUMNS
+    )
+    _sqlite_insert_many(conn, "products", PRODUCT_COLUMNS, rows, suffix)
+
+
+def _append_history(conn, rows):
+    if not rows:
+        return
+
+    if conn.dialect.name == "postgresql":
+        # COPY в рамках текущей транзакции соединения
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            writer.writerow([row[column] for column in HISTORY_COLUMNS])
+        buf.seek(0)
+        cursor = conn.connection.driver_connection.cursor()
+        try:
+            cursor.copy_expert(
+                "COPY price_history (product_id, price, timestamp, source, last_seen) "
+                "FROM STDIN WITH (FORMAT csv)",
+                buf
+            )
+        finally:
+            cursor.close()
+        return
+
+    _sqlite_insert_many(conn, "price_history", HISTORY_COLUMNS, rows)
+
+
+def _bucket(now, unit):
+    if unit == "hour":
+        return now.replace(minute=0, second=0, microsecond=0)
+    return now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _update_rollups(conn, observations, now):
+    """Обновление OHLC-агрегатов всеми наблюдениями пакета"""
+    if not observations:
+        return
+
+    for unit, table in ROLLUP_TABLES.items():
+        bucket = _bucket(now, unit)
+        rows = [
+            {"product_id": product_id, "bucket": bucket, "open": price, "high": price,
+             "low": price, "close": price, "samples": 1}
+            for product_id, price in observations
+        ]
+
+        if conn.dialect.name == "postgresql":
+            stmt = pg_insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.product_id, table.c.bucket],
+                set_={
+                    "high": func.greatest(table.c.high, stmt.excluded.high),
+                    "low": func.least(table.c.low, stmt.excluded.low),
+                    "close": stmt.excluded.close,
+                    "samples": table.c.samples + stmt.excluded.samples
+                }
+            )
+            conn.execute(stmt, rows)
+            continue
+
+        suffix = (
+            f" ON CONFLICT (product_id, bucket) DO UPDATE SET"
+            f" high = MAX({table.name}.high, excluded.high),"
+            f" low = MIN({table.name}.low, excluded.low),"
+            f" close = excluded.close,"
+            f" samples = {table.name}.samples + excluded.samples"
+        )
+        _sqlite_insert_many(conn, table.name, ROLLUP_COLUMNS, rows, suffix)
+
+
+def _previous_state(conn, ids):
+    result = conn.execute(
+        select(products.c.id, products.c.price, products.c.category,
+               products.c.reviews, products.c.is_active)
+        .where(products.c.id.in_(ids))
+    )
+    return {row.id: row for row in result}
+
+
+def _update_category_stats(conn, rows, previous, now):
+    """Применение приращений пакета к статистике категорий.
+
+    Старое состояние товара вычитается из его прежней категории,
+    новое добавляется к текущей — полный пересчет не нужен.
+    """
+    deltas = {}
+
+    def apply(category, sign, reviews, price):
+        if not category:
+            return
+        delta = deltas.setdefault(category, [0, 0, 0.0, 0])
+        delta[0] += sign
+        delta[1] += sign * (reviews or 0)
+        if price is not None:
+            delta[2] += sign * price
+            delta[3] += sign
+
+    for row in rows:
+        old = previous.get(row["id"])
+        if old is not None and old.is_active == 1:
+            apply(old.category, -1, old.reviews, old.price)
+        apply(row["category"], 1, row["reviews"], row["price"])
+
+    changes = [
+        {"category": category, "products": d[0], "demand": d[1], "price_sum": d[2],
+         "priced": d[3], "now": now}
+        for category, d in deltas.items() if any(d)
+    ]
+    if changes:
+        conn.execute(CATEGORY_STATS_QUERY, changes)
+    return set(deltas)
+
+
+def _price_changed(old, new):
+    return old is None or abs(old - new) >= 0.005
+
+
+def write_batch(conn, records, source="kaspi", now=None):
+    """Запись одного пакета товаров и истории цен в открытой транзакции.
+
+    В историю попадают только изменения цены; для неизменных цен
+    продлевается last_seen последней записи. Агрегаты обновляются всеми
+    наблюдениями.
+    """
+    now = now or datetime.utcnow()
+    rows = _product_rows(records, now)
+    if not rows:
+        return {"products": 0, "history": 0, "unchanged": 0, "alerts": 0, "categories": set()}
+
+    previous = _previous_state(conn, [row["id"] for row in rows])
+    history = []
+    unchanged = []
+    for row in rows:
+        if row["price"] is None:
+            continue
+        old = previous.get(row["id"])
+        if _price_changed(old.price if old else None, row["price"]):
+            history.append({
+                "product_id": row["id"],
+                "price": row["price"],
+                "timestamp": now,
+                "source": source,
+                "last_seen": now
+            })
+        else:
+            unchanged.append(row["id"])
+
+    _upsert_products(conn, rows)
+    _append_history(conn, history)
+    if unchanged:
+        conn.execute(HEARTBEAT_QUERY, {"now": now, "product_ids": unchanged})
+    _update_rollups(conn, [(row["id"], row["price"]) for row in rows if row["price"] is not None], now)
+    categories = _update_category_stats(conn, rows, previous, now)
+    # Падения цен у товаров с подписками — по уже загруженному состоянию
+    alerts = detect_drops(conn, rows, previous, now)
+    return {
+        "products": len(rows),
+        "history": len(history),
+        "unchanged": len(unchanged),
+        "alerts": alerts,
+        "categories": categories
+    }
+
+
+def touch_products(conn, product_ids, now):
+    """Наблюдение товаров неизменной страницы листинга: их цена — та, что в products.
+
+    Как для неизменной цены в write_batch: продлевается last_seen последней
+    записи истории и обновляются агрегаты. Возвращает (число товаров, их категории).
+    """
+    rows = conn.execute(
+        select(products.c.id, products.c.price, products.c.category)
+        .where(products.c.id.in_(product_ids), products.c.is_active == 1)
+    ).fetchall()
+    if not rows:
+        return 0, set()
+    ids = [row.id for row in rows]
+    conn.execute(products.update().where(products.c.id.in_(ids)).values(updated_at=now))
+    priced = [(row.id, row.price) for row in rows if row.price is not None]
+    if priced:
+        conn.execute(HEARTBEAT_QUERY, {"now": now, "product_ids": [product_id for product_id, _ in priced]})
+        _update_rollups(conn, priced, now)
+    return len(rows), {row.category for row in rows if row.category}
+
+
+def ingest_products(records, batch_size=INGEST_BATCH_SIZE, source="kaspi", unchanged_ids=()):
+    """Пакетная запись потока товаров в одной транзакции.
+
+    unchanged_ids — товары неизменных страниц листинга (см. touch_products).
+    """
+    total = {"products": 0, "history": 0, "unchanged": 0, "alerts": 0}
+    now = datetime.utcnow()
+    categories = set()
+
+    with get_engine().begin() as conn:
+        for batch in chunked(records, batch_size):
+            result = write_batch(conn, batch, source, now)
+            for key in total:
+                total[key] += result[key]
+            categories |= result["categories"]
+        for ids in chunked(unchanged_ids, batch_size):
+            touched, touched_categories = touch_products(conn, ids, now)
+            total["unchanged"] += touched
+            categories |= touched_categories
+        refresh_category_metrics(conn, categories)
+
+    logger.info(
+        f"Записано {total['products']} товаров, {total['history']} изменений цен, "
+        f"без изменений {total['unchanged']}, уведомлений {total['alerts']}"
+    )
+    return total
+
+
+async def ingest_stream(records, batch_size=INGEST_BATCH_SIZE, source="kaspi"):
+    """Запись асинхронного потока товаров пакетами, не блокируя event loop.
+
+    Отметки страниц (parser.page_marker) подтверждаются после коммита
+    пакета, в который попали их товары; товары неизменных страниц
+    записываются тем же пакетом.
+    """
+    total = {"products": 0, "history": 0, "unchanged": 0, "alerts": 0}
+    batch = []
+    pages = []
+    unchanged_ids = []
+
+    def write(batch, pages, unchanged_ids):
+        result = ingest_products(batch, batch_size, source, unchanged_ids)
+        for page in pages:
+            if page["committed"]:
+                page["committed"]()
+        return result
+
+    async def flush():
+        result = await asyncio.to_thread(write, batch, pages, unchanged_ids)
+        for key in total:
+            total[key] += result[key]
+
+    async for record in records:
+        if "page" in record:
+            pages.append(record)
+            unchanged_ids.extend(record["product_ids"])
+        else:
+            batch.append(record)
+        if len(batch) + len(unchanged_ids) >= batch_size:
+            await flush()
+            batch = []
+            pages = []
+            unchanged_ids = []
+
+    if batch or pages:
+        await flush()
+
+    logger.info(f"Загрузка завершена: {total['products']} товаров, {total['history']} записей истории")
+    return total
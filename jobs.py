@@ -0,0 +1,180 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import text, bindparam, DateTime
+from db import get_engine
+
+logger = logging.getLogger(__name__)
+
+# Аренда задачи: воркер продлевает ее, пока работает; истекшая аренда освобождает задачу
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_SECONDS = int(os.getenv("JOB_RETRY_SECONDS", "60"))
+
+# Задача готова к выдаче: ждет своей очереди или ее аренда истекла
+READY_CONDITION = """
+    ((status = 'pending' AND run_after <= :now)
+     OR (status = 'running' AND lease_expires < :now))
+    AND attempts < :max_attempts
+"""
+
+DATETIME_PARAMS = [bindparam(name, type_=DateTime) for name in ("now", "expires")]
+
+ENQUEUE_QUERY = text("""
+    INSERT INTO crawl_jobs (kind, url, status, priority, attempts, run_after, created_at)
+    VALUES (:kind, :url, 'pending', :priority, 0, :now, :now)
+    ON CONFLICT (kind, url) WHERE status IN ('pending', 'running') DO NOTHING
+""").bindparams(bindparam("now", type_=DateTime))
+
+# PostgreSQL: конкурирующие воркеры пропускают строки, заблокированные другими
+PG_CLAIM_QUERY = text(f"""
+    UPDATE crawl_jobs
+    SET status = 'running', lease_owner = :worker, lease_expires = :expires,
+        heartbeat_at = :now, attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM crawl_jobs
+        WHERE {READY_CONDITION}
+        ORDER BY priority DESC, id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, url, attempts
+""").bindparams(*DATETIME_PARAMS)
+
+# SQLite: кандидаты читаются без блокировки, захват — условным UPDATE.
+# Запись в SQLite последовательна, поэтому условие проверяется атомарно
+# и задачу получает ровно один воркер.
+SQLITE_CANDIDATES_QUERY = text(f"""
+    SELECT id FROM crawl_jobs
+    WHERE {READY_CONDITION}
+    ORDER BY priority DESC, id
+    LIMIT :limit
+""").bindparams(bindparam("now", type_=DateTime))
+
+SQLITE_CLAIM_QUERY = text(f"""
+    UPDATE crawl_jobs
+    SET status = 'running', lease_owner = :worker, lease_expires = :expires,
+        heartbeat_at = :now, attempts = attempts + 1
+    WHERE id = :id AND {READY_CONDITION}
+""").bindparams(*DATETIME_PARAMS)
+
+CLAIMED_QUERY = text("""
+    SELECT id, kind, url, attempts FROM crawl_jobs
+    WHERE id IN :ids AND lease_owner = :worker AND status = 'running'
+    ORDER BY priority DESC, id
+""").bindparams(bindparam("ids", expanding=True))
+
+# Задачи, исчерпавшие попытки из-за потерянной аренды (воркер упал)
+REAP_QUERY = text("""
+    UPDATE crawl_jobs
+    SET status = 'failed', finished_at = :now, last_error = 'Аренда истекла'
+    WHERE status = 'running' AND lease_expires < :now AND attempts >= :max_attempts
+""").bindparams(bindparam("now", type_=DateTime))
+
+HEARTBEAT_QUERY = text("""
+    UPDATE crawl_jobs SET lease_expires = :expires, heartbeat_at = :now
+    WHERE id IN :ids AND lease_owner = :worker AND status = 'running'
+""").bindparams(bindparam("ids", expanding=True), *DATETIME_PARAMS)
+
+
+def enqueue(jobs):
+    """Постановка задач в очередь: [{"kind", "url", "priority"}].
+
+    Для одного URL одновременно существует не больше одной
+    ожидающей или выполняемой задачи — повторы пропускаются.
+    """
+    if not jobs:
+        return 0
+    now = datetime.utcnow()
+    rows = [
+        {"kind": job["kind"], "url": job["url"], "priority": job.get("priority", 0), "now": now}
+        for job in jobs
+    ]
+    with get_engine().begin() as conn:
+        result = conn.execute(ENQUEUE_QUERY, rows)
+    return max(result.rowcount, 0)
+
+
+def claim(worker, limit, lease_seconds=JOB_LEASE_SECONDS):
+    """Захват до limit готовых задач в аренду воркером worker"""
+    now = datetime.utcnow()
+    params = {
+        "worker": worker,
+        "now": now,
+        "expires": now + timedelta(seconds=lease_seconds),
+        "limit": limit,
+        "max_attempts": JOB_MAX_ATTEMPTS
+    }
+
+    with get_engine().begin() as conn:
+        conn.execute(REAP_QUERY, params)
+
+        if conn.dialect.name == "postgresql":
+            rows = conn.execute(PG_CLAIM_QUERY, params).fetchall()
+            return [dict(row._mapping) for row in rows]
+
+        candidates = [row.id for row in conn.execute(SQLITE_CANDIDATES_QUERY, params)]
+        claimed = [
+            job_id for job_id in candidates
+            if conn.execute(SQLITE_CLAIM_QUERY, {**params, "id": job_id}).rowcount == 1
+        ]
+        if not claimed:
+            return []
+        rows = conn.execute(CLAIMED_QUERY, {"ids": claimed, "worker": worker}).fetchall()
+        return [dict(row._mapping) for row in rows]
+
+
+def heartbeat(worker, job_ids, lease_seconds=JOB_LEASE_SECONDS):
+    """Продление аренды; возвращает id задач, которые все еще за воркером"""
+    if not job_ids:
+        return set()
+    now = datetime.utcnow()
+    params = {
+        "worker": worker,
+        "ids": list(job_ids),
+        "now": now,
+        "expires": now + timedelta(seconds=lease_seconds)
+    }
+    with get_engine().begin() as conn:
+        conn.execute(HEARTBEAT_QUERY, params)
+        rows = conn.execute(CLAIMED_QUERY, params)
+        return {row.id for row in rows}
+
+
+def complete(worker, job_id):
+    """Отметка об успешном выполнении (только владельцем аренды)"""
+    with get_engine().begin() as conn:
+        result = conn.execute(text("""
+            UPDATE crawl_jobs
+            SET status = 'done', finished_at = :now, lease_owner = NULL, lease_expires = NULL
+            WHERE id = :id AND lease_owner = :worker AND status = 'running'
+        """).bindparams(bindparam("now", type_=DateTime)),
+            {"id": job_id, "worker": worker, "now": datetime.utcnow()})
+    return result.rowcount == 1
+
+
+def fail(worker, job, error):
+    """Ошибка задачи: повтор с экспоненциальной задержкой или окончательный отказ"""
+    now = datetime.utcnow()
+    final = job["attempts"] >= JOB_MAX_ATTEMPTS
+    delay = JOB_RETRY_SECONDS * 2 ** (job["attempts"] - 1)
+
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            UPDATE crawl_jobs
+            SET status = :status, run_after = :run_after, last_error = :error,
+                finished_at = :finished_at, lease_owner = NULL, lease_expires = NULL
+            WHERE id = :id AND lease_owner = :worker AND status = 'running'
+        """).bindparams(bindparam("run_after", type_=DateTime), bindparam("finished_at", type_=DateTime)), {
+            "id": job["id"],
+            "worker": worker,
+            "status": "failed" if final else "pending",
+            "run_after": now + timedelta(seconds=delay),
+            "finished_at": now if final else None,
+            "error": str(error)[:1000]
+        })
+
+    if final:
+        logger.error(f"Задача {job['kind']} {job['url']} отменена после {job['attempts']} попыток: {error}")
+    else:
+        logger.warning(f"Задача {job['kind']} {job['url']} будет повторена через {delay} с: {error}")
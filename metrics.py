@@ -0,0 +1,217 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Доля замеров, попадающих в гистограммы (время меряется всегда — это дешево)
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "1.0"))
+# Медленные запросы и загрузки сохраняются целиком, независимо от выборки
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_FETCH_MS = float(os.getenv("SLOW_FETCH_MS", "3000"))
+SLOW_EVENTS_MAX = int(os.getenv("SLOW_EVENTS_MAX", "50"))
+# Порт HTTP-эндпоинта /metrics в формате Prometheus (0 — выключен)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Описания метрик для вывода Prometheus
+DESCRIPTIONS = {
+    "db_query": "Время выполнения SQL-запросов",
+    "handler": "Время обработки команд бота",
+    "telegram_send": "Время отправки сообщений в Telegram",
+    "fetch": "Время загрузки страниц Kaspi",
+    "parse": "Время разбора страниц Kaspi",
+    "chart_data": "Время загрузки данных графика",
+    "chart_render": "Время отрисовки графика"
+}
+
+
+class Histogram:
+    """Гистограмма длительностей с фиксированными корзинами"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (линейно внутри корзины)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+
+_histograms = {}
+_slow_events = deque(maxlen=SLOW_EVENTS_MAX)
+_lock = threading.Lock()
+
+
+def sampled():
+    """Попадает ли текущий замер в выборку"""
+    return METRICS_SAMPLE_RATE >= 1 or random.random() < METRICS_SAMPLE_RATE
+
+
+def observe(name, seconds, **labels):
+    """Запись длительности в гистограмму name с метками labels"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+def record_slow(kind, seconds, detail):
+    """Сохранение медленного события для /stats"""
+    _slow_events.append({
+        "kind": kind,
+        "ms": seconds * 1000,
+        "detail": " ".join(str(detail).split())[:300],
+        "at": time.time()
+    })
+
+
+@contextmanager
+def timed(name, **labels):
+    """Замер блока кода: with timed("chart_render"): ..."""
+    if not sampled():
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def _statement_kind(statement):
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+
+
+def instrument_engine(engine):
+    """Замер всех SQL-запросов движка через события курсора"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        elapsed = time.perf_counter() - started
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            record_slow("sql", elapsed, statement)
+            logger.warning(f"🐢 Медленный запрос {elapsed * 1000:.0f} мс: {' '.join(statement.split())[:200]}")
+        if sampled():
+            observe("db_query", elapsed, statement=_statement_kind(statement))
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # Запрос завершился ошибкой — after_cursor_execute не вызывается
+        started = context.connection.info.get("query_started") if context.connection else None
+        if started:
+            started.pop()
+
+
+def snapshot():
+    """Копия гистограмм: {(name, labels): (count, sum, counts)}"""
+    with _lock:
+        return {
+            key: (h.count, h.sum, list(h.counts))
+            for key, h in _histograms.items()
+        }
+
+
+def summary():
+    """Сводка для /stats: [{name, labels, count, p50, p95, total}]"""
+    rows = []
+    with _lock:
+        for (name, labels), histogram in sorted(_histograms.items()):
+            rows.append({
+                "name": name,
+                "labels": dict(labels),
+                "count": histogram.count,
+                "p50": histogram.quantile(0.5),
+                "p95": histogram.quantile(0.95),
+                "total": histogram.sum
+            })
+    return rows
+
+
+def slow_events(limit=10):
+    """Последние медленные события, самые медленные первыми"""
+    return sorted(_slow_events, key=lambda e: e["ms"], reverse=True)[:limit]
+
+
+def _labels_text(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def render_prometheus():
+    """Все гистограммы в текстовом формате Prometheus"""
+    lines = []
+    described = set()
+    for (name, labels), (count, total, counts) in sorted(snapshot().items()):
+        metric = f"kaspi_{name}_seconds"
+        if metric not in described:
+            described.add(metric)
+            lines.append(f"# HELP {metric} {DESCRIPTIONS.get(name, name)}")
+            lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+            cumulative += bucket_count
+            lines.append(f"{metric}_bucket{_labels_text(labels, ('le', bound))} {cumulative}")
+        lines.append(f"{metric}_sum{_labels_text(labels)} {total}")
+        lines.append(f"{metric}_count{_labels_text(labels)} {count}")
+    lines.append("# HELP kaspi_slow_events Медленные события в буфере")
+    lines.append("# TYPE kaspi_slow_events gauge")
+    lines.append(f"kaspi_slow_events {len(_slow_events)}")
+    lines.append("# HELP kaspi_metrics_sample_rate Доля замеров в гистограммах")
+    lines.append("# TYPE kaspi_metrics_sample_rate gauge")
+    lines.append(f"kaspi_metrics_sample_rate {METRICS_SAMPLE_RATE}")
+    return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(port=METRICS_PORT, host="0.0.0.0"):
+    """HTTP-эндпоинт /metrics в текущем event loop (None, если порт не задан)"""
+    if not port:
+        return None
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"📈 Метрики Prometheus: http://{host}:{port}/metrics")
+    return runner
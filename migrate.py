@@ -0,0 +1,295 @@
+import time
+import logging
+from contextlib import contextmanager
+from sqlalchemy import inspect, text, bindparam, DateTime
+from sqlalchemy.exc import SQLAlchemyError
+from datetime import datetime
+import startup
+from db import get_engine, metadata, products, price_history, ROLLUP_TABLES, refresh_category_metrics
+from history_archive import partition_price_history
+from search import ensure_search_index
+
+logger = logging.getLogger(__name__)
+
+def _bucket_expression(conn, unit):
+    if conn.dialect.name == "postgresql":
+        return f"date_trunc('{unit}', timestamp)"
+    pattern = "%Y-%m-%d %H:00:00.000000" if unit == "hour" else "%Y-%m-%d 00:00:00.000000"
+    return f"strftime('{pattern}', timestamp)"
+
+def backfill_rollups(conn):
+    """Заполнение пустых таблиц агрегатов по существующей истории цен"""
+    for unit, table in ROLLUP_TABLES.items():
+        if conn.execute(text(f"SELECT 1 FROM {table.name} LIMIT 1")).first():
+            continue
+        bucket = _bucket_expression(conn, unit)
+        conn.execute(text(f"""
+            INSERT INTO {table.name} (product_id, bucket, open, high, low, close, samples)
+            SELECT
+                product_id,
+                bucket,
+                MAX(CASE WHEN first_rank = 1 THEN price END),
+                MAX(price),
+                MIN(price),
+                MAX(CASE WHEN last_rank = 1 THEN price END),
+                COUNT(*)
+            FROM (
+                SELECT
+                    product_id,
+                    price,
+                    {bucket} AS bucket,
+                    ROW_NUMBER() OVER (PARTITION BY product_id, {bucket} ORDER BY timestamp ASC) AS first_rank,
+                    ROW_NUMBER() OVER (PARTITION BY product_id, {bucket} ORDER BY timestamp DESC) AS last_rank
+                FROM price_history
+            ) AS observations
+            GROUP BY product_id, bucket
+        """))
+        logger.info(f"✅ Агрегаты {table.name} заполнены по истории цен")
+
+def backfill_category_stats(conn):
+    """Первичное заполнение статистики категорий полным проходом по товарам"""
+    if conn.execute(text("SELECT 1 FROM category_stats LIMIT 1")).first():
+        return
+    conn.execute(text("""
+        INSERT INTO category_stats (category, products, demand, price_sum, priced, updated_at)
+        SELECT
+            category,
+            COUNT(*),
+            COALESCE(SUM(reviews), 0),
+            COALESCE(SUM(price), 0),
+            COUNT(price),
+            :now
+        FROM products
+        WHERE category IS NOT NULL
+        AND category != ''
+        AND is_active = 1
+        GROUP BY category
+    """).bindparams(bindparam("now", type_=DateTime)), {"now": datetime.utcnow()})
+    refresh_category_metrics(conn)
+    logger.info("✅ Статистика категорий заполнена")
+
+def _ensure_column(conn, table, column, ddl_type):
+    """Добавление колонки в существующую таблицу"""
+    columns = [c["name"] for c in inspect(conn).get_columns(table)]
+    if column not in columns:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+        logger.info(f"Добавлена колонка {table}.{column}")
+
+# Ключ advisory-блокировки миграций PostgreSQL (одинаковый у всех реплик)
+MIGRATION_LOCK_KEY = 7201903
+
+@contextmanager
+def _migration_lock(engine):
+    """Миграции выполняет одна реплика за раз, остальные ждут и затем видят готовую схему.
+
+    В PostgreSQL — сессионная advisory-блокировка: ей не нужна таблица,
+    которую еще предстоит создать, и она снимается, если процесс упал.
+    В SQLite записи и так сериализуются блокировкой файла.
+    """
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+def migrate():
+    """Создание схемы, индексов и тестовых данных"""
+    started = time.perf_counter()
+    engine = get_engine()
+    with _migration_lock(engine):
+        _migrate(engine)
+    startup.mark("migrate", time.perf_counter() - started)
+    logger.info("✅ База данных инициализирована успешно")
+
+def _migrate(engine):
+    try:
+        # Создаем таблицы
+        metadata.create_all(engine)
+        logger.info("✅ Таблицы базы данных созданы/проверены")
+        
+        # Создаем индексы для оптимизации
+        with engine.begin() as conn:
+            # Колонки, появившиеся после создания таблиц
+            _ensure_column(conn, "price_history", "last_seen", "TIMESTAMP")
+            
+            # PostgreSQL: месячные секции истории цен (старые месяцы уходят в архив)
+            partition_price_history(conn)
+            
+            # Покрывающий индекс для истории одного товара за период;
+            # отдельный индекс по product_id им заменяется. last_seen в индекс
+            # не входит: он переписывается при каждом обходе
+            if conn.dialect.name == "postgresql":
+                conn.execute(text("""
+                    CREATE INDEX IF NOT EXISTS idx_price_history_product_time 
+                    ON price_history(product_id, timestamp) INCLUDE (price)
+                """))
+            else:
+                conn.execute(text("""
+                    CREATE INDEX IF NOT EXISTS idx_price_history_product_time 
+                    ON price_history(product_id, timestamp, price)
+                """))
+            conn.execute(text("DROP INDEX IF EXISTS idx_price_history_product_id"))
+            
+            # Индекс для сортировки по времени
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_price_history_timestamp 
+                ON price_history(timestamp DESC)
+            """))
+            
+            # Индекс для категорий
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_products_category 
+                ON products(category)
+            """))
+            
+            # Поиск товаров по названию (/search)
+            ensure_search_index(conn)
+            
+            # Индексы для ТОП ниш: чтение первых N строк без сортировки
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_category_stats_demand 
+                ON category_stats(demand DESC, products DESC)
+            """))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_category_stats_score 
+                ON category_stats(score DESC)
+            """))
+            
+            # Индекс очереди обновлений: ближайшие по сроку цели
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_refresh_targets_next_due 
+                ON refresh_targets(next_due)
+            """))
+            
+            # Очередь обхода: выборка готовых задач и не больше одной активной задачи на URL
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_crawl_jobs_ready 
+                ON crawl_jobs(status, run_after)
+            """))
+            conn.execute(text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_crawl_jobs_active_url 
+                ON crawl_jobs(kind, url) WHERE status IN ('pending', 'running')
+            """))
+            
+            # Подписчики товаров пакета и очередь неотправленных уведомлений
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_watches_product_id 
+                ON watches(product_id)
+            """))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_alert_outbox_status 
+                ON alert_outbox(status, id)
+            """))
+            
+            # Очистка общего состояния реплик по времени
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_processed_updates_created_at 
+                ON processed_updates(created_at)
+            """))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_chart_file_ids_created_at 
+                ON chart_file_ids(created_at)
+            """))
+            
+            logger.info("✅ Индексы созданы/проверены")
+        
+        # Добавляем тестовые данные если таблица пуста
+        with engine.begin() as conn:
+            result = conn.execute(text("SELECT COUNT(*) FROM products"))
+            count = result.scalar()
+            
+            if count == 0:
+                logger.info("Добавляю тестовые данные...")
+                
+                # Тестовые товары
+                test_products = [
+                    {
+                        "id": 1,
+                        "name": "Смартфон Apple iPhone 14 Pro Max",
+                        "category": "Смартфоны",
+                        "price": 650000.0,
+                        "rating": 4.8,
+                        "reviews": 1250,
+                        "url": "https://kaspi.kz/shop/p/apple-iphone-14-pro-max-256gb-fioletovyi-106363342/"
+                    },
+                    {
+                        "id": 2,
+                        "name": "Ноутбук Apple MacBook Pro 16",
+                        "category": "Ноутбуки",
+                        "price": 1250000.0,
+                        "rating": 4.9,
+                        "reviews": 840,
+                        "url": "https://kaspi.kz/shop/p/apple-macbook-pro-16-mk183-seryi-102892005/"
+                    },
+                    {
+                        "id": 3,
+                        "name": "Наушники Apple AirPods Pro 2",
+                        "category": "Наушники",
+                        "price": 145000.0,
+                        "rating": 4.7,
+                        "reviews": 3120,
+                        "url": "https://kaspi.kz/shop/p/apple-airpods-pro-2nd-generation-belyi-106662968/"
+                    },
+                    {
+                        "id": 4,
+                        "name": "Смарт-часы Apple Watch Series 8",
+                        "category": "Смарт-часы",
+                        "price": 280000.0,
+                        "rating": 4.6,
+                        "reviews": 1560,
+                        "url": "https://kaspi.kz/shop/p/apple-watch-series-8-45-mm-aluminium-chernyi-106585020/"
+                    },
+                    {
+                        "id": 5,
+                        "name": "Планшет Apple iPad Air 5",
+                        "category": "Планшеты",
+                        "price": 420000.0,
+                        "rating": 4.8,
+                        "reviews": 920,
+                        "url": "https://kaspi.kz/shop/p/apple-ipad-air-5-2022-wi-fi-10-9-64-gb-seryi-104235453/"
+                    }
+                ]
+                
+                # Добавляем товары одним пакетом
+                conn.execute(products.insert(), test_products)
+                
+                # Добавляем историю цен для тестовых товаров
+                import random
+                from datetime import datetime, timedelta
+                
+                history = []
+                for product_id in range(1, 6):
+                    base_price = random.uniform(100000, 1500000)
+                    for days_ago in range(30, 0, -2):
+                        price_date = datetime.utcnow() - timedelta(days=days_ago)
+                        price_change = random.uniform(-0.1, 0.1)  # ±10%
+                        current_price = base_price * (1 + price_change)
+                        
+                        history.append({
+                            "product_id": product_id,
+                            "price": round(current_price, 2),
+                            "timestamp": price_date
+                        })
+                
+                conn.execute(price_history.insert(), history)
+                
+                logger.info(f"✅ Добавлено {len(test_products)} тестовых товаров с историей цен")
+            
+            backfill_rollups(conn)
+            backfill_category_stats(conn)
+        
+    except SQLAlchemyError as e:
+        logger.error(f"❌ Ошибка SQL при инициализации базы данных: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"❌ Неизвестная ошибка при инициализации базы данных: {e}")
+        raise
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate()
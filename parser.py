@@ -1,36 +1,627 @@
-import requests
-from bs4 import BeautifulSoup
+import os
+import re
+import json
+import zlib
+import sqlite3
+import hashlib
+import threading
+import asyncio
+import aiohttp
+from io import BytesIO
+from functools import partial
+from lxml import etree
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urljoin, urlsplit, urlunsplit
 import logging
 import time
-import random
+import metrics
 
 logger = logging.getLogger(__name__)
 
-def parse_category(url):
-    """Парсинг категорий с Kaspi"""
-    try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+}
+
+# Настройки краулера
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "8"))
+CRAWL_RATE = float(os.getenv("CRAWL_RATE", "2"))  # запросов в секунду на хост
+CRAWL_BURST = int(os.getenv("CRAWL_BURST", "4"))
+CRAWL_TIMEOUT = int(os.getenv("CRAWL_TIMEOUT", "30"))
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 2)))
+PARSE_MAX_PAGES = int(os.getenv("PARSE_MAX_PAGES", "100"))
+
+# Дисковый кеш ответов (пустой путь отключает кеш)
+HTTP_CACHE_PATH = os.getenv("HTTP_CACHE_PATH", "http_cache.db")
+HTTP_CACHE_MAX_MB = int(os.getenv("HTTP_CACHE_MAX_MB", "256"))
+
+_parse_pool = None
+_response_cache = None
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов (token bucket)"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ожидание свободного токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostRateLimiter:
+    """Отдельный token bucket для каждого хоста"""
+
+    def __init__(self, rate=CRAWL_RATE, capacity=CRAWL_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+
+    async def acquire(self, url):
+        host = urlsplit(url).netloc
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets[host] = TokenBucket(self.rate, self.capacity)
+        await bucket.acquire()
+
+
+class ResponseCache:
+    """Дисковый LRU-кеш HTTP-ответов с валидаторами ETag / Last-Modified.
+
+    Тела хранятся сжатыми, вместе с хешем содержимого и результатами разбора
+    (meta), чтобы неизмененные страницы не разбирались повторно.
+    """
+
+    def __init__(self, path=HTTP_CACHE_PATH, max_bytes=HTTP_CACHE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                meta TEXT NOT NULL DEFAULT '{}',
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)"
+        )
+        self.total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, url):
+        """Запись кеша (без распаковки тела) или None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, hash, etag, last_modified, meta FROM responses WHERE url = ?",
+                (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url)
+            )
+        return {
+            "body": row[0],
+            "hash": row[1],
+            "etag": row[2],
+            "last_modified": row[3],
+            "meta": json.loads(row[4])
         }
-        
-        logger.info(f"Парсинг категории: {url}")
-        
-        response = requests.get(url, headers=headers, timeout=30)
-        soup = BeautifulSoup(response.text, "lxml")
-        categories = []
-        
-        for a in soup.select("a[href]"):
-            link = a.get("href")
+
+    def put(self, url, html, digest, etag=None, last_modified=None):
+        """Сохранение нового содержимого страницы (meta сбрасывается)"""
+        body = zlib.compress(html.encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(url, body, size, hash, etag, last_modified, meta, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, '{}', ?, ?)",
+                (url, body, len(body), digest, etag, last_modified, now, now)
+            )
+            self.total += len(body) - (old[0] if old else 0)
+            self._evict()
+
+    def revalidated(self, url, etag=None, last_modified=None):
+        """Обновление валидаторов для неизмененной страницы"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE responses SET etag = COALESCE(?, etag), "
+                "last_modified = COALESCE(?, last_modified), fetched_at = ? WHERE url = ?",
+                (etag, last_modified, time.time(), url)
+            )
+
+    def set_meta(self, url, kind, value):
+        """Сохранение результата разбора страницы для потребителя kind"""
+        with self._lock:
+            row = self._conn.execute("SELECT meta FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return
+            meta = json.loads(row[0])
+            meta[kind] = value
+            self._conn.execute(
+                "UPDATE responses SET meta = ? WHERE url = ?", (json.dumps(meta), url)
+            )
+
+    def _evict(self):
+        if self.total <= self.max_bytes:
+            return
+        evicted = []
+        for url, size in self._conn.execute(
+            "SELECT url, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            if self.total <= self.max_bytes:
+                break
+            evicted.append((url,))
+            self.total -= size
+        self._conn.executemany("DELETE FROM responses WHERE url = ?", evicted)
+        logger.info(f"Кеш ответов: вытеснено {len(evicted)} записей")
+
+    @staticmethod
+    def decode(entry):
+        return zlib.decompress(entry["body"]).decode("utf-8")
+
+
+def get_response_cache():
+    """Общий дисковый кеш ответов (None, если отключен)"""
+    global _response_cache
+    if _response_cache is None and HTTP_CACHE_PATH:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+
+def create_session(concurrency=CRAWL_CONCURRENCY):
+    """HTTP-сессия с пулом keep-alive соединений"""
+    connector = aiohttp.TCPConnector(
+        limit=concurrency,
+        limit_per_host=concurrency,
+        ttl_dns_cache=300,
+        keepalive_timeout=30
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=HEADERS,
+        timeout=aiohttp.ClientTimeout(total=CRAWL_TIMEOUT)
+    )
+
+
+def normalize_url(link, base_url):
+    """Абсолютный URL без query и fragment"""
+    parts = urlsplit(urljoin(base_url, link))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, "", ""))
+
+
+def _classes(el):
+    return el.get("class", "").split()
+
+
+def _text(el):
+    return " ".join("".join(el.itertext()).split())
+
+
+def _digits(value):
+    digits = re.sub(r"\D", "", value or "")
+    return int(digits) if digits else None
+
+
+def _parse_rating(el):
+    # Рейтинг хранится в классе: "rating _small _45" -> 4.5
+    for cls in _classes(el):
+        if re.fullmatch(r"_\d{1,2}", cls):
+            return int(cls[1:]) / 10
+    return None
+
+
+def _parse_product_id(card, url):
+    product_id = card.get("data-product-id")
+    if product_id and product_id.isdigit():
+        return int(product_id)
+    match = re.search(r"-(\d+)/?$", urlsplit(url).path)
+    return int(match.group(1)) if match else None
+
+
+def _parse_card(card, base_url, category):
+    """Данные товара из карточки листинга"""
+    product = {
+        "id": None,
+        "name": None,
+        "category": category,
+        "price": None,
+        "rating": None,
+        "reviews": 0,
+        "url": None
+    }
+
+    for el in card.iter("a", "span", "div"):
+        classes = _classes(el)
+        if "item-card__name-link" in classes:
+            product["name"] = _text(el)
+            product["url"] = normalize_url(el.get("href", ""), base_url)
+        elif "item-card__prices-price" in classes and product["price"] is None:
+            price = _digits(_text(el))
+            product["price"] = float(price) if price is not None else None
+        elif "rating" in classes:
+            product["rating"] = _parse_rating(el)
+        elif "item-card__rating" in classes:
+            reviews = _digits(_text(el))
+            product["reviews"] = reviews or 0
+
+    if not product["name"] or not product["url"]:
+        return None
+    product["id"] = _parse_product_id(card, product["url"])
+    if product["id"] is None:
+        return None
+    return product
+
+
+def parse_listing(html, base_url):
+    """Потоковый разбор страницы листинга: товары, категории и пагинация.
+
+    Дерево целиком не строится: lxml отдает элементы по мере закрытия тегов,
+    а обработанные карточки товаров сразу освобождаются.
+    """
+    host = urlsplit(base_url).netloc
+    category = None
+    products = []
+    categories = []
+    has_next = False
+    in_card = 0
+
+    events = etree.iterparse(
+        BytesIO(html.encode("utf-8")),
+        events=("start", "end"),
+        tag=("a", "div", "h1", "li"),
+        html=True,
+        encoding="utf-8",
+        recover=True
+    )
+
+    for event, el in events:
+        classes = _classes(el)
+        is_card = el.tag == "div" and "item-card" in classes
+
+        if event == "start":
+            if is_card:
+                in_card += 1
+            continue
+
+        if is_card:
+            in_card -= 1
+            product = _parse_card(el, base_url, category or _category_from_url(base_url))
+            if product:
+                products.append(product)
+            # Освобождаем память от разобранной карточки
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+        elif in_card:
+            continue
+        elif el.tag == "h1" and category is None:
+            category = _text(el) or None
+        elif el.tag == "a":
+            link = el.get("href") or ""
             if "/shop/c/" in link:
-                categories.append(link)
-        
-        time.sleep(1)
-        
-        unique_categories = list(set(categories))
+                url = normalize_url(link, base_url)
+                if urlsplit(url).netloc == host:
+                    categories.append(url)
+        elif el.tag == "li" and "pagination__el" in classes:
+            if "Следующая" in _text(el) and "_disabled" not in classes:
+                has_next = True
+
+    return {
+        "category": category or _category_from_url(base_url),
+        "products": products,
+        "categories": categories,
+        "has_next": has_next
+    }
+
+
+def _category_from_url(url):
+    segments = [s for s in urlsplit(url).path.split("/") if s]
+    return segments[-1] if segments else None
+
+
+def extract_category_links(html, base_url):
+    """Ссылки на категории со страницы"""
+    return parse_listing(html, base_url)["categories"]
+
+
+def get_parse_pool():
+    """Пул процессов для CPU-bound разбора HTML"""
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    return _parse_pool
+
+
+async def parse_in_pool(html, base_url):
+    """Разбор страницы в пуле процессов, не блокируя загрузку"""
+    loop = asyncio.get_running_loop()
+    with metrics.timed("parse"):
+        return await loop.run_in_executor(get_parse_pool(), parse_listing, html, base_url)
+
+
+def _record_fetch(url, status, started):
+    elapsed = time.perf_counter() - started
+    if elapsed * 1000 >= metrics.SLOW_FETCH_MS:
+        metrics.record_slow("fetch", elapsed, url)
+    if metrics.sampled():
+        metrics.observe("fetch", elapsed, host=urlsplit(url).netloc, status=str(status))
+
+
+async def fetch_html(session, url, limiter):
+    """Загрузка страницы с учетом ограничения частоты"""
+    html, _ = await fetch_page(session, url, limiter)
+    return html
+
+
+def _store_response(cache, entry, url, html, kind, etag, last_modified):
+    """Сравнение с кешем и запись новой версии страницы: meta потребителя
+    kind, если содержимое не изменилось, иначе None"""
+    digest = hashlib.sha256(html.encode("utf-8")).hexdigest()
+    if entry and entry["hash"] == digest:
+        cache.revalidated(url, etag, last_modified)
+        return entry["meta"].get(kind)
+    cache.put(url, html, digest, etag, last_modified)
+    return None
+
+
+async def fetch_page(session, url, limiter, cache=None, kind=None):
+    """Загрузка страницы с условной ревалидацией через кеш.
+
+    Возвращает (html, meta). meta не None, если страница не изменилась
+    с прошлого разбора потребителем kind — тогда разбор можно пропустить.
+    Запросы к кешу (sqlite3, zlib) идут в потоке, не блокируя остальные загрузки.
+    """
+    entry = await asyncio.to_thread(cache.get, url) if cache else None
+    headers = {}
+    if entry:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        await limiter.acquire(url)
+        # Ожидание лимитера в замер не входит
+        started = time.perf_counter()
+        async with session.get(url, headers=headers) as response:
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if response.status != 200:
+                _record_fetch(url, response.status, started)
+            if response.status == 304 and entry:
+                await asyncio.to_thread(cache.revalidated, url, etag, last_modified)
+                meta = entry["meta"].get(kind)
+                if meta is not None:
+                    return None, meta
+                return await asyncio.to_thread(cache.decode, entry), None
+            if response.status != 200:
+                logger.warning(f"Статус {response.status} для {url}")
+                return None, None
+            html = await response.text()
+            _record_fetch(url, response.status, started)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки {url}: {e}")
+        return None, None
+
+    if cache is None:
+        return html, None
+    return html, await asyncio.to_thread(_store_response, cache, entry, url, html, kind, etag, last_modified)
+
+
+async def crawl_categories(start_urls, concurrency=CRAWL_CONCURRENCY, rate=CRAWL_RATE,
+                           burst=CRAWL_BURST, max_depth=None, session=None, cache=None,
+                           limiter=None):
+    """Обход дерева категорий в ширину, URL отдаются по мере нахождения"""
+    limiter = limiter or HostRateLimiter(rate, burst)
+    cache = cache or get_response_cache()
+    own_session = session is None
+    if own_session:
+        session = create_session(concurrency)
+
+    seen = set()
+    frontier = asyncio.Queue()
+    found = asyncio.Queue(maxsize=concurrency * 16)
+
+    for url in start_urls:
+        url = normalize_url(url, url)
+        if url not in seen:
+            seen.add(url)
+            frontier.put_nowait((url, 0))
+
+    async def worker():
+        while True:
+            url, depth = await frontier.get()
+            try:
+                html, links = await fetch_page(session, url, limiter, cache, "categories")
+                if links is None:
+                    if not html:
+                        continue
+                    links = (await parse_in_pool(html, url))["categories"]
+                    if cache:
+                        await asyncio.to_thread(cache.set_meta, url, "categories", links)
+                for link in links:
+                    if link in seen:
+                        continue
+                    seen.add(link)
+                    await found.put(link)
+                    if max_depth is None or depth < max_depth:
+                        frontier.put_nowait((link, depth + 1))
+            except Exception as e:
+                logger.error(f"Ошибка парсинга {url}: {e}")
+            finally:
+                frontier.task_done()
+
+    async def finish():
+        await frontier.join()
+        await found.put(None)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    tasks.append(asyncio.create_task(finish()))
+
+    count = 0
+    try:
+        while True:
+            link = await found.get()
+            if link is None:
+                break
+            count += 1
+            yield link
+        logger.info(f"Обход завершен, найдено {count} уникальных категорий")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if own_session:
+            await session.close()
+
+
+def page_url(url, page):
+    """URL страницы листинга с номером"""
+    return url if page <= 1 else f"{url}?page={page}"
+
+
+def page_marker(url, committed=None, product_ids=()):
+    """Отметка конца страницы в потоке товаров (у товаров нет ключа "page").
+
+    Потребитель вызывает committed() после коммита товаров страницы:
+    только тогда страница считается разобранной. product_ids — товары
+    неизменной страницы: их наблюдение продлевается без разбора.
+    """
+    return {"page": url, "committed": committed, "product_ids": list(product_ids)}
+
+
+async def iter_category_products(category_url, session=None, max_pages=PARSE_MAX_PAGES,
+                                 limiter=None, cache=None, stats=None):
+    """Обход страниц категории, товары отдаются по одному.
+
+    Страницы, не изменившиеся с прошлого обхода, не разбираются: вместо
+    товаров отдается page_marker с их id из кеша, и ingest только продлевает
+    их наблюдение. После товаров каждой разобранной страницы тоже отдается
+    page_marker. В stats (если передан)
+    записываются число загруженных страниц и название категории.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault("pages", 0)
+    limiter = limiter or HostRateLimiter()
+    cache = cache or get_response_cache()
+    own_session = session is None
+    if own_session:
+        session = create_session()
+
+    category_url = normalize_url(category_url, category_url)
+    seen = set()
+    unchanged = 0
+    try:
+        for number in range(1, max_pages + 1):
+            url = page_url(category_url, number)
+            html, meta = await fetch_page(session, url, limiter, cache, "listing")
+            stats["pages"] += 1
+            if meta is not None:
+                unchanged += 1
+                yield page_marker(url, product_ids=meta["ids"])
+                if not meta["has_next"]:
+                    break
+                continue
+            if not html:
+                break
+
+            page = await parse_in_pool(html, category_url)
+            stats.setdefault("category", page["category"])
+            new_products = [p for p in page["products"] if p["id"] not in seen]
+            if not new_products:
+                break
+
+            for product in new_products:
+                seen.add(product["id"])
+                yield product
+
+            # Если запись пакета не удастся, страница будет разобрана снова
+            if cache:
+                meta = {"has_next": page["has_next"], "ids": [p["id"] for p in page["products"]]}
+                yield page_marker(url, partial(cache.set_meta, url, "listing", meta))
+            if not page["has_next"]:
+                break
+
+        logger.info(
+            f"Категория {category_url}: получено {len(seen)} товаров, "
+            f"без изменений {unchanged} страниц"
+        )
+    finally:
+        if own_session:
+            await session.close()
+
+
+async def crawl_products(start_urls, concurrency=CRAWL_CONCURRENCY):
+    """Товары всех найденных категорий единым потоком"""
+    queue = asyncio.Queue(maxsize=concurrency * 64)
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = HostRateLimiter()
+
+    async with create_session(concurrency) as session:
+        async def walk(url):
+            async with semaphore:
+                async for product in iter_category_products(url, session=session, limiter=limiter):
+                    await queue.put(product)
+
+        async def produce():
+            tasks = []
+            try:
+                async for url in crawl_categories(start_urls, concurrency, session=session,
+                                                  limiter=limiter):
+                    tasks.append(asyncio.create_task(walk(url)))
+                await asyncio.gather(*tasks, return_exceptions=True)
+            except Exception as e:
+                logger.error(f"Ошибка обхода каталога: {e}")
+            finally:
+                for task in tasks:
+                    task.cancel()
+            await queue.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                product = await queue.get()
+                if product is None:
+                    break
+                yield product
+        finally:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+
+
+async def _collect(stream):
+    return [item async for item in stream]
+
+
+def parse_category(url):
+    """Парсинг категорий с Kaspi (синхронная обертка над crawl_categories)"""
+    logger.info(f"Парсинг категории: {url}")
+    try:
+        unique_categories = asyncio.run(_collect(crawl_categories([url], max_depth=0)))
         logger.info(f"Найдено {len(unique_categories)} уникальных категорий")
-        
         return unique_categories
-        
     except Exception as e:
         logger.error(f"Ошибка парсинга {url}: {e}")
-        return []
\ No newline at end of file
+        return []
@@ -0,0 +1,236 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import text, bindparam, DateTime
+from db import get_engine
+from parser import crawl_categories
+from jobs import enqueue
+
+logger = logging.getLogger(__name__)
+
+# Общий бюджет краулера: запросов (страниц) в минуту
+REFRESH_BUDGET_RPM = float(os.getenv("REFRESH_BUDGET_RPM", "60"))
+# Границы интервала обновления одной категории
+REFRESH_MIN_MINUTES = float(os.getenv("REFRESH_MIN_MINUTES", "30"))
+REFRESH_MAX_MINUTES = float(os.getenv("REFRESH_MAX_MINUTES", "1440"))
+# Окно, по которому считаются сигналы
+SIGNAL_WINDOW_DAYS = 7
+# Оценка числа страниц для еще не обойденной категории
+DEFAULT_PAGES = 5
+
+# Веса сигналов: волатильность цен, рост отзывов, интерес пользователей
+WEIGHTS = {"volatility": 0.4, "velocity": 0.3, "interest": 0.3}
+
+TARGETS_QUERY = text("""
+    SELECT t.url, t.category, t.demand_at_refresh, t.last_refreshed, s.demand
+    FROM refresh_targets t
+    LEFT JOIN category_stats s ON s.category = t.category
+""").columns(last_refreshed=DateTime)
+
+# Число изменений цены на товар за окно (история хранит только изменения)
+VOLATILITY_QUERY = text("""
+    SELECT p.category AS category, CAST(COUNT(*) AS FLOAT) / MAX(s.products) AS value
+    FROM price_history h
+    JOIN products p ON p.id = h.product_id
+    JOIN category_stats s ON s.category = p.category
+    WHERE h.timestamp >= :since AND s.products > 0
+    GROUP BY p.category
+""").bindparams(bindparam("since", type_=DateTime))
+
+INTEREST_QUERY = text("""
+    SELECT p.category AS category, SUM(t.hits) AS value
+    FROM trend_hits t
+    JOIN products p ON p.id = t.product_id
+    WHERE t.day >= :since
+    GROUP BY p.category
+""").bindparams(bindparam("since", type_=DateTime))
+
+# Цели с задачей в очереди или в работе пропускаются: enqueue все равно не
+# поставит повтор, а бюджет тратится только на новые обходы
+DUE_QUERY = text("""
+    SELECT t.url, t.score, t.interval_minutes, t.pages, t.next_due
+    FROM refresh_targets t
+    WHERE t.next_due <= :now
+      AND NOT EXISTS (
+          SELECT 1 FROM crawl_jobs j
+          WHERE j.kind = 'category' AND j.url = t.url AND j.status IN ('pending', 'running')
+      )
+    ORDER BY t.next_due
+    LIMIT :limit
+""").bindparams(bindparam("now", type_=DateTime)).columns(next_due=DateTime)
+
+
+def _normalize(values):
+    top = max(values.values(), default=0)
+    if not top:
+        return {key: 0.0 for key in values}
+    return {key: value / top for key, value in values.items()}
+
+
+def update_scores():
+    """Пересчет приоритета и интервала обновления для всех категорий.
+
+    Цель обновления — категория: товары видны только на страницах списка
+    (страницы товара не разбираются), поэтому сигналы товаров — изменения
+    цен и запросы /trend — поднимают приоритет их категорий.
+    """
+    now = datetime.utcnow()
+    since = now - timedelta(days=SIGNAL_WINDOW_DAYS)
+
+    with get_engine().begin() as conn:
+        targets = conn.execute(TARGETS_QUERY).fetchall()
+        if not targets:
+            return 0
+        volatility = {r.category: r.value for r in conn.execute(VOLATILITY_QUERY, {"since": since})}
+        interest = {r.category: r.value for r in conn.execute(INTEREST_QUERY, {"since": since})}
+
+        # Рост отзывов в час с прошлого обновления
+        velocity = {}
+        for target in targets:
+            if target.last_refreshed and target.demand is not None and target.demand_at_refresh is not None:
+                hours = max((now - target.last_refreshed).total_seconds() / 3600, 1)
+                velocity[target.url] = max(target.demand - target.demand_at_refresh, 0) / hours
+
+        signals = {
+            "volatility": _normalize({t.url: volatility.get(t.category) or 0 for t in targets}),
+            "velocity": _normalize({t.url: velocity.get(t.url, 0) for t in targets}),
+            "interest": _normalize({t.url: interest.get(t.category) or 0 for t in targets})
+        }
+
+        updates = []
+        for target in targets:
+            score = sum(WEIGHTS[name] * signals[name][target.url] for name in WEIGHTS)
+            interval = REFRESH_MAX_MINUTES - (REFRESH_MAX_MINUTES - REFRESH_MIN_MINUTES) * score
+            next_due = target.last_refreshed + timedelta(minutes=interval) if target.last_refreshed else now
+            updates.append({"url": target.url, "score": score, "interval": interval, "next_due": next_due})
+
+        conn.execute(text("""
+            UPDATE refresh_targets
+            SET score = :score, interval_minutes = :interval, next_due = :next_due
+            WHERE url = :url
+        """).bindparams(bindparam("next_due", type_=DateTime)), updates)
+
+    logger.info(f"Приоритеты обновлены для {len(updates)} категорий")
+    return len(updates)
+
+
+class RefreshPlanner:
+    """Очередь обновлений по приоритету в рамках бюджета запросов в минуту.
+
+    Бюджет хранится в памяти процесса: он общий, пока plan() вызывает одна
+    реплика — шаг планировщика выполняется под арендой (scheduler.leader_only).
+    """
+
+    def __init__(self, rpm=REFRESH_BUDGET_RPM):
+        self.rpm = rpm
+        self.capacity = rpm * 2
+        self.tokens = rpm
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) / 60 * self.rpm)
+        self.updated = now
+
+    def plan(self, now=None):
+        """Выбор целей на текущий шаг: самые приоритетные, пока хватает бюджета"""
+        now = now or datetime.utcnow()
+        self._refill()
+
+        with get_engine().connect() as conn:
+            due = conn.execute(DUE_QUERY, {"now": now, "limit": int(self.capacity) + 1}).fetchall()
+
+        # Приоритет растет с оценкой и с просрочкой относительно своего интервала
+        queue = []
+        for row in due:
+            interval = row.interval_minutes or REFRESH_MAX_MINUTES
+            overdue = (now - row.next_due).total_seconds() / 60
+            priority = ((row.score or 0) + 0.1) * (1 + overdue / interval)
+            heapq.heappush(queue, (-priority, row.url, row.pages or DEFAULT_PAGES, interval))
+
+        planned = []
+        while queue:
+            priority, url, pages, interval = heapq.heappop(queue)
+            # Слишком дорогая цель не должна блокировать очередь навсегда
+            if pages > self.tokens and (planned or self.tokens < self.rpm):
+                break
+            self.tokens -= pages
+            planned.append({"url": url, "interval": interval, "priority": -priority})
+        return planned
+
+
+def record_refresh(url, stats):
+    """Запись результатов обхода категории: число страниц, категория, спрос"""
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            UPDATE refresh_targets
+            SET category = COALESCE(:category, category),
+                pages = :pages,
+                last_refreshed = :now,
+                demand_at_refresh = (
+                    SELECT demand FROM category_stats
+                    WHERE category = COALESCE(:category, refresh_targets.category)
+                )
+            WHERE url = :url
+        """).bindparams(bindparam("now", type_=DateTime)), {
+            "url": url,
+            "category": stats.get("category"),
+            "pages": max(stats.get("pages", 0), 1),
+            "now": datetime.utcnow()
+        })
+
+
+async def discover_targets(start_urls):
+    """Поиск категорий каталога и регистрация новых целей обновления"""
+    found = 0
+    batch = []
+
+    def save(urls):
+        with get_engine().begin() as conn:
+            conn.execute(text("""
+                INSERT INTO refresh_targets (url, score, next_due, created_at)
+                VALUES (:url, 0, :now, :now)
+                ON CONFLICT (url) DO NOTHING
+            """).bindparams(bindparam("now", type_=DateTime)),
+                [{"url": url, "now": datetime.utcnow()} for url in urls])
+
+    async for url in crawl_categories(start_urls):
+        batch.append(url)
+        found += 1
+        if len(batch) >= 500:
+            await asyncio.to_thread(save, batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(save, batch)
+
+    logger.info(f"Найдено {found} категорий для планировщика")
+    return found
+
+
+planner = RefreshPlanner()
+
+
+def enqueue_planned_refreshes():
+    """Шаг планировщика: самые приоритетные категории в рамках бюджета уходят в очередь обхода"""
+    try:
+        targets = planner.plan()
+        if not targets:
+            return 0
+        now = datetime.utcnow()
+        enqueue([{"kind": "category", "url": t["url"], "priority": t["priority"]} for t in targets])
+        # Следующий срок назначается сразу: задача уже в очереди у воркеров
+        with get_engine().begin() as conn:
+            conn.execute(text("""
+                UPDATE refresh_targets SET next_due = :next_due WHERE url = :url
+            """).bindparams(bindparam("next_due", type_=DateTime)), [
+                {"url": t["url"], "next_due": now + timedelta(minutes=t["interval"])}
+                for t in targets
+            ])
+        logger.info(f"В очередь обхода поставлено {len(targets)} категорий")
+        return len(targets)
+    except Exception as e:
+        logger.error(f"Ошибка шага планировщика: {e}")
+        return 0
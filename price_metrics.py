@@ -0,0 +1,194 @@
+import os
+import logging
+import warnings
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import text, bindparam, DateTime, Float
+from db import get_engine
+
+logger = logging.getLogger(__name__)
+
+# Товаров в одном запросе загрузки рядов
+PRICE_BATCH_SIZE = int(os.getenv("PRICE_BATCH_SIZE", "500"))
+# Скидка: цена ниже медианы за DISCOUNT_WINDOW_DAYS дней хотя бы на DISCOUNT_THRESHOLD
+DISCOUNT_WINDOW_DAYS = 30
+DISCOUNT_THRESHOLD = float(os.getenv("DISCOUNT_THRESHOLD", "0.1"))
+# Окна изменения цены, дни
+CHANGE_WINDOWS = (7, 30, 90)
+
+# Дневные цены закрытия в окне и последняя цена до окна — одним запросом на пакет
+SERIES_QUERY = text("""
+    SELECT product_id, bucket, close FROM price_rollup_daily
+    WHERE product_id IN :ids AND bucket >= :since AND bucket <= :until
+    UNION ALL
+    SELECT r.product_id, r.bucket, r.close
+    FROM price_rollup_daily r
+    JOIN (
+        SELECT product_id, MAX(bucket) AS bucket FROM price_rollup_daily
+        WHERE product_id IN :ids AND bucket < :since
+        GROUP BY product_id
+    ) previous ON previous.product_id = r.product_id AND previous.bucket = r.bucket
+""").bindparams(
+    bindparam("ids", expanding=True),
+    bindparam("since", type_=DateTime),
+    bindparam("until", type_=DateTime)
+).columns(bucket=DateTime, close=Float)
+
+
+def load_price_matrix(product_ids, days=90, until=None):
+    """Матрица дневных цен [товар, день] за последние days дней.
+
+    Между наблюдениями цена продлевается (история хранит только изменения),
+    до первого наблюдения — NaN. Возвращает (даты datetime64[D], матрица).
+    """
+    until = (until or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+    since = until - timedelta(days=days - 1)
+    start = np.datetime64(since.date(), "D")
+    dates = start + np.arange(days)
+    matrix = np.full((len(product_ids), days), np.nan)
+    rows_of = {product_id: index for index, product_id in enumerate(product_ids)}
+
+    product_column, day_column, price_column = [], [], []
+    with get_engine().connect() as conn:
+        for offset in range(0, len(product_ids), PRICE_BATCH_SIZE):
+            batch = list(product_ids[offset:offset + PRICE_BATCH_SIZE])
+            params = {"ids": batch, "since": since, "until": until}
+            for product_id, bucket, close in conn.execute(SERIES_QUERY, params):
+                product_column.append(rows_of[product_id])
+                day_column.append(bucket.date())
+                price_column.append(close)
+
+    if product_column:
+        rows = np.array(product_column)
+        columns = (np.array(day_column, dtype="datetime64[D]") - start).astype(int)
+        prices = np.array(price_column, dtype=float)
+        # Сначала цены до окна (в первый день), затем наблюдения окна поверх них
+        carried = columns < 0
+        matrix[rows[carried], 0] = prices[carried]
+        matrix[rows[~carried], columns[~carried]] = prices[~carried]
+
+    return dates, forward_fill(matrix)
+
+
+def forward_fill(matrix):
+    """Продление последнего известного значения вдоль строки"""
+    known = ~np.isnan(matrix)
+    index = np.where(known, np.arange(matrix.shape[1]), 0)
+    np.maximum.accumulate(index, axis=1, out=index)
+    return matrix[np.arange(matrix.shape[0])[:, None], index]
+
+
+def moving_average(matrix, window):
+    """Скользящее среднее за window дней (NaN пропускаются)"""
+    values = np.nan_to_num(matrix)
+    counts = (~np.isnan(matrix)).astype(float)
+    pad = np.zeros((matrix.shape[0], 1))
+    sums = np.cumsum(np.hstack([pad, values]), axis=1)
+    totals = np.cumsum(np.hstack([pad, counts]), axis=1)
+    lagged = np.maximum(np.arange(1, matrix.shape[1] + 1) - window, 0)
+    window_sums = sums[:, 1:] - sums[:, lagged]
+    window_counts = totals[:, 1:] - totals[:, lagged]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(window_counts > 0, window_sums / window_counts, np.nan)
+
+
+def daily_returns(matrix):
+    """Дневные относительные изменения цены"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.diff(matrix, axis=1) / matrix[:, :-1]
+
+
+def volatility(matrix, window=30):
+    """Стандартное отклонение дневных изменений за последние window дней"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanstd(daily_returns(matrix)[:, -window:], axis=1)
+
+
+def max_drawdown(matrix):
+    """Наибольшее падение от предыдущего максимума (отрицательная доля)"""
+    peaks = np.fmax.accumulate(matrix, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmin(matrix / peaks - 1, axis=1)
+
+
+def change(matrix, window):
+    """Изменение цены за window дней (доля)"""
+    window = min(window, matrix.shape[1] - 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return matrix[:, -1] / matrix[:, -1 - window] - 1
+
+
+def discounts(matrix, window=DISCOUNT_WINDOW_DAYS, threshold=DISCOUNT_THRESHOLD):
+    """Скидка относительно медианы прошлых window дней и признак реальной скидки"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        reference = np.nanmedian(matrix[:, -window - 1:-1], axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        discount = 1 - matrix[:, -1] / reference
+    return discount, discount >= threshold
+
+
+def _value(x):
+    return None if np.isnan(x) else float(x)
+
+
+def compute_metrics(product_ids, days=90, until=None):
+    """Производные метрики цен для набора товаров: {id: {...}}"""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+    _, matrix = load_price_matrix(product_ids, days, until)
+    return _metrics(product_ids, matrix, days)
+
+
+def _metrics(product_ids, matrix, days):
+    ma7 = moving_average(matrix, 7)[:, -1]
+    ma30 = moving_average(matrix, 30)[:, -1]
+    vol = volatility(matrix)
+    drawdown = max_drawdown(matrix)
+    changes = {w: change(matrix, w) for w in CHANGE_WINDOWS if w < days}
+    discount, is_discount = discounts(matrix)
+
+    result = {}
+    for index, product_id in enumerate(product_ids):
+        if np.isnan(matrix[index, -1]):
+            result[product_id] = None
+            continue
+        result[product_id] = {
+            "price": float(matrix[index, -1]),
+            "ma7": _value(ma7[index]),
+            "ma30": _value(ma30[index]),
+            "volatility": _value(vol[index]),
+            "max_drawdown": _value(drawdown[index]),
+            "change": {f"{w}d": _value(values[index]) for w, values in changes.items()},
+            "discount": _value(discount[index]),
+            "is_discount": bool(is_discount[index])
+        }
+    return result
+
+
+def compare_data(product_ids, days=90):
+    """Данные для /compare: даты, ряды, названия и метрики товаров с историей"""
+    dates, matrix = load_price_matrix(product_ids, days)
+    with get_engine().connect() as conn:
+        names = dict(conn.execute(
+            text("SELECT id, name FROM products WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+            {"ids": list(product_ids)}
+        ).fetchall())
+    metrics = _metrics(product_ids, matrix, days)
+
+    found = [i for i, product_id in enumerate(product_ids) if metrics.get(product_id)]
+    if not found:
+        return None
+    return {
+        "dates": dates.astype("datetime64[s]").tolist(),
+        "series": [
+            (f"{names.get(product_ids[i], 'Товар')[:40]} ({product_ids[i]})", matrix[i])
+            for i in found
+        ],
+        "metrics": {product_ids[i]: metrics[product_ids[i]] for i in found},
+        "names": {product_ids[i]: names.get(product_ids[i], "Товар") for i in found},
+        "missing": [product_id for product_id in product_ids if not metrics.get(product_id)]
+    }
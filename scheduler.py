@@ -1,48 +1,131 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+import os
+import socket
+import asyncio
 import logging
-from db import engine
-import random
+from functools import wraps
 from datetime import datetime
+from parser import crawl_products
+from ingest import ingest_stream
+from planner import update_scores, enqueue_planned_refreshes
+from jobs import enqueue
+from shared_state import prune_shared_state, acquire_lease
+from history_archive import maintain_history
 
 logger = logging.getLogger(__name__)
 
+# Стартовые страницы каталога, через запятую
+KASPI_START_URLS = [
+    url.strip()
+    for url in os.getenv("KASPI_START_URLS", "https://kaspi.kz/shop/c/categories/").split(",")
+    if url.strip()
+]
+
+# Поиск новых категорий и пересчет приоритетов обновления
+DISCOVERY_HOURS = int(os.getenv("DISCOVERY_HOURS", "24"))
+SCORE_REFRESH_MINUTES = int(os.getenv("SCORE_REFRESH_MINUTES", "30"))
+
 scheduler = BackgroundScheduler()
 
+# Владелец аренд задач планировщика
+SCHEDULER_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+def leader_only(name, func, seconds):
+    """Задача планировщика под арендой: при нескольких репликах ее выполняет одна.
+
+    Аренда на полтора интервала задачи продлевается при каждом запуске,
+    поэтому задача остается у одной реплики, пока та жива; после ее
+    остановки задачу подхватит другая.
+    """
+    @wraps(func)
+    def job():
+        try:
+            if not acquire_lease(f"job:{name}", SCHEDULER_OWNER, seconds):
+                return None
+        except Exception as e:
+            logger.error(f"Ошибка захвата аренды задачи {name}: {e}")
+            return None
+        return func()
+    return job
+
 def update_all_categories():
     """Обновление данных из всех категорий"""
     try:
         logger.info("Запуск обновления данных...")
         
-        # Здесь должен быть реальный парсинг
-        # Для примера обновляем тестовые данные
-        
-        with engine.connect() as conn:
-            # Обновляем цены в истории для тестовых товаров
-            for product_id in range(1, 6):
-                new_price = random.uniform(10000, 1000000)
-                conn.execute(
-                    "INSERT INTO price_history (product_id, price, timestamp) VALUES (?, ?, ?)",
-                    (product_id, new_price, datetime.utcnow())
-                )
+        # Обход каталога и пакетная запись товаров и истории цен
+        result = asyncio.run(ingest_stream(crawl_products(KASPI_START_URLS)))
         
-        logger.info("Обновление данных завершено успешно")
+        logger.info(f"Обновление данных завершено успешно: {result['products']} товаров")
         
     except Exception as e:
         logger.error(f"Ошибка при обновлении данных: {e}")
 
-# Настраиваем планировщик: обновление каждые 6 часов
-scheduler.add_job(
-    update_all_categories,
-    'interval',
-    hours=6,
-    id='update_job',
-    name='Обновление данных Kaspi'
-)
-
-# Автоматический запуск планировщика
-try:
-    if not scheduler.running:
+def discover_categories():
+    """Постановка в очередь поиска новых категорий каталога"""
+    try:
+        enqueue([{"kind": "discover", "url": url, "priority": 1} for url in KASPI_START_URLS])
+    except Exception as e:
+        logger.error(f"Ошибка постановки поиска категорий: {e}")
+
+def start_scheduler():
+    """Запуск планировщика.
+
+    Вместо полного обхода раз в 6 часов: поиск категорий раз в сутки,
+    пересчет приоритетов и шаг очереди обновлений в рамках бюджета запросов.
+    Сам обход выполняют воркеры очереди (worker.py). Каждую задачу
+    выполняет одна реплика (leader_only).
+    """
+    try:
+        if scheduler.running:
+            return
+        scheduler.add_job(
+            leader_only("discovery", discover_categories, DISCOVERY_HOURS * 3600 * 1.5),
+            'interval',
+            hours=DISCOVERY_HOURS,
+            id='discovery_job',
+            name='Поиск категорий Kaspi',
+            next_run_time=datetime.now(),
+            replace_existing=True
+        )
+        scheduler.add_job(
+            leader_only("scores", update_scores, SCORE_REFRESH_MINUTES * 60 * 1.5),
+            'interval',
+            minutes=SCORE_REFRESH_MINUTES,
+            id='scores_job',
+            name='Пересчет приоритетов обновления',
+            replace_existing=True
+        )
+        # Бюджет запросов планировщика (RefreshPlanner) — у реплики с этой арендой
+        scheduler.add_job(
+            leader_only("refresh", enqueue_planned_refreshes, 90),
+            'interval',
+            minutes=1,
+            id='refresh_job',
+            name='Обновление данных Kaspi',
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
+        scheduler.add_job(
+            leader_only("shared_state", prune_shared_state, 3600 * 1.5),
+            'interval',
+            hours=1,
+            id='shared_state_job',
+            name='Очистка общего состояния реплик',
+            replace_existing=True
+        )
+        scheduler.add_job(
+            leader_only("history", maintain_history, 24 * 3600 * 1.5),
+            'interval',
+            hours=24,
+            id='history_job',
+            name='Секции и архив истории цен',
+            next_run_time=datetime.now(),
+            max_instances=1,
+            replace_existing=True
+        )
         scheduler.start()
         logger.info("Планировщик запущен")
-except Exception as e:
-    logger.error(f"Ошибка запуска планировщика: {e}")
\ No newline at end of file
+    except Exception as e:
+        logger.error(f"Ошибка запуска планировщика: {e}")
\ No newline at end of file
@@ -0,0 +1,184 @@
+import os
+import re
+import logging
+from sqlalchemy import text
+from db import get_engine
+
+logger = logging.getLogger(__name__)
+
+# Результатов /search
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", "10"))
+# Граница узкого запроса: до стольких совпадений они сортируются по отзывам
+# целиком, у более широкого запроса активные товары просматриваются по индексу
+# отзывов до первых limit совпадений. bm25 читает все совпадения каждого слова
+# (на миллионе товаров "смартфон" — больше 100 мс) и здесь не используется.
+# На миллионе товаров узкий запрос занимает 0,5–16 мс, широкий (десятки тысяч
+# совпадений) — 17–62 мс: время уходит на построение множества совпадений в FTS5
+# и раскрытие длинных префиксов. Урезать это множество нельзя без потери точности
+# ранжирования, поэтому цель в единицы мс для широких запросов вне рамок поиска
+SEARCH_NARROW_MATCHES = 1000
+
+_TOKEN = re.compile(r"\w+")
+RESULT_COLUMNS = ("id", "name", "category", "price")
+
+# SQLite: внешний FTS5-индекс по products.name, триггеры обновляют его вместе
+# с таблицей (ingest меняет цены постоянно, поэтому только при смене названия)
+FTS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name ON products
+    WHEN old.name IS NOT new.name BEGIN
+        INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO products_fts (rowid, name) VALUES (new.id, new.name);
+    END
+    """
+)
+
+FTS_COUNT_QUERY = text("""
+    SELECT COUNT(*) FROM (
+        SELECT rowid FROM products_fts WHERE products_fts MATCH :match LIMIT :narrow
+    ) AS found
+""")
+
+# Узкий запрос: совпадения выбираются один раз, matches равно :narrow, если
+# их больше. CROSS JOIN оставляет совпадения внешним циклом
+FTS_QUERY = text("""
+    WITH found AS MATERIALIZED (
+        SELECT rowid FROM products_fts WHERE products_fts MATCH :match LIMIT :narrow
+    )
+    SELECT p.id, p.name, p.category, p.price, (SELECT COUNT(*) FROM found) AS matches
+    FROM found
+    CROSS JOIN products p
+    WHERE p.id = found.rowid AND p.is_active = 1
+    ORDER BY p.reviews DESC
+    LIMIT :limit
+""")
+
+# Широкий запрос: просмотр по убыванию отзывов останавливается на limit-м
+# совпадении; множество совпадений строится внутри SQLite один раз
+FTS_POPULAR_QUERY = text("""
+    SELECT p.id, p.name, p.category, p.price
+    FROM products p INDEXED BY idx_products_active_reviews
+    WHERE p.is_active = 1
+      AND +p.id IN (SELECT rowid FROM products_fts WHERE products_fts MATCH :match)
+    ORDER BY p.reviews DESC
+    LIMIT :limit
+""")
+
+# Есть ли FTS5-индекс в базе SQLite (проверяется один раз на процесс)
+_index_ready = None
+
+
+def ensure_search_index(conn):
+    """Индекс поиска по названиям: FTS5 в SQLite, триграммный GIN в PostgreSQL"""
+    # Самые популярные активные товары первыми: широкий запрос не сортирует все совпадения
+    conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS idx_products_active_reviews
+        ON products(is_active, reviews DESC)
+    """))
+    if conn.dialect.name == "postgresql":
+        try:
+            # pg_trgm может быть недоступен без прав на CREATE EXTENSION
+            with conn.begin_nested():
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text("""
+                    CREATE INDEX IF NOT EXISTS idx_products_name_trgm
+                    ON products USING gin (name gin_trgm_ops)
+                """))
+        except Exception as e:
+            logger.error(f"Ошибка создания триграммного индекса: {e}")
+        return
+
+    if not conn.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar():
+        logger.warning("⚠️ SQLite собран без FTS5: /search работает без индекса")
+        return
+    exists = conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'")
+    ).first()
+    # unicode61 приводит к нижнему регистру кириллицу и латиницу; префиксные
+    # индексы ускоряют короткие запросы вида "ай*"
+    conn.execute(text("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, content='products', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """))
+    for trigger in FTS_TRIGGERS:
+        conn.execute(text(trigger))
+    if not exists:
+        conn.execute(text("INSERT INTO products_fts (products_fts) VALUES ('rebuild')"))
+        logger.info("✅ Индекс поиска товаров построен")
+
+
+def _has_index(conn):
+    global _index_ready
+    if _index_ready is None:
+        _index_ready = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'")
+        ).first() is not None
+        if not _index_ready:
+            logger.warning("⚠️ Индекс поиска товаров не найден, поиск перебором")
+    return _index_ready
+
+
+def _lower(value):
+    return value.lower() if value is not None else None
+
+
+def _like_search(conn, tokens, limit):
+    # Каждое слово — подстрока названия. PostgreSQL сам выбирает план: редкие
+    # слова — по триграммному индексу с сортировкой совпадений, частые — по
+    # индексу отзывов до первых limit строк
+    if conn.dialect.name == "postgresql":
+        operator, column = "ILIKE", "name"
+    else:
+        # LIKE и lower() в SQLite не различают регистр только для ASCII:
+        # кириллица приводится к нижнему регистру функцией Python
+        conn.connection.driver_connection.create_function("py_lower", 1, _lower, deterministic=True)
+        operator, column = "LIKE", "py_lower(name)"
+    params = {"limit": limit}
+    conditions = []
+    for i, token in enumerate(tokens):
+        params[f"p{i}"] = "%" + token.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions.append(f"{column} {operator} :p{i} ESCAPE '\\'")
+    return conn.execute(text(f"""
+        SELECT id, name, category, price FROM products
+        WHERE {' AND '.join(conditions)} AND is_active = 1
+        ORDER BY reviews DESC
+        LIMIT :limit
+    """), params)
+
+
+def search_products(query, limit=SEARCH_LIMIT):
+    """Активные товары, в названии которых есть все слова запроса, популярные первыми"""
+    tokens = _TOKEN.findall(query.lower())[:8]
+    if not tokens:
+        return []
+    try:
+        with get_engine().connect() as conn:
+            if conn.dialect.name == "sqlite" and _has_index(conn):
+                # Последнее слово — префикс ("iphone 14 pr" найдет "iphone 14 pro"),
+                # остальные целиком: префикс объединяет списки всех слов с ним
+                words = [f'"{t}"' for t in tokens]
+                if len(tokens[-1]) > 1:
+                    words[-1] += "*"
+                params = {"match": " ".join(words), "limit": limit, "narrow": SEARCH_NARROW_MATCHES}
+                rows = conn.execute(FTS_QUERY, params).fetchall()
+                matches = rows[0].matches if rows else conn.execute(FTS_COUNT_QUERY, params).scalar()
+                if matches >= SEARCH_NARROW_MATCHES:
+                    rows = conn.execute(FTS_POPULAR_QUERY, params)
+            else:
+                rows = _like_search(conn, tokens, limit)
+            return [{key: row._mapping[key] for key in RESULT_COLUMNS} for row in rows]
+    except Exception as e:
+        logger.error(f"Ошибка поиска товаров по запросу {query!r}: {e}")
+        return []
@@ -0,0 +1,114 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import text, bindparam, DateTime
+from db import get_engine
+
+logger = logging.getLogger(__name__)
+
+# Где хранится состояние, общее для реплик бота: local — в памяти процесса
+# (одна реплика), db — в базе (несколько реплик за балансировщиком)
+SHARED_STATE = os.getenv(
+    "SHARED_STATE", "db" if os.getenv("BOT_MODE", "polling") == "webhook" else "local"
+)
+# Сколько помнить обработанные update_id и file_id графиков
+SHARED_UPDATES_TTL = timedelta(hours=int(os.getenv("SHARED_UPDATES_TTL_HOURS", "24")))
+SHARED_FILE_IDS_TTL = timedelta(days=int(os.getenv("SHARED_FILE_IDS_TTL_DAYS", "30")))
+# update_id в памяти процесса в режиме local
+LOCAL_UPDATES_MAX = 10000
+
+UPDATE_INSERT = text("""
+    INSERT INTO processed_updates (update_id, created_at) VALUES (:update_id, :now)
+    ON CONFLICT (update_id) DO NOTHING
+""").bindparams(bindparam("now", type_=DateTime))
+
+FILE_ID_UPSERT = text("""
+    INSERT INTO chart_file_ids (chart_key, file_id, created_at) VALUES (:key, :file_id, :now)
+    ON CONFLICT (chart_key) DO UPDATE SET file_id = excluded.file_id, created_at = excluded.created_at
+""").bindparams(bindparam("now", type_=DateTime))
+
+# Аренда достается новому владельцу, только если прежняя истекла
+LEASE_UPSERT = text("""
+    INSERT INTO leases (name, owner, expires_at) VALUES (:name, :owner, :expires)
+    ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+    WHERE leases.owner = excluded.owner OR leases.expires_at < :now
+""").bindparams(bindparam("expires", type_=DateTime), bindparam("now", type_=DateTime))
+
+_updates = OrderedDict()
+_lock = threading.Lock()
+
+
+def _shared():
+    return SHARED_STATE == "db"
+
+
+def _key_text(key):
+    return "_".join(str(part) for part in key)
+
+
+def claim_update(update_id):
+    """True, если update еще не обрабатывался ни одной репликой"""
+    if not _shared():
+        with _lock:
+            if update_id in _updates:
+                return False
+            _updates[update_id] = True
+            if len(_updates) > LOCAL_UPDATES_MAX:
+                _updates.popitem(last=False)
+            return True
+    with get_engine().begin() as conn:
+        result = conn.execute(UPDATE_INSERT, {"update_id": update_id, "now": datetime.utcnow()})
+    return result.rowcount == 1
+
+
+def get_file_id(key):
+    """file_id графика, отправленного любой репликой (в режиме local — None:
+    в памяти процесса их хранит chart_cache)"""
+    if not _shared():
+        return None
+    with get_engine().connect() as conn:
+        return conn.execute(
+            text("SELECT file_id FROM chart_file_ids WHERE chart_key = :key"), {"key": _key_text(key)}
+        ).scalar()
+
+
+def set_file_id(key, file_id):
+    """Сохранение file_id графика для остальных реплик"""
+    if not _shared():
+        return
+    with get_engine().begin() as conn:
+        conn.execute(FILE_ID_UPSERT, {"key": _key_text(key), "file_id": file_id, "now": datetime.utcnow()})
+
+
+def acquire_lease(name, owner, seconds):
+    """Захват или продление именованной аренды: True, если она у owner.
+
+    Так фоновые задачи вроде отправки уведомлений выполняет одна реплика,
+    и общий лимит отправки в Telegram соблюдается на всех.
+    """
+    if not _shared():
+        return True
+    now = datetime.utcnow()
+    params = {"name": name, "owner": owner, "expires": now + timedelta(seconds=seconds), "now": now}
+    with get_engine().begin() as conn:
+        return conn.execute(LEASE_UPSERT, params).rowcount == 1
+
+
+def prune_shared_state():
+    """Удаление устаревших update_id и file_id графиков"""
+    if not _shared():
+        return
+    try:
+        now = datetime.utcnow()
+        with get_engine().begin() as conn:
+            updates = conn.execute(text("DELETE FROM processed_updates WHERE created_at < :before")
+                                   .bindparams(bindparam("before", type_=DateTime)),
+                                   {"before": now - SHARED_UPDATES_TTL}).rowcount
+            file_ids = conn.execute(text("DELETE FROM chart_file_ids WHERE created_at < :before")
+                                    .bindparams(bindparam("before", type_=DateTime)),
+                                    {"before": now - SHARED_FILE_IDS_TTL}).rowcount
+        logger.info(f"Общее состояние: удалено {updates} update_id и {file_ids} file_id")
+    except Exception as e:
+        logger.error(f"Ошибка очистки общего состояния: {e}")
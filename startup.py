@@ -0,0 +1,31 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Момент запуска процесса: модуль импортируется первым в bot.py
+PROCESS_START = time.perf_counter()
+
+_marks = {}
+
+
+def mark(name, duration=None):
+    """Отметка этапа запуска: время с начала процесса и длительность этапа"""
+    if name in _marks:
+        return
+    _marks[name] = {
+        "at_ms": round((time.perf_counter() - PROCESS_START) * 1000, 1),
+        "duration_ms": round(duration * 1000, 1) if duration is not None else None
+    }
+
+
+def report():
+    """Отчет о времени запуска в лог"""
+    lines = []
+    for name, timing in sorted(_marks.items(), key=lambda item: item[1]["at_ms"]):
+        line = f"{name}: +{timing['at_ms']} мс"
+        if timing["duration_ms"] is not None:
+            line += f" (заняло {timing['duration_ms']} мс)"
+        lines.append(line)
+    logger.info("⏱ Время запуска:\n" + "\n".join(lines))
+    return dict(_marks)
@@ -0,0 +1,112 @@
+import os
+import hmac
+import asyncio
+import logging
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес бота (https://example.com) и путь, на который Telegram шлет обновления
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token: 1-256 символов A-Z, a-z, 0-9, _ и -
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Регистрировать webhook в Telegram при старте (достаточно одной реплики)
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") == "1"
+# Адрес HTTP-сервера; PORT задают хостинги вроде Render
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", os.getenv("PORT", "8080")))
+# Одновременно обрабатываемые обновления и очередь сверх них; при переполнении
+# Telegram получает 503 и повторит доставку позже
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "32"))
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "500"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+_pending = set()
+
+
+async def _process(dp, slots, data):
+    from async_db import claim_update
+    try:
+        async with slots:
+            # Повторная доставка того же обновления (таймаут, другая реплика) пропускается
+            try:
+                if not await claim_update(data["update_id"]):
+                    return
+            except Exception as e:
+                logger.error(f"Ошибка проверки update_id {data['update_id']}: {e}")
+            Bot.set_current(dp.bot)
+            Dispatcher.set_current(dp)
+            await dp.process_update(types.Update(**data))
+    except Exception as e:
+        logger.error(f"Ошибка обработки обновления {data.get('update_id')}: {e}")
+
+
+def create_app(dp, on_startup=None):
+    """aiohttp-приложение: прием обновлений Telegram, /healthz и /metrics"""
+    slots = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+
+    async def handle_update(request):
+        secret = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            logger.warning(f"Отклонен запрос webhook без верного секрета от {request.remote}")
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+            int(data["update_id"])
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        if len(_pending) >= WEBHOOK_MAX_PENDING:
+            return web.Response(status=503, headers={"Retry-After": "1"})
+
+        # Ответ сразу: Telegram не ждет обработки и шлет следующие обновления
+        task = asyncio.create_task(_process(dp, slots, data))
+        _pending.add(task)
+        task.add_done_callback(_pending.discard)
+        return web.Response(text="ok")
+
+    async def handle_health(request):
+        return web.Response(text="ok")
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    async def startup(app):
+        if WEBHOOK_REGISTER:
+            url = WEBHOOK_HOST.rstrip("/") + WEBHOOK_PATH
+            await dp.bot.set_webhook(url, secret_token=WEBHOOK_SECRET,
+                                     max_connections=min(WEBHOOK_CONCURRENCY, 100))
+            logger.info(f"🌐 Webhook зарегистрирован: {url}")
+        if on_startup:
+            await on_startup(dp)
+
+    async def cleanup(app):
+        # Webhook не удаляется: обновления продолжат принимать остальные реплики
+        if _pending:
+            logger.info(f"Ожидание {len(_pending)} обновлений перед остановкой")
+            await asyncio.wait(list(_pending), timeout=30)
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.router.add_get("/healthz", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    app.on_startup.append(startup)
+    app.on_cleanup.append(cleanup)
+    return app
+
+
+def start_webhook(dp, on_startup=None):
+    """Запуск бота в режиме webhook (блокирует до остановки процесса)"""
+    if not WEBHOOK_SECRET:
+        logger.error("❌ WEBHOOK_SECRET не задан!")
+        raise ValueError("Не указан WEBHOOK_SECRET!")
+    if WEBHOOK_REGISTER and not WEBHOOK_HOST:
+        logger.error("❌ WEBHOOK_HOST не задан!")
+        raise ValueError("Не указан WEBHOOK_HOST!")
+    logger.info(f"🌐 Прием обновлений на http://{WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    web.run_app(create_app(dp, on_startup), host=WEBAPP_HOST, port=WEBAPP_PORT, print=None)
@@ -0,0 +1,130 @@
+import os
+import socket
+import signal
+import asyncio
+import logging
+import argparse
+from dotenv import load_dotenv
+
+# Переменные окружения читаются модулями при импорте
+load_dotenv()
+
+from parser import iter_category_products, create_session, HostRateLimiter
+from ingest import ingest_stream
+from jobs import claim, heartbeat, complete, fail, JOB_LEASE_SECONDS
+from planner import record_refresh, discover_targets, update_scores
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Одновременно выполняемые задачи и пауза опроса пустой очереди
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "5"))
+
+
+class Worker:
+    """Воркер очереди обхода: берет задачи в аренду, продлевает ее и отчитывается"""
+
+    def __init__(self, concurrency=WORKER_CONCURRENCY, worker_id=None):
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.running = {}
+        self.stopping = asyncio.Event()
+        self.session = None
+        self.limiter = HostRateLimiter()
+
+    def stop(self):
+        """Остановка: новые задачи не берутся, текущие дорабатываются"""
+        self.stopping.set()
+
+    async def _run_category(self, job):
+        stats = {}
+        await ingest_stream(
+            iter_category_products(job["url"], session=self.session, limiter=self.limiter, stats=stats)
+        )
+        await asyncio.to_thread(record_refresh, job["url"], stats)
+
+    async def _run_discover(self, job):
+        await discover_targets([job["url"]])
+        await asyncio.to_thread(update_scores)
+
+    async def _execute(self, job):
+        handlers = {"category": self._run_category, "discover": self._run_discover}
+        try:
+            handler = handlers.get(job["kind"])
+            if handler is None:
+                raise ValueError(f"Неизвестный тип задачи: {job['kind']}")
+            await handler(job)
+            await asyncio.to_thread(complete, self.worker_id, job["id"])
+        except asyncio.CancelledError:
+            # Аренду забрал другой воркер — результат отчитает он
+            logger.warning(f"Задача {job['id']} прервана: аренда потеряна")
+        except Exception as e:
+            await asyncio.to_thread(fail, self.worker_id, job, e)
+        finally:
+            self.running.pop(job["id"], None)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            if not self.running:
+                continue
+            try:
+                held = await asyncio.to_thread(heartbeat, self.worker_id, list(self.running))
+            except Exception as e:
+                logger.error(f"Ошибка продления аренды: {e}")
+                continue
+            for job_id, task in list(self.running.items()):
+                if job_id not in held:
+                    task.cancel()
+
+    async def run(self):
+        """Основной цикл: опрос очереди, пока не вызван stop()"""
+        logger.info(f"🛠 Воркер {self.worker_id} запущен, задач одновременно: {self.concurrency}")
+        async with create_session(self.concurrency) as session:
+            self.session = session
+            beat = asyncio.create_task(self._heartbeat())
+            try:
+                while not self.stopping.is_set():
+                    free = self.concurrency - len(self.running)
+                    jobs = []
+                    if free > 0:
+                        try:
+                            jobs = await asyncio.to_thread(claim, self.worker_id, free)
+                        except Exception as e:
+                            logger.error(f"Ошибка получения задач: {e}")
+                    for job in jobs:
+                        self.running[job["id"]] = asyncio.create_task(self._execute(job))
+
+                    if jobs and len(self.running) < self.concurrency:
+                        continue
+                    # Ждем освобождения слота, новых задач или остановки
+                    waiters = [asyncio.create_task(self.stopping.wait()), *self.running.values()]
+                    await asyncio.wait(waiters, timeout=WORKER_POLL_SECONDS,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    waiters[0].cancel()
+
+                if self.running:
+                    logger.info(f"Ожидание {len(self.running)} задач перед остановкой")
+                    await asyncio.gather(*self.running.values(), return_exceptions=True)
+            finally:
+                beat.cancel()
+        logger.info(f"Воркер {self.worker_id} остановлен")
+
+
+async def main(concurrency, metrics_port=0):
+    await metrics.start_metrics_server(metrics_port)
+    worker = Worker(concurrency)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    await worker.run()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = argparse.ArgumentParser(description="Воркер очереди обхода Kaspi")
+    args.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY)
+    args.add_argument("--metrics-port", type=int, default=0, help="порт /metrics (0 — выключен)")
+    opts = args.parse_args()
+    asyncio.run(main(opts.concurrency, opts.metrics_port))